@@ -1,5 +1,5 @@
 """Initialize app."""
-from flask import Flask
+from flask import Flask, request
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager, current_user, login_user, logout_user
 from db_api import DatabaseAPI
@@ -29,6 +29,42 @@ def create_app(config_class=Config):
     bootstrap.init_app(app)
     login_manager.init_app(app)
 
+    # Count and time the queries run by each request
+    @app.before_request
+    def beginquerymetrics():
+        gdb.querymetrics.begin()
+
+    @app.after_request
+    def endquerymetrics(response):
+        metrics = gdb.querymetrics.end(request.endpoint)
+        # Report queries in response headers when debugging
+        if app.debug and metrics is not None:
+            response.headers['X-DB-Query-Count'] = metrics['queries']
+            response.headers['X-DB-Time-Ms'] = metrics['dbms']
+            for i, (ms, statement) in enumerate(metrics['slowest']):
+                response.headers[f'X-DB-Slowest-{i + 1}'] = (
+                    f"{ms}ms {' '.join(statement.split())[:200]}")
+        return response
+
+    # Share one database session and transaction across each request,
+    # except scheduled tasks, which commit their work in batches
+    if config_class.DB_REQUEST_SESSIONS:
+        @app.before_request
+        def beginrequestsession():
+            if not request.path.startswith('/tasks/'):
+                gdb.beginrequestsession()
+
+        @app.after_request
+        def commitrequestsession(response):
+            # Commit before the response is sent so failures return an error
+            gdb.endrequestsession()
+            return response
+
+        @app.teardown_appcontext
+        def endrequestsession(exception):
+            # Roll back a request session that was not committed
+            gdb.endrequestsession(commit=False)
+
     # Import parts of our application
     from app.main import bp as main_bp
     from app.admin import bp as admin_bp
@@ -97,24 +97,33 @@ def userlist():
         order = request.args.get('order')
     else:
         order = "asc"
-    # Get the page of shares to display and calculate offset
+    # Get the page of users to display, continuing from the page cursor
+    # if given so that deep pages do not skip over every earlier user
     # TODO: DEFINE LIMIT IN A CONFIG
     limit = 10
-    if(request.args.get('page')):
+    cursor = request.args.get('cursor')
+    if(request.args.get('page') and not cursor):
         offset = 10*(int(request.args.get('page'))-1)
     else:
         offset = 0
-    # Get users
-    users, usercount = gdb.getusers(
-        orderby=orderby,
-        order=order,
-        offset=offset,
-        limit=limit)
+    # Get users, estimating the count of the whole user table from table
+    # statistics, aborting if the page cursor is invalid
+    try:
+        users, usercount, cursors = gdb.getusers(
+            orderby=orderby,
+            order=order,
+            offset=offset,
+            limit=limit,
+            cursor=cursor,
+            countstrategy="estimate")
+    except ValueError:
+        abort(400)
     # Render template
     return render_template('admin/userlist.html',
                            users=users,
                            usercount=usercount,
-                           countperpage=limit)
+                           countperpage=limit,
+                           cursors=cursors)
 
 
 @bp.route('/user/<userID>')
@@ -162,3 +171,22 @@ def unbanuser(userID):
 
     # Redirect to reffering page or admin dashboard
     return redirect(request.referrer or url_for('admin.dashboard'))
+
+
+@bp.route('/database')
+@admin_login_required
+def database():
+    """
+    Shows database connection pool metrics and the queries run by each
+    endpoint to admin.
+
+    """
+    # Get connection pool state and counters
+    poolmetrics = gdb.poolmetrics.snapshot()
+    # Get query metrics of each endpoint
+    querymetrics = gdb.querymetrics.snapshot()
+
+    # Render template with metrics
+    return render_template('admin/database.html',
+                           poolmetrics=poolmetrics,
+                           querymetrics=querymetrics)
@@ -7,7 +7,9 @@ from app import gdb, login_manager
 from app.main import bp
 from app.main.forms import (UserLoginForm, UserRegistrationForm,
                             BuyShareForm, SellShareForm)
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
+import downsampling
+import numpy as np
 
 
 def user_login_required(f):
@@ -164,9 +166,9 @@ def dashboard():
     user = current_user
     # Get tip of the day
     tip = gdb.gettipofday()
-    # Get current user Leaderboard Status
-    leaderboard, current_user_info = gdb.getleaderboard(current_user.userID)
-    weektopgainers, monthtopgainers = gdb.gettopgainers()
+    # Get current user Leaderboard Status and top of leaderboard
+    leaderboard, current_user_info, usercount = gdb.getleaderboard(
+        current_user.userID, limit=5)
     # Render template
     return render_template('dashboard.html', user=user,
                            leaderboard=leaderboard,
@@ -197,7 +199,7 @@ def portfolio():
     else:
         offset = 0
     # Get processed usershare info
-    usershares, sharecount = gdb.getusersharesinfo(
+    usershares, sharecount, cursors = gdb.getusersharesinfo(
         userID=user.userID,
         orderby=orderby,
         order=order,
@@ -209,6 +211,7 @@ def portfolio():
                            usershares=usershares,
                            sharecount=sharecount,
                            countperpage=limit,
+                           cursors=cursors,
                            userbalance=current_user.balance)
 
 
@@ -236,17 +239,19 @@ def sharelist():
         offset = 10*(int(request.args.get('page'))-1)
     else:
         offset = 0
-    # Get shares
-    shares, sharecount = gdb.getshares(
+    # Get shares, caching the share count as shares are rarely added
+    shares, sharecount, cursors = gdb.getshares(
         orderby=orderby,
         order=order,
         offset=offset,
-        limit=limit)
+        limit=limit,
+        countstrategy="cached")
 
     # Render template
     return render_template('sharelist.html', shares=shares,
                            sharecount=sharecount,
                            countperpage=limit,
+                           cursors=cursors,
                            userbalance=current_user.balance)
 
 
@@ -277,27 +282,37 @@ def share(issuerID):
         order = request.args.get('order')
     else:
         order = "desc"
-    # Get the page of shares to display and calculate offset
+    # Get the page of transactions to display, continuing from the page
+    # cursor if given so that deep pages do not skip over every earlier
+    # transaction
     # TODO: DEFINE LIMIT IN A CONFIG
     limit = 10
-    if(request.args.get('page')):
+    cursor = request.args.get('cursor')
+    if(request.args.get('page') and not cursor):
         offset = 10*(int(request.args.get('page'))-1)
     else:
         offset = 0
-    # Get share transaction history for user
-    transactions, transcount = gdb.gettransactions(
-        userID=current_user.userID,
-        issuerID=share.issuerID,
-        orderby=orderby,
-        order=order,
-        offset=offset,
-        limit=limit)
+    # Get share transaction history for user without counting it, as the
+    # page cursors show whether there are further pages, aborting if the
+    # page cursor is invalid
+    try:
+        transactions, transcount, cursors = gdb.gettransactions(
+            userID=current_user.userID,
+            issuerID=share.issuerID,
+            orderby=orderby,
+            order=order,
+            offset=offset,
+            limit=limit,
+            cursor=cursor,
+            countstrategy="none")
+    except ValueError:
+        abort(400)
 
     # Render template for share page
     return render_template('share.html', share=share,
                            buyform=buyform, sellform=sellform,
                            transactions=transactions, transcount=transcount,
-                           countperpage=limit,
+                           countperpage=limit, cursors=cursors,
                            userbalance=current_user.balance)
 
 
@@ -355,28 +370,110 @@ def sellshares():
     return redirect(request.referrer or url_for('main.dashboard'))
 
 
+@bp.route('/submitorders', methods=['POST'])
+@user_login_required
+def submitorders():
+    """
+    Handles a batch of share purchases and sales, given as JSON of the form
+    {"orders": [{"issuerID": "CBA", "quantity": 10, "transtype": "B"}]}.
+    Either every order is executed or none are.
+
+    """
+    # Get orders from JSON request data
+    data = request.get_json(silent=True) or {}
+    orders = data.get('orders')
+    if not isinstance(orders, list) or not all(
+            isinstance(order, dict) for order in orders):
+        return jsonify(success=False), 400
+    # Call submitorders API
+    success = gdb.submitorders(current_user.userID, orders)
+    # Return whether orders were executed
+    return jsonify(success=success)
+
+
+@bp.route('/placeorder', methods=['POST'])
+@user_login_required
+def placeorder():
+    """
+    Places a limit or stop order, given as JSON of the form
+    {"issuerID": "CBA", "transtype": "B", "ordertype": "limit",
+     "triggerprice": 90.5, "quantity": 10}.
+
+    """
+    # Get order from JSON request data
+    data = request.get_json(silent=True) or {}
+    # Call placeorder API
+    orderID = gdb.placeorder(
+        current_user.userID, data.get('issuerID'), data.get('transtype'),
+        data.get('ordertype'), data.get('triggerprice'),
+        data.get('quantity'))
+    # Return ID of placed order
+    return jsonify(success=orderID is not None, orderID=orderID)
+
+
+@bp.route('/cancelorder', methods=['POST'])
+@user_login_required
+def cancelorder():
+    """
+    Cancels a limit or stop order, given as JSON of the form
+    {"orderID": 1}.
+
+    """
+    # Get order ID from JSON request data
+    data = request.get_json(silent=True) or {}
+    # Call cancelorder API
+    cancelled = gdb.cancelorder(current_user.userID, data.get('orderID'))
+    # Return whether order was cancelled
+    return jsonify(success=cancelled)
+
+
 @bp.route('/updates/pricegraph', methods=['POST'])
 def sharepricehistorydata():
+    """
+    Returns share price history of a share for the price graph. If a number
+    of points is given, the history is downsampled to that many points
+    using the given method, 'lttb' (default) or 'minmax'. Long periods are
+    read from share price rollups rather than every share price.
+
+    """
     # Get JSON request data
     data = request.get_json()
     issuerID = data.get('issuerID')
-    endtime = datetime.now()
-    starttime = endtime - timedelta(data.get('days'))
-    # Get share price history for given share and period
-    sharepricehistory = gdb.getsharepricehistory(
-        issuerID=issuerID, starttime=starttime, endtime=endtime)
-    # Parse results into dictionary
-    data = list()
-    for shareprice in sharepricehistory:
-        # Change timezone of recording time
-        time = str(shareprice.time.replace(
-            tzinfo=timezone.utc).astimezone(tz=None))
-        # Define price
-        price = shareprice.price
-        data.append({
-            "time": time,
-            "price": price
-        })
+    # Get period and number of points to downsample to, if specified,
+    # aborting if either is not a number
+    try:
+        endtime = datetime.now()
+        starttime = endtime - timedelta(float(data.get('days')))
+        points = int(data.get('points') or 0)
+    except (ValueError, TypeError, OverflowError):
+        abort(400)
+    # Abort if there are too few points to downsample to, with 0 meaning
+    # the history is not downsampled
+    if(points < 0 or 0 < points < downsampling.MINTHRESHOLD):
+        abort(400)
+    # Get downsampling method, if specified
+    method = downsampling.METHODS.get(data.get('method'), downsampling.lttb)
+    if points and endtime - starttime > timedelta(hours=points):
+        # Use closing prices of share price rollups, since even hourly
+        # prices would be more than the requested number of points
+        resolution, rollups = gdb.getsharepricerollups(
+            issuerID=issuerID, starttime=starttime, endtime=endtime,
+            maxpoints=points)
+        times = np.array([rollup.time for rollup in rollups],
+                         dtype='datetime64[us]').astype(np.int64) / 1e6
+        prices = np.array([rollup.close for rollup in rollups])
+    else:
+        # Get share price history for given share and period
+        times, prices = gdb.getsharepriceseries(
+            issuerID=issuerID, starttime=starttime, endtime=endtime)
+    # Downsample share price history to requested number of points
+    if points and len(times) > points:
+        indices = method(times, prices, points)
+        times = times[indices]
+        prices = prices[indices]
+    # Parse results into dictionary, with times as epoch milliseconds
+    data = [{"time": time, "price": price} for time, price in
+            zip((times * 1000).astype(np.int64).tolist(), prices.tolist())]
     # Return results as JSON
     return jsonify(data)
 
@@ -397,14 +494,23 @@ def sharesupdate():
 @user_login_required
 def leaderboard():
     """Displays overall leaderboard and top gainer leaderboards """
-    # Get leaderboard and user information
-    leaderboard, current_user_info = gdb.getleaderboard(current_user.userID)
+    # Get the page of users to display and calculate offset
+    # TODO: DEFINE LIMIT IN A CONFIG
+    limit = 10
+    if(request.args.get('page')):
+        offset = 10*(int(request.args.get('page'))-1)
+    else:
+        offset = 0
+    # Get page of leaderboard and user information
+    leaderboard, current_user_info, usercount = gdb.getleaderboard(
+        current_user.userID, limit=limit, offset=offset)
     # Get top gainer leaderboards
     weektopgainers, monthtopgainers = gdb.gettopgainers()
     # Render template
     return render_template('leaderboard.html',
                            leaderboard=leaderboard,
                            current_user_info=current_user_info,
+                           usercount=usercount, countperpage=limit,
                            weektopgainers=weektopgainers,
                            monthtopgainers=monthtopgainers,
                            userbalance=current_user.balance)
@@ -419,3 +525,14 @@ def updateleaderboard():
     gdb.updateleaderboard()
     # Return success
     return jsonify(success=True)
+
+
+@bp.route('/tasks/compactleaderboard')
+def compactleaderboard():
+    """
+    Compact leaderboard history
+    """
+    # Compact leaderboard
+    gdb.compactleaderboard()
+    # Return success
+    return jsonify(success=True)
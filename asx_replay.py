@@ -0,0 +1,249 @@
+"""
+Offline stand-in for the ASX API, for benchmarking and load testing share
+ingestion without network access.
+
+The server replays recorded company, share and chart payloads from a
+fixture directory laid out as follows:
+    <fixture directory>/company/<issuer ID>.json
+    <fixture directory>/share/<issuer ID>.json
+    <fixture directory>/chart/<issuer ID>.json
+
+Fixtures are recorded from ASX with:
+    python asx_replay.py record ASX CBA BHP
+The server is started with:
+    python asx_replay.py serve --port 8089 --latency 0.05 --errorrate 0.01
+The application is then pointed at the server by setting ASX_BASE_URL to
+"http://127.0.0.1:8089".
+
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import os
+import random
+import requests
+import time
+
+
+# Default directory for recorded fixtures
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "fixtures", "asx")
+
+
+def recordfixtures(issuerIDs, fixturedir=FIXTURE_DIR,
+                   baseurl="https://www.asx.com.au"):
+    """
+    Records company, share and chart payloads from ASX as fixtures.
+
+    Args:
+        issuerIDs (list): Issuer IDs of shares to record.
+        fixturedir (str): Directory to save fixtures in.
+            Defaults to FIXTURE_DIR.
+        baseurl (str): Base URL of the ASX API to record from.
+            Defaults to "https://www.asx.com.au".
+    Returns:
+        List of issuer IDs that were recorded successfully.
+
+    """
+    # Create fixture directories if not already present
+    for kind in ("company", "share", "chart"):
+        os.makedirs(os.path.join(fixturedir, kind), exist_ok=True)
+    # Record each share using the same connection
+    recorded = list()
+    with requests.Session() as http:
+        for issuerID in issuerIDs:
+            # Get company and share data
+            company = http.get(f"{baseurl}/asx/1/company/"
+                               f"{issuerID}?fields=primary_share").json()
+            share = http.get(f"{baseurl}/asx/1/share/"
+                             f"{issuerID}?fields=primary_share").json()
+            # Skip shares that ASX does not know of
+            if company.get('error_code') or share.get('error_code'):
+                continue
+            # Get share price history
+            code = company['primary_share']['code']
+            chart = http.get(f"{baseurl}/asx/1/chart/highcharts?"
+                             f"asx_code={code}&complete=true").json()
+            # Save each payload
+            for kind, payload in (("company", company), ("share", share),
+                                  ("chart", chart)):
+                path = os.path.join(fixturedir, kind, f"{issuerID}.json")
+                with open(path, "w") as fixture:
+                    json.dump(payload, fixture)
+            recorded.append(issuerID)
+    # Return recorded shares
+    return recorded
+
+
+def synthesisefixture(kind, issuerID):
+    """
+    Generates a deterministic payload for a share that has no recorded
+    fixture, so that any number of shares can be served.
+
+    Args:
+        kind (str): Kind of payload, 'company', 'share' or 'chart'.
+        issuerID (str): Issuer ID of share to generate payload for.
+    Returns:
+        The generated payload.
+
+    """
+    # Seed generator with the issuer ID so payloads are reproducible
+    generator = random.Random(issuerID)
+    lastprice = round(generator.uniform(0.5, 100), 3)
+    changeprice = round(generator.uniform(-1, 1), 3)
+    share = {
+        "code": issuerID,
+        "last_price": lastprice,
+        "market_cap": generator.randint(10**6, 10**11),
+        "number_of_shares": generator.randint(10**6, 10**10),
+        "change_in_percent": f"{round(changeprice/lastprice*100, 3)}%",
+        "change_price": changeprice,
+        "day_high_price": round(lastprice*1.02, 3),
+        "day_low_price": round(lastprice*0.98, 3),
+        "volume": generator.randint(10**3, 10**7)
+    }
+    if kind == "share":
+        return share
+    if kind == "company":
+        return {
+            "code": issuerID,
+            "name_full": f"{issuerID} LIMITED",
+            "name_short": f"{issuerID} SHORT",
+            "name_abbrev": f"{issuerID} ABBREV",
+            "principal_activities": f"Synthetic share {issuerID}.",
+            "sector_name": "Synthetic",
+            "primary_share": share
+        }
+    # Generate a year of daily prices ending at the current day
+    chart = list()
+    price = lastprice
+    endtime = int(time.time() // 86400) * 86400
+    for day in range(365, 0, -1):
+        price = max(0.01, round(price*generator.uniform(0.97, 1.03), 3))
+        chart.append([(endtime - day*86400)*1000, price, price, price,
+                      price, generator.randint(10**3, 10**7)])
+    return chart
+
+
+class ASXReplayHandler(BaseHTTPRequestHandler):
+    """
+    Request handler that replays fixtures for the ASX API endpoints used by
+    the application.
+
+    """
+    def do_GET(self):
+        # Parse request path into fixture kind and issuer ID
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts[:3] == ["asx", "1", "chart"]:
+            kind = "chart"
+            issuerID = parse_qs(url.query).get("asx_code", [""])[0]
+        elif parts[:3] in (["asx", "1", "company"], ["asx", "1", "share"]):
+            kind = parts[2]
+            issuerID = parts[3] if len(parts) > 3 else ""
+        else:
+            return self.respond(404, {"error_code": "404",
+                                      "error_desc": "Unknown endpoint"})
+        issuerID = issuerID.upper()
+        # Simulate network latency
+        latency = self.server.latency + random.uniform(0, self.server.jitter)
+        if latency > 0:
+            time.sleep(latency)
+        # Inject errors at the configured rate
+        if random.random() < self.server.errorrate:
+            return self.respond(404, {"error_code": "404",
+                                      "error_desc": "Injected error"})
+        # Respond with recorded fixture if present
+        path = os.path.join(self.server.fixturedir, kind, f"{issuerID}.json")
+        if os.path.isfile(path):
+            with open(path) as fixture:
+                return self.respond(200, json.load(fixture))
+        # Otherwise respond with synthetic payload for valid looking codes
+        if (self.server.synthetic and len(issuerID) == 3 and
+                issuerID.isalpha()):
+            return self.respond(200, synthesisefixture(kind, issuerID))
+        return self.respond(404, {"error_code": "404",
+                                  "error_desc": f"{issuerID} not found"})
+
+    def respond(self, status, payload):
+        """
+        Sends given payload as a JSON response.
+
+        Args:
+            status (int): HTTP status code of response.
+            payload: JSON serialisable payload of response.
+
+        """
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't log each request, as it slows down load tests
+        pass
+
+
+def createserver(host="127.0.0.1", port=8089, fixturedir=FIXTURE_DIR,
+                 latency=0.0, jitter=0.0, errorrate=0.0, synthetic=False):
+    """
+    Creates an ASX replay server. Call serve_forever on the returned server
+    to start handling requests.
+
+    Args:
+        host (str): Host to bind to. Defaults to "127.0.0.1".
+        port (int): Port to bind to, 0 picks a free port. Defaults to 8089.
+        fixturedir (str): Directory of recorded fixtures.
+            Defaults to FIXTURE_DIR.
+        latency (float): Seconds to delay every response by.
+            Defaults to 0.
+        jitter (float): Maximum random seconds added to latency.
+            Defaults to 0.
+        errorrate (float): Fraction of requests that respond with an ASX
+            error. Defaults to 0.
+        synthetic (bool): Whether to generate payloads for shares without
+            recorded fixtures. Defaults to False.
+    Returns:
+        The created server.
+
+    """
+    server = ThreadingHTTPServer((host, port), ASXReplayHandler)
+    server.daemon_threads = True
+    server.fixturedir = fixturedir
+    server.latency = latency
+    server.jitter = jitter
+    server.errorrate = errorrate
+    server.synthetic = synthetic
+    return server
+
+
+# Allow recording and serving fixtures by running module directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline ASX stand-in.")
+    parser.add_argument("--fixturedir", default=FIXTURE_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record = subparsers.add_parser("record", help="Record fixtures.")
+    record.add_argument("issuerIDs", nargs="+")
+    record.add_argument("--baseurl", default="https://www.asx.com.au")
+    serve = subparsers.add_parser("serve", help="Serve fixtures.")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8089)
+    serve.add_argument("--latency", type=float, default=0.0)
+    serve.add_argument("--jitter", type=float, default=0.0)
+    serve.add_argument("--errorrate", type=float, default=0.0)
+    serve.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+    if args.command == "record":
+        recorded = recordfixtures(args.issuerIDs, args.fixturedir,
+                                  args.baseurl)
+        print(f"Recorded {len(recorded)} shares: {' '.join(recorded)}")
+    else:
+        server = createserver(args.host, args.port, args.fixturedir,
+                              args.latency, args.jitter, args.errorrate,
+                              args.synthetic)
+        print(f"Serving ASX fixtures at "
+              f"http://{args.host}:{server.server_port}")
+        server.serve_forever()
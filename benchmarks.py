@@ -0,0 +1,486 @@
+"""
+Benchmarks for measuring performance of the database API.
+
+Benchmarks run against the database given by the application config and
+add and remove their own data, so they should be pointed at a disposable
+database. ASX data is served by the offline stand-in in asx_replay.py, so
+no network access is required.
+
+Usage:
+    python benchmarks.py <benchmark> [options]
+Run with --help for the list of benchmarks and their options.
+
+"""
+from db_api import DatabaseAPI
+from config import Config
+from models import (Share, SharePrice, SharePriceRollup, User, Usershare,
+                    Transaction, Leaderboard, Ranking)
+from datetime import datetime, date, timedelta
+from itertools import product
+from sqlalchemy import func, case
+import argparse
+import asx_replay
+import random
+import string
+import threading
+import time
+import tracemalloc
+
+
+def syntheticissuerIDs(count):
+    """
+    Generates issuer IDs for synthetic shares served by the ASX stand-in.
+
+    Args:
+        count (int): Number of issuer IDs to generate, at most 676.
+    Returns:
+        List of generated issuer IDs.
+
+    """
+    codes = product(string.ascii_uppercase, repeat=2)
+    return ["Z" + "".join(code) for code, i in zip(codes, range(count))]
+
+
+def startreplayserver(**kwargs):
+    """
+    Starts an ASX stand-in server in a background thread.
+
+    Args:
+        Keyword arguments are passed to asx_replay.createserver.
+    Returns:
+        The running server.
+        Base URL of the running server.
+
+    """
+    server = asx_replay.createserver(port=0, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def addsyntheticusers(session, userIDs, balance):
+    """
+    Adds users for benchmarking with a single bulk insert.
+
+    Args:
+        session: Session to add users in.
+        userIDs (list): IDs of users to add.
+        balance (float): Balance of every user.
+
+    """
+    session.bulk_insert_mappings(User, [{
+        "userID": userID, "email": f"bench{userID}@example.com",
+        "username": f"bench{userID}", "userpass": "",
+        "firstname": "Bench", "lastname": "User", "gender": "Other",
+        "dob": date(2000, 1, 1), "verified": True, "banned": False,
+        "balance": balance, "overallPerc": 0, "totalNumSales": 0}
+        for userID in userIDs])
+
+
+def benchmarkupdateshares(args):
+    """
+    Measures ingestion throughput of addshare, generatesharepricehistory
+    and updateshares against the ASX stand-in.
+
+    """
+    # Start ASX stand-in and point database API at it
+    server, baseurl = startreplayserver(
+        fixturedir=args.fixturedir, latency=args.latency,
+        jitter=args.jitter, errorrate=args.errorrate, synthetic=True)
+    config = type("BenchmarkConfig", (Config,), {
+        "ASX_BASE_URL": baseurl, "ASX_FETCH_WORKERS": args.workers})
+    gdb = DatabaseAPI(config)
+    gdb.createtables()
+    issuerIDs = syntheticissuerIDs(args.shares)
+    try:
+        # Add shares
+        starttime = time.perf_counter()
+        for issuerID in issuerIDs:
+            gdb.addshare(issuerID)
+        addtime = time.perf_counter() - starttime
+        print(f"addshare: {len(issuerIDs)} shares in {addtime:.3f}s "
+              f"({len(issuerIDs)/addtime:.1f} shares/s)")
+        # Generate share price history
+        starttime = time.perf_counter()
+        rows = sum(gdb.generatesharepricehistory(issuerID) or 0
+                   for issuerID in issuerIDs)
+        historytime = time.perf_counter() - starttime
+        print(f"generatesharepricehistory: {rows} rows in "
+              f"{historytime:.3f}s ({rows/historytime:.1f} rows/s)")
+        # Update shares
+        for run in range(args.runs):
+            starttime = time.perf_counter()
+            gdb.updateshares(bulk=not args.nobulk)
+            updatetime = time.perf_counter() - starttime
+            print(f"updateshares run {run+1}: {len(issuerIDs)} shares in "
+                  f"{updatetime:.3f}s "
+                  f"({len(issuerIDs)/updatetime:.1f} shares/s)")
+    finally:
+        # Remove benchmark data
+        with gdb.sessionmanager() as session:
+            for model in (SharePrice, SharePriceRollup):
+                session.query(model).filter(
+                    model.issuerID.in_(issuerIDs)).delete(
+                    synchronize_session=False)
+            session.query(Share).filter(
+                Share.issuerID.in_(issuerIDs)).delete(
+                synchronize_session=False)
+        server.shutdown()
+
+
+def measure(function, *args, **kwargs):
+    """
+    Calls a function, measuring how long it takes and the peak memory
+    allocated while it runs.
+
+    Args:
+        function: Function to call.
+        Remaining arguments are passed to the function.
+    Returns:
+        Result of the function.
+        Seconds taken.
+        Peak bytes allocated.
+
+    """
+    tracemalloc.start()
+    starttime = time.perf_counter()
+    result = function(*args, **kwargs)
+    timetaken = time.perf_counter() - starttime
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, timetaken, peak
+
+
+def benchmarksharepricehistory(args):
+    """
+    Compares reading share price history as SharePrice objects with
+    getsharepricehistory against plain arrays with getsharepriceseries.
+
+    """
+    gdb = DatabaseAPI(Config)
+    gdb.createtables()
+    issuerID = syntheticissuerIDs(1)[0]
+    try:
+        # Add share with a share price every minute
+        with gdb.sessionmanager() as session:
+            session.add(Share(
+                issuerID=issuerID, fullname=issuerID, shortname=issuerID,
+                abbrevname=issuerID, description=issuerID, currentprice=1,
+                marketcapitalisation=1, sharecount=1, daychangepercent=0,
+                daychangeprice=0, daypricehigh=1, daypricelow=1, dayvolume=1))
+            session.commit()
+            starttime = datetime(2019, 1, 1)
+            session.bulk_insert_mappings(SharePrice, [{
+                "issuerID": issuerID,
+                "time": starttime + timedelta(minutes=i),
+                "price": float(i % 1000)} for i in range(args.points)])
+        # Read history both ways
+        shareprices, ormtime, ormpeak = measure(
+            gdb.getsharepricehistory, issuerID)
+        (times, prices), seriestime, seriespeak = measure(
+            gdb.getsharepriceseries, issuerID)
+        for name, count, timetaken, peak in (
+                ("getsharepricehistory", len(shareprices), ormtime, ormpeak),
+                ("getsharepriceseries", len(times), seriestime, seriespeak)):
+            print(f"{name}: {count} points in {timetaken:.3f}s, "
+                  f"peak {peak/2**20:.1f} MiB ({peak/count:.0f} bytes/point)")
+    finally:
+        # Remove benchmark data
+        with gdb.sessionmanager() as session:
+            for model in (SharePrice, SharePriceRollup):
+                session.query(model).filter(
+                    model.issuerID == issuerID).delete()
+            session.query(Share).filter(Share.issuerID == issuerID).delete()
+
+
+def benchmarktrades(args):
+    """
+    Measures trade throughput of buyshare and sellshare from concurrent
+    threads, then checks that no balance or holding updates were lost.
+
+    """
+    gdb = DatabaseAPI(Config)
+    gdb.createtables()
+    issuerIDs = syntheticissuerIDs(args.shares)
+    # Use user IDs well clear of real users
+    userIDs = list(range(10**9, 10**9 + args.users))
+    balance = 10**9
+    try:
+        # Add users and shares, with every user holding every share
+        with gdb.sessionmanager() as session:
+            session.bulk_insert_mappings(Share, [{
+                "issuerID": issuerID, "fullname": issuerID,
+                "shortname": issuerID, "abbrevname": issuerID,
+                "description": issuerID, "currentprice": 10,
+                "marketcapitalisation": 1, "sharecount": 1,
+                "daychangepercent": 0, "daychangeprice": 0,
+                "daypricehigh": 10, "daypricelow": 10, "dayvolume": 1}
+                for issuerID in issuerIDs])
+            addsyntheticusers(session, userIDs, balance)
+            session.commit()
+            session.bulk_insert_mappings(Usershare, [{
+                "userID": userID, "issuerID": issuerID, "profit": 0,
+                "loss": 0, "quantity": 10**6}
+                for userID in userIDs for issuerID in issuerIDs])
+        # Trade from every thread against randomly chosen users and shares
+        failures = list()
+
+        def trade(seed):
+            generator = random.Random(seed)
+            for i in range(args.trades):
+                userID = generator.choice(userIDs)
+                issuerID = generator.choice(issuerIDs)
+                if generator.random() < 0.5:
+                    succeeded = gdb.buyshare(userID, issuerID, 1)
+                else:
+                    succeeded = gdb.sellshare(userID, issuerID, 1)
+                if not succeeded:
+                    failures.append((userID, issuerID))
+        threads = [threading.Thread(target=trade, args=(seed,))
+                   for seed in range(args.threads)]
+        starttime = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        tradetime = time.perf_counter() - starttime
+        trades = args.threads * args.trades
+        print(f"trades: {trades} trades by {args.threads} threads on "
+              f"{len(userIDs)} users in {tradetime:.3f}s "
+              f"({trades/tradetime:.1f} trades/s, "
+              f"{len(failures)} failed)")
+        # Check balances match the transactions recorded for each user
+        with gdb.sessionmanager() as session:
+            totals = dict(session.query(
+                Transaction.userID,
+                func.sum(case([(Transaction.transtype == 'S', 1)],
+                              else_=-1) * Transaction.totaltransval)).filter(
+                Transaction.userID.in_(userIDs)).group_by(
+                Transaction.userID).all())
+            balances = dict(session.query(User.userID, User.balance).filter(
+                User.userID.in_(userIDs)).all())
+        inconsistent = [userID for userID in userIDs if abs(
+            balances[userID] - balance - (totals.get(userID) or 0)) > 0.01]
+        print(f"consistency: {len(inconsistent)} of {len(userIDs)} users "
+              f"with balances not matching their transactions")
+    finally:
+        # Remove benchmark data
+        with gdb.sessionmanager() as session:
+            for model in (Transaction, Usershare, Ranking, User):
+                session.query(model).filter(
+                    model.userID.in_(userIDs)).delete(
+                    synchronize_session=False)
+            session.query(Share).filter(
+                Share.issuerID.in_(issuerIDs)).delete(
+                synchronize_session=False)
+
+
+def benchmarktopgainers(args):
+    """
+    Measures how gettopgainers latency changes with the number of users,
+    with a day of hourly leaderboard snapshots for every user in both the
+    week and month periods.
+
+    """
+    gdb = DatabaseAPI(Config)
+    gdb.createtables()
+    for usercount in args.users:
+        # Use user IDs well clear of real users
+        userIDs = list(range(10**9, 10**9 + usercount))
+        try:
+            # Add users with rankings and snapshots
+            now = datetime.utcnow()
+            with gdb.sessionmanager() as session:
+                addsyntheticusers(session, userIDs, 10**6)
+                session.commit()
+                gdb.refreshrankings(session, userIDs)
+                for days in (7, 30):
+                    for hour in range(args.snapshots):
+                        recordtime = now - timedelta(days=days, hours=hour)
+                        session.bulk_insert_mappings(Leaderboard, [{
+                            "userID": userID, "recordtime": recordtime,
+                            "ranking": 0, "totalvalue": userID % 10**6}
+                            for userID in userIDs])
+            # Get top gainers several times, keeping the fastest
+            timings = list()
+            for run in range(args.runs):
+                starttime = time.perf_counter()
+                gdb.gettopgainers()
+                timings.append(time.perf_counter() - starttime)
+            print(f"gettopgainers: {usercount} users, "
+                  f"{usercount * args.snapshots * 2} snapshots in "
+                  f"{min(timings)*1000:.1f}ms")
+        finally:
+            # Remove benchmark data
+            with gdb.sessionmanager() as session:
+                for model in (Leaderboard, Ranking, User):
+                    session.query(model).filter(
+                        model.userID.in_(userIDs)).delete(
+                        synchronize_session=False)
+
+
+def benchmarkupdateleaderboard(args):
+    """
+    Measures how long updateleaderboard takes to snapshot every user.
+
+    """
+    gdb = DatabaseAPI(Config)
+    gdb.createtables()
+    # Use user IDs well clear of real users
+    userIDs = list(range(10**9, 10**9 + args.users))
+    try:
+        # Add users with rankings
+        with gdb.sessionmanager() as session:
+            addsyntheticusers(session, userIDs, 10**6)
+            session.commit()
+            gdb.refreshrankings(session, userIDs)
+        # Snapshot leaderboard several times
+        for run in range(args.runs):
+            starttime = time.perf_counter()
+            rows = gdb.updateleaderboard()
+            updatetime = time.perf_counter() - starttime
+            print(f"updateleaderboard run {run+1}: {rows} snapshots in "
+                  f"{updatetime:.3f}s")
+    finally:
+        # Remove benchmark data
+        with gdb.sessionmanager() as session:
+            for model in (Leaderboard, Ranking, User):
+                session.query(model).filter(
+                    model.userID.in_(userIDs)).delete(
+                    synchronize_session=False)
+
+
+def ormusersharesinfo(gdb, userID):
+    """
+    Gets a user's shares the way getusersharesinfo did before it selected
+    only the columns it needs, by loading full Usershare and Share objects
+    and merging their attributes, for comparison.
+
+    Args:
+        gdb: Database API.
+        userID (int): ID of user.
+    Returns:
+        List of merged usershare and share attribute dicts.
+
+    """
+    with gdb.sessionmanager() as session:
+        results = session.query(Usershare, Share).join(Share).filter(
+            Usershare.userID == userID).order_by(Usershare.issuerID).all()
+        for result in results:
+            for obj in result:
+                session.expunge(obj)
+    usershares = list()
+    for usershare, share in results:
+        usershare.__dict__.pop('_sa_instance_state', None)
+        share.__dict__.pop('_sa_instance_state', None)
+        usershares.append({**usershare.__dict__, **share.__dict__})
+    return usershares
+
+
+def benchmarkusersharesinfo(args):
+    """
+    Compares getting a user's portfolio by loading full Usershare and Share
+    objects against getusersharesinfo selecting only the columns shown.
+
+    """
+    gdb = DatabaseAPI(Config)
+    gdb.createtables()
+    issuerIDs = syntheticissuerIDs(args.shares)
+    # Use user ID well clear of real users
+    userID = 10**9
+    try:
+        # Add shares with full descriptions and a user holding each share
+        with gdb.sessionmanager() as session:
+            session.bulk_insert_mappings(Share, [{
+                "issuerID": issuerID, "fullname": issuerID * 20,
+                "shortname": issuerID, "abbrevname": issuerID,
+                "description": "x" * 500, "industrysector": "Benchmarks",
+                "currentprice": 1, "marketcapitalisation": 1,
+                "sharecount": 1, "daychangepercent": 0, "daychangeprice": 0,
+                "daypricehigh": 1, "daypricelow": 1, "dayvolume": 1}
+                for issuerID in issuerIDs])
+            addsyntheticusers(session, [userID], 10**6)
+            session.commit()
+            session.bulk_insert_mappings(Usershare, [{
+                "userID": userID, "issuerID": issuerID, "profit": 10,
+                "loss": 5, "quantity": 100, "totalcost": 100,
+                "quantityacquired": 100} for issuerID in issuerIDs])
+        # Get portfolio both ways several times, keeping the fastest
+        for name, function in (
+                ("orm objects",
+                 lambda: ormusersharesinfo(gdb, userID)),
+                ("getusersharesinfo",
+                 lambda: gdb.getusersharesinfo(userID, limit=args.shares)[0])):
+            timings, peaks = list(), list()
+            for run in range(args.runs):
+                result, timetaken, peak = measure(function)
+                timings.append(timetaken)
+                peaks.append(peak)
+            print(f"{name}: {len(result)} rows in {min(timings)*1000:.1f}ms "
+                  f"({min(timings)*10**6/len(result):.1f}us/row), "
+                  f"peak {min(peaks)/2**10:.0f} KiB "
+                  f"({min(peaks)/len(result):.0f} bytes/row)")
+    finally:
+        # Remove benchmark data
+        with gdb.sessionmanager() as session:
+            session.query(Usershare).filter(
+                Usershare.userID == userID).delete(synchronize_session=False)
+            session.query(User).filter(
+                User.userID == userID).delete(synchronize_session=False)
+            session.query(Share).filter(
+                Share.issuerID.in_(issuerIDs)).delete(
+                synchronize_session=False)
+
+
+# Run benchmarks by running module directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Database API benchmarks.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    # Share ingestion benchmark
+    subparser = subparsers.add_parser(
+        "updateshares", help="Share ingestion throughput.")
+    subparser.add_argument("--shares", type=int, default=300)
+    subparser.add_argument("--runs", type=int, default=3)
+    subparser.add_argument("--workers", type=int,
+                           default=Config.ASX_FETCH_WORKERS)
+    subparser.add_argument("--latency", type=float, default=0.05)
+    subparser.add_argument("--jitter", type=float, default=0.05)
+    subparser.add_argument("--errorrate", type=float, default=0.0)
+    subparser.add_argument("--fixturedir", default=asx_replay.FIXTURE_DIR)
+    subparser.add_argument("--nobulk", action="store_true")
+    subparser.set_defaults(run=benchmarkupdateshares)
+    # Share price history read benchmark
+    subparser = subparsers.add_parser(
+        "sharepricehistory", help="Share price history read paths.")
+    subparser.add_argument("--points", type=int, default=200000)
+    subparser.set_defaults(run=benchmarksharepricehistory)
+    # Concurrent trade benchmark
+    subparser = subparsers.add_parser(
+        "trades", help="Concurrent trade throughput and consistency.")
+    subparser.add_argument("--users", type=int, default=4)
+    subparser.add_argument("--shares", type=int, default=4)
+    subparser.add_argument("--threads", type=int, default=8)
+    subparser.add_argument("--trades", type=int, default=50)
+    subparser.set_defaults(run=benchmarktrades)
+    # Top gainers scaling benchmark
+    subparser = subparsers.add_parser(
+        "topgainers", help="Top gainers latency by number of users.")
+    subparser.add_argument("--users", type=int, nargs="+",
+                           default=[1000, 4000, 16000])
+    subparser.add_argument("--snapshots", type=int, default=24)
+    subparser.add_argument("--runs", type=int, default=5)
+    subparser.set_defaults(run=benchmarktopgainers)
+    # Leaderboard snapshot benchmark
+    subparser = subparsers.add_parser(
+        "updateleaderboard", help="Leaderboard snapshot time.")
+    subparser.add_argument("--users", type=int, default=100000)
+    subparser.add_argument("--runs", type=int, default=3)
+    subparser.set_defaults(run=benchmarkupdateleaderboard)
+    # Portfolio read benchmark
+    subparser = subparsers.add_parser(
+        "usersharesinfo", help="Portfolio read paths.")
+    subparser.add_argument("--shares", type=int, default=500)
+    subparser.add_argument("--runs", type=int, default=5)
+    subparser.set_defaults(run=benchmarkusersharesinfo)
+    # Run chosen benchmark
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,178 @@
+"""
+Small in-process caches for values that are expensive to calculate and
+fine to serve slightly out of date.
+
+"""
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Thread safe cache of values that expire a fixed number of seconds after
+    being set.
+
+    """
+    def __init__(self, ttl):
+        """
+        Initialise cache.
+
+        Args:
+            ttl (float): Seconds values are kept for. 0 disables caching.
+
+        """
+        self.ttl = ttl
+        # Expiry time and value of each key
+        self.entries = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Gets a cached value.
+
+        Args:
+            key: Key of value.
+        Returns:
+            The value, or None if not cached or expired.
+
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.entries.pop(key, None)
+                return None
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Caches a value.
+
+        Args:
+            key: Key of value.
+            value: Value to cache.
+
+        """
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+
+    def discard(self, match):
+        """
+        Removes every cached value whose key matches.
+
+        Args:
+            match (function): Returns whether a key matches.
+
+        """
+        with self.lock:
+            for key in [key for key in self.entries if match(key)]:
+                del self.entries[key]
+
+    def clear(self):
+        """
+        Removes every cached value.
+
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+class SnapshotCache:
+    """
+    Thread safe cache of a snapshot of a whole table, tagged with the
+    version stamp the table had in the database when it was read. The
+    snapshot is served without checking the version stamp again for a fixed
+    number of seconds, and is replaced whole, so readers never see a mix of
+    old and new rows.
+
+    """
+    def __init__(self, checkinterval):
+        """
+        Initialise cache.
+
+        Args:
+            checkinterval (float): Seconds the snapshot is served for before
+                the version stamp is checked again. 0 checks on every read.
+
+        """
+        self.checkinterval = checkinterval
+        self.snapshot = None
+        self.version = None
+        # Time version stamp was last checked
+        self.checkedtime = None
+        # Number of invalidations, so snapshots read before an
+        # invalidation are not stored after it
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Gets the snapshot if its version stamp was checked recently.
+
+        Returns:
+            The snapshot, or None if it must be checked or read.
+
+        """
+        with self.lock:
+            if(self.snapshot is None or self.checkedtime is None or
+               time.monotonic() - self.checkedtime >= self.checkinterval):
+                return None
+            return self.snapshot
+
+    def validate(self, version):
+        """
+        Gets the snapshot if it has the current version stamp, resetting the
+        time until it is checked again.
+
+        Args:
+            version: Current version stamp of the table.
+        Returns:
+            The snapshot, or None if it must be read again.
+
+        """
+        with self.lock:
+            if self.snapshot is None or self.version != version:
+                return None
+            self.checkedtime = time.monotonic()
+            return self.snapshot
+
+    def replace(self, version, snapshot, generation):
+        """
+        Replaces the snapshot, unless it was invalidated since the new
+        snapshot started being read.
+
+        Args:
+            version: Version stamp of the table when read.
+            snapshot: The new snapshot.
+            generation (int): Generation of the cache when the version stamp
+                was read.
+        Returns:
+            bool: True if the snapshot was replaced.
+
+        """
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.snapshot = snapshot
+            self.version = version
+            self.checkedtime = time.monotonic()
+            return True
+
+    def invalidate(self):
+        """
+        Removes the snapshot, such as after this process changes the table.
+
+        """
+        with self.lock:
+            self.generation += 1
+            self.snapshot = None
+            self.version = None
+            self.checkedtime = None
+
+    def clear(self):
+        """
+        Removes the snapshot.
+
+        """
+        self.invalidate()
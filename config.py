@@ -14,3 +14,26 @@ class Config(object):
     DB_PORT = os.getenv('DB_PORT') or '3306'
     DB_DATABASE = os.getenv('DB_DATABASE') or 'Database'
     DB_QUERY = os.getenv('DB_QUERY') or ""
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE') or 5)
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW') or 10)
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT') or 30)
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE') or 1800)
+    DB_POOL_PRE_PING = (os.getenv('DB_POOL_PRE_PING') or 'idle').lower()
+    DB_POOL_PING_IDLE_SECONDS = float(
+        os.getenv('DB_POOL_PING_IDLE_SECONDS') or 30)
+    DB_REQUEST_SESSIONS = (
+        (os.getenv('DB_REQUEST_SESSIONS') or 'false').lower() == 'true')
+    ASX_BASE_URL = os.getenv('ASX_BASE_URL') or 'https://www.asx.com.au'
+    ASX_FETCH_WORKERS = int(os.getenv('ASX_FETCH_WORKERS') or 8)
+    ASX_FETCH_TIMEOUT = float(os.getenv('ASX_FETCH_TIMEOUT') or 10)
+    ORDER_BATCH_SIZE = int(os.getenv('ORDER_BATCH_SIZE') or 100)
+    ORDER_LOAD_OVERLAP_SECONDS = float(
+        os.getenv('ORDER_LOAD_OVERLAP_SECONDS') or 300)
+    LEADERBOARD_HOURLY_DAYS = int(os.getenv('LEADERBOARD_HOURLY_DAYS') or 2)
+    LEADERBOARD_COMPACT_BATCH_SIZE = int(
+        os.getenv('LEADERBOARD_COMPACT_BATCH_SIZE') or 10000)
+    STATISTICS_CACHE_SECONDS = float(
+        os.getenv('STATISTICS_CACHE_SECONDS') or 60)
+    COUNT_CACHE_SECONDS = float(os.getenv('COUNT_CACHE_SECONDS') or 300)
+    SHARE_CACHE_CHECK_SECONDS = float(
+        os.getenv('SHARE_CACHE_CHECK_SECONDS') or 5)
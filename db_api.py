@@ -1,20 +1,44 @@
-from models import (User, Share, SharePrice, Usershare, Transaction, Admin,
-                    Leaderboard, Tips, Base)
-from sqlalchemy import create_engine, asc, desc
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import OperationalError
+from models import (User, Share, SharePrice, SharePriceRollup, Usershare,
+                    Transaction, PendingOrder, Admin, Leaderboard, Ranking,
+                    Tips, SchemaVersion, CacheVersion, Base)
+from orderbook import OrderBook
+from cache import TTLCache, SnapshotCache
+from db_metrics import MeasuredQueuePool, PoolMetrics, QueryMetrics
+import migrations
+from sqlalchemy import (create_engine, event, inspect, asc, desc, select,
+                        tuple_, and_, or_, case, literal, DateTime)
+from sqlalchemy.orm import sessionmaker, aliased
+from sqlalchemy.exc import OperationalError, DisconnectionError
 from sqlalchemy.sql import func
+from sqlalchemy.sql.util import find_tables
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
+from collections import namedtuple
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import base64
 import json
+import logging
 import requests
 from datetime import datetime, date, timedelta
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, timedelta
 import math
+import numpy as np
 import operator
 import random
+import threading
+import time
+import zlib
+
+
+# Logger for reporting on background tasks
+logger = logging.getLogger(__name__)
+
+# Immutable row of every share column, as served from the share cache
+ShareRow = namedtuple('ShareRow',
+                      [column.name for column in Share.__table__.columns])
 
 
 class DatabaseAPI:
@@ -38,23 +62,104 @@ class DatabaseAPI:
         port = config_class.DB_PORT
         database = config_class.DB_DATABASE
         query = config_class.DB_QUERY
-        # Create engine with pool pre pinging
+        # Get connection pool parameters
+        self.poolprepping = config_class.DB_POOL_PRE_PING
+        self.poolpingidle = config_class.DB_POOL_PING_IDLE_SECONDS
+        # Create engine with configured connection pool
         self.engine = create_engine(
             (f"{drivername}://"
              f"{username}:{password}@"
              f"{host}:{port}/"
              f"{database}{query}"),
-            pool_pre_ping=True
+            poolclass=MeasuredQueuePool,
+            pool_size=config_class.DB_POOL_SIZE,
+            max_overflow=config_class.DB_MAX_OVERFLOW,
+            pool_timeout=config_class.DB_POOL_TIMEOUT,
+            pool_recycle=config_class.DB_POOL_RECYCLE,
+            pool_pre_ping=(self.poolprepping == 'always')
         )
+        # Ping connections that have been idle before they are used
+        if self.poolprepping == 'idle':
+            event.listen(self.engine, 'checkout', self.pingidleconnection)
+            event.listen(self.engine, 'checkin', self.marklastused)
+        # Count connection pool activity
+        self.poolmetrics = PoolMetrics()
+        self.poolmetrics.attach(self.engine)
+        # Count and time queries run by each web request
+        self.querymetrics = QueryMetrics()
+        self.querymetrics.attach(self.engine)
         # Define session maker
         self.Session = sessionmaker(bind=self.engine)
+        # Get ASX fetching parameters
+        self.asxurl = config_class.ASX_BASE_URL.rstrip('/')
+        self.fetchworkers = config_class.ASX_FETCH_WORKERS
+        self.fetchtimeout = config_class.ASX_FETCH_TIMEOUT
+        # Create HTTP session so connections to ASX are kept alive and
+        # reused, pooling enough connections for every fetch worker
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.fetchworkers)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        # Create index of resting limit and stop orders, loaded from the
+        # database when first used
+        self.orderbook = OrderBook()
+        self.orderbatchsize = config_class.ORDER_BATCH_SIZE
+        self.orderloadoverlap = config_class.ORDER_LOAD_OVERLAP_SECONDS
+        # Remove orders executed within request sessions from the index
+        # only once the request is committed
+        event.listen(self.Session, 'after_commit', self.removeexecutedorders)
+        event.listen(self.Session, 'after_rollback', self.keepexecutedorders)
+        # Get leaderboard history retention parameters
+        self.leaderboardhourlydays = config_class.LEADERBOARD_HOURLY_DAYS
+        self.leaderboardbatchsize = config_class.LEADERBOARD_COMPACT_BATCH_SIZE
+        # Create cache for statistics that are expensive to calculate
+        self.statisticscache = TTLCache(config_class.STATISTICS_CACHE_SECONDS)
+        # Create cache of list result counts, discarding the counts of
+        # tables that rows are added to or deleted from
+        self.countcache = TTLCache(config_class.COUNT_CACHE_SECONDS)
+        event.listen(self.Session, 'after_flush', self.invalidatecounts)
+        event.listen(self.Session, 'after_bulk_delete',
+                     self.invalidatebulkdelete)
+        # Create cache of every share, reloaded when this process changes
+        # shares or the share version stamp is changed by another process
+        self.sharecache = SnapshotCache(config_class.SHARE_CACHE_CHECK_SECONDS)
+        event.listen(self.Session, 'after_flush', self.watchshares)
+        event.listen(self.Session, 'after_transaction_end',
+                     self.endsharetransaction)
+        # Request session of each thread, joined by sessionmanager if present
+        self.requestscope = threading.local()
 
     @contextmanager
-    def sessionmanager(self):
+    def sessionmanager(self, join=True):
         """
         Context manager for handling sessions.
+        If this thread has a request session, it is joined instead of
+        creating a new session, and the caller runs inside a savepoint of the
+        request transaction so its changes are still discarded on error or
+        rollback.
+
+        Args:
+            join (bool): Whether to join the request session, if any. Work
+                done in batches should not join it, so that each batch is
+                committed, and its locks released, as soon as it is done.
+                Defaults to True.
 
         """
+        # Join request session if one is active
+        requestsession = getattr(self.requestscope, 'session', None)
+        if join and requestsession is not None:
+            savepoint = requestsession.begin_nested()
+            try:
+                yield requestsession
+                # Release savepoint unless already committed or rolled back
+                if savepoint.is_active:
+                    savepoint.commit()
+            except BaseException:
+                # Roll back savepoint on any exception, including interrupts
+                if savepoint.is_active:
+                    savepoint.rollback()
+                raise
+            return
         # Create session
         session = self.Session()
         # Handle session activities
@@ -67,14 +172,204 @@ class DatabaseAPI:
         finally:
             session.close()
 
+    def marklastused(self, dbapi_connection, connection_record):
+        """
+        Pool checkin listener that records when a connection was last used.
+
+        """
+        connection_record.info['lastused'] = time.monotonic()
+
+    def pingidleconnection(self, dbapi_connection, connection_record,
+                           connection_proxy):
+        """
+        Pool checkout listener that pings connections that have been idle
+        for longer than DB_POOL_PING_IDLE_SECONDS, so that only connections
+        likely to have been closed by the server pay for a round trip.
+        A connection that fails the ping is replaced by the pool.
+
+        """
+        # Skip new and recently used connections
+        lastused = connection_record.info.get('lastused')
+        if(lastused is None or
+           time.monotonic() - lastused < self.poolpingidle):
+            return
+        # Ping connection, having the pool reconnect if it fails
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except Exception as e:
+            logger.warning("Replacing idle connection that failed ping: %s",
+                           e)
+            raise DisconnectionError()
+
+    def beginrequestsession(self):
+        """
+        Starts a request session for this thread, which every method called
+        from this thread joins until endrequestsession is called. A request
+        then checks out one connection and runs one transaction.
+
+        """
+        # Discard any request session left over from a previous request
+        self.endrequestsession(commit=False)
+        # Create session, which checks out a connection on first use
+        self.requestscope.session = self.Session()
+
+    def endrequestsession(self, commit=True):
+        """
+        Ends the request session of this thread if one is active.
+
+        Args:
+            commit (bool): Whether to commit the request transaction rather
+                than roll it back. Defaults to True.
+
+        """
+        # Get and clear request session
+        session = getattr(self.requestscope, 'session', None)
+        if session is None:
+            return
+        self.requestscope.session = None
+        # Commit or roll back request transaction
+        try:
+            if commit:
+                session.commit()
+            else:
+                session.rollback()
+        except BaseException:
+            # Roll back on any exception, including interrupts
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    @contextmanager
+    def requestsession(self):
+        """
+        Context manager for running a request session outside of a web
+        request, committing on success and rolling back on error.
+
+        """
+        self.beginrequestsession()
+        try:
+            yield
+        except BaseException:
+            # Roll back on any exception, including interrupts
+            self.endrequestsession(commit=False)
+            raise
+        self.endrequestsession()
+
     def createtables(self):
         """
         Create all the tables defined in models, if not already present
         in connected database.
 
         """
+        # Get tables present beforehand, to tell new databases apart from
+        # databases created by older versions
+        existing = inspect(self.engine).get_table_names()
         # Create all tables from models base metadata
         Base.metadata.create_all(self.engine)
+        # Record new databases as up to date, otherwise apply migrations
+        self.migrate(stamp=(User.__tablename__ not in existing))
+
+    def migrate(self, stamp=False):
+        """
+        Applies the schema migrations defined in migrations.py that have not
+        been applied to the database, in order, recording each one applied.
+        On MySQL, migrations are applied while holding a named lock, so that
+        instances starting at the same time do not apply them twice.
+
+        Args:
+            stamp (bool): Record migrations as applied without running them,
+                for databases just created from the models.
+                Defaults to False.
+        Returns:
+            List of versions of migrations applied.
+
+        """
+        mysql = (self.engine.dialect.name == 'mysql')
+        with self.engine.connect() as lockconnection:
+            # Wait for other instances to finish migrating
+            if(mysql and not lockconnection.execute(
+                    "SELECT GET_LOCK('schemamigrations', 600)").scalar()):
+                raise RuntimeError("Timed out waiting for migration lock")
+            try:
+                # Get versions already applied
+                with self.sessionmanager() as session:
+                    applied = {version for (version,) in
+                               session.query(SchemaVersion.version)}
+                # Apply and record each missing migration
+                versions = list()
+                for version, description, function in migrations.MIGRATIONS:
+                    if version in applied:
+                        continue
+                    if not stamp:
+                        logger.info("Applying schema migration %d: %s",
+                                    version, description)
+                        function(self)
+                    with self.sessionmanager() as session:
+                        session.add(SchemaVersion(
+                            version=version, description=description,
+                            appliedtime=datetime.utcnow()))
+                    versions.append(version)
+            finally:
+                if mysql:
+                    lockconnection.execute(
+                        "SELECT RELEASE_LOCK('schemamigrations')")
+        return versions
+
+    def migratecostbasis(self):
+        """
+        Adds the purchase total columns to the usershare table if it was
+        created before they existed, then fills them in from past purchase
+        transactions. Does nothing if the columns are already present.
+
+        Returns:
+            bool: True if the columns were added and filled in.
+
+        """
+        # Check which usershare columns are already present
+        columns = [column['name'] for column in
+                   inspect(self.engine).get_columns('USERSHARE')]
+        if 'totalcost' in columns and 'quantityacquired' in columns:
+            return False
+        # Add missing columns, defaulting to 0
+        with self.engine.begin() as connection:
+            if 'totalcost' not in columns:
+                connection.execute(
+                    "ALTER TABLE USERSHARE ADD COLUMN totalcost "
+                    "DECIMAL(20, 2) NOT NULL DEFAULT 0")
+            if 'quantityacquired' not in columns:
+                connection.execute(
+                    "ALTER TABLE USERSHARE ADD COLUMN quantityacquired "
+                    "BIGINT NOT NULL DEFAULT 0")
+        # Fill in columns from past purchases
+        self.backfillcostbasis()
+        return True
+
+    def backfillcostbasis(self):
+        """
+        Sets the purchase totals of every usershare to the totals of all of
+        its purchase transactions.
+
+        """
+        # Define purchase transactions of each usershare
+        purchases = [
+            Transaction.userID == Usershare.userID,
+            Transaction.issuerID == Usershare.issuerID,
+            Transaction.transtype == 'B'
+        ]
+        # Initialse session
+        with self.sessionmanager() as session:
+            # Update every usershare from totals of its purchases
+            session.execute(Usershare.__table__.update().values(
+                totalcost=select([
+                    func.coalesce(func.sum(Transaction.totaltransval), 0)
+                ]).where(and_(*purchases)).as_scalar(),
+                quantityacquired=select([
+                    func.coalesce(func.sum(Transaction.quantity), 0)
+                ]).where(and_(*purchases)).as_scalar()
+            ))
 
     def deletetables(self):
         """
@@ -87,7 +382,495 @@ class DatabaseAPI:
         # Create all tables from models base metadata
         Base.metadata.drop_all(self.engine)
 
-    def getusers(self, orderby=None, order="asc", offset=0, limit=1000):
+    def countquery(self, session, query, strategy="exact"):
+        """
+        Counts the results of a query using a count strategy.
+        The caller should pass the active session.
+
+        Args:
+            session: The active session.
+            query: Query to count results of, without ordering or limits.
+            strategy (str): How to count results. Defaults to "exact".
+                - 'exact' counts every result.
+                - 'cached' counts every result, reusing the count for
+                  COUNT_CACHE_SECONDS or until this process adds or deletes
+                  rows of a queried table. Rows added or deleted by other
+                  processes are not counted until the count expires.
+                - 'estimate' uses table statistics for queries of a single
+                  table without filters, otherwise a cached count.
+                - 'none' does not count, leaving the page cursors to show
+                  whether there are further pages.
+        Returns:
+            The number of results, or None if not counted.
+        Raises:
+            ValueError: If the strategy is unknown.
+
+        """
+        if(strategy not in ('exact', 'cached', 'estimate', 'none')):
+            raise ValueError(f"Unknown count strategy {strategy}")
+        if(strategy == 'none'):
+            return None
+        # Get tables queried, whose changes invalidate cached counts
+        tables = frozenset(table.name
+                           for table in find_tables(query.statement))
+        # Estimate count of single tables from table statistics
+        if(strategy == 'estimate' and len(tables) == 1 and
+           query.whereclause is None):
+            estimate = self.estimatecount(session, next(iter(tables)))
+            if estimate is not None:
+                return estimate
+        if(strategy == 'exact'):
+            return query.count()
+        # Get cached count, counting if not cached
+        compiled = query.statement.compile()
+        key = (tables, str(compiled), tuple(sorted(
+            (name, str(value)) for name, value in compiled.params.items())))
+        count = self.countcache.get(key)
+        if count is None:
+            count = query.count()
+            self.countcache.set(key, count)
+        return count
+
+    def estimatecount(self, session, tablename):
+        """
+        Estimates the number of rows in a table from table statistics, which
+        are kept by MySQL and may be out by a small proportion.
+        The caller should pass the active session.
+
+        Args:
+            session: The active session.
+            tablename (str): Name of table.
+        Returns:
+            The estimated number of rows, or None if the database has no
+            table statistics.
+
+        """
+        # Only MySQL table statistics are supported
+        if(session.get_bind().dialect.name != 'mysql'):
+            return None
+        return session.execute(
+            "SELECT TABLE_ROWS FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :tablename",
+            {'tablename': tablename}).scalar()
+
+    def discardcounts(self, *tables):
+        """
+        Discards the cached counts of queries of tables that rows were added
+        to or deleted from. Called for rows added or deleted with bulk or
+        Core statements, which flush listeners do not see.
+
+        Args:
+            tables: Models or names of tables.
+
+        """
+        tables = {getattr(table, '__tablename__', table) for table in tables}
+        if tables:
+            self.countcache.discard(lambda key: not key[0].isdisjoint(tables))
+
+    def invalidatecounts(self, session, flushcontext):
+        """
+        Session after flush listener that discards the cached counts of
+        tables that rows were added to or deleted from.
+
+        """
+        # Discard counts of queries of tables of added and deleted rows
+        self.discardcounts(*{obj.__table__.name for obj in
+                             list(session.new) + list(session.deleted)})
+
+    def invalidatebulkdelete(self, delete_context):
+        """
+        Session after bulk delete listener that discards the cached counts
+        of tables that rows were deleted from by Query.delete.
+
+        """
+        self.discardcounts(*[table.name for table in find_tables(
+            delete_context.query.statement)])
+
+    def stampshares(self, session):
+        """
+        Changes the version stamp of the share table in the transaction of
+        the session, so every process reloads its share cache once the
+        transaction is committed. Called for every change to shares.
+        The caller should pass the active session.
+
+        Args:
+            session: The active session.
+
+        """
+        # Increment version stamp, adding it if shares were never stamped
+        table = CacheVersion.__table__
+        now = datetime.utcnow()
+        updated = session.execute(table.update().where(
+            table.c.name == Share.__tablename__).values(
+            version=table.c.version + 1, updatedtime=now)).rowcount
+        if not updated:
+            session.execute(table.insert().values(
+                name=Share.__tablename__, version=1, updatedtime=now))
+        # Reload share cache of this process once the transaction ends
+        session.info['sharesstamped'] = True
+
+    def watchshares(self, session, flushcontext):
+        """
+        Session after flush listener that changes the share version stamp
+        when shares were added, changed or deleted.
+
+        """
+        if any(isinstance(obj, Share) for obj in
+               list(session.new) + list(session.dirty) +
+               list(session.deleted)):
+            self.stampshares(session)
+
+    def endsharetransaction(self, session, transaction):
+        """
+        Session after transaction end listener that discards the share
+        cache once a transaction that changed shares is committed or rolled
+        back.
+
+        """
+        if(transaction.parent is None and
+           session.info.pop('sharesstamped', False)):
+            self.sharecache.invalidate()
+
+    def getsharecache(self):
+        """
+        Gets every share from the share cache, which is read from the
+        database when this process changes shares, and otherwise served
+        for SHARE_CACHE_CHECK_SECONDS between checks of the share version
+        stamp for changes made by other processes.
+
+        Returns:
+            A dictionary of every share as a ShareRow keyed by issuer ID,
+            shared by every caller so must not be changed.
+
+        """
+        # Get shares if version stamp was checked recently
+        shares = self.sharecache.get()
+        if shares is not None:
+            return shares
+        generation = self.sharecache.generation
+        # Initialse session
+        with self.sessionmanager() as session:
+            # Get shares if version stamp is unchanged, reading the stamp
+            # before the shares so that they are at least as new
+            version = session.query(CacheVersion.version).filter(
+                CacheVersion.name == Share.__tablename__).scalar()
+            shares = self.sharecache.validate(version)
+            if shares is not None:
+                return shares
+            # Read every share into immutable share rows, so that callers
+            # cannot change the shares of other callers
+            shares = {row.issuerID: ShareRow(**dict(row)) for row in
+                      session.execute(Share.__table__.select())}
+            # Only cache shares if not changed by this uncommitted session
+            if not session.info.get('sharesstamped'):
+                self.sharecache.replace(version, shares, generation)
+        return shares
+
+    def getsortkeys(self, model, orderby):
+        """
+        Gets the column of a model to sort by, for use with pagequery.
+
+        Args:
+            model: Model class to get column of.
+            orderby (str): Name of column.
+        Returns:
+            A list of one (column, nullable) tuple, or an empty list if the
+            model has no such column.
+
+        """
+        # Only allow sorting by table columns
+        if(orderby and orderby in model.__table__.c):
+            return [(getattr(model, orderby),
+                     model.__table__.c[orderby].nullable)]
+        return list()
+
+    def pagequery(self, query, sortkeys, order="asc", offset=0, limit=1000,
+                  cursor=None, count=None):
+        """
+        Orders and limits a query to a single page of results.
+        Pages are found either by skipping offset rows, or if a cursor is
+        given, by continuing from the row the cursor was created at using a
+        condition on the sort keys (keyset pagination). Keyset pages are
+        found through an index on the sort keys rather than by reading and
+        discarding every skipped row, so deep pages are as fast as the first.
+
+        Args:
+            query: Query to get page of.
+            sortkeys (list): (expression, nullable) tuples of the expressions
+                to sort by, ending with primary key columns so that every row
+                has a unique position.
+            order (str): How to order, 'asc' for acsending,
+                'desc' for descending. Defaults to "asc"
+            offset (int): How many rows to skip of query. Ignored if a cursor
+                is given. Defaults to 0.
+            limit (int): How many rows to return of query.
+                Defaults to 1000.
+            cursor (str): Cursor of page to get, as returned by a previous
+                call with the same query and ordering. Defaults to None.
+            count (int): Number of results of query if counted, so that the
+                last page holds the results left over after every full page,
+                as when numbering pages. Otherwise the last page is a full
+                page. Defaults to None.
+        Returns:
+            List of query results for the page.
+            Dictionary of opaque 'next', 'prev' and 'last' cursors of the
+            page after and before this page and the last page, which are
+            None if there is no such page.
+        Raises:
+            ValueError: If the cursor is invalid or for another ordering.
+
+        """
+        # Identify ordering that cursors are valid for
+        descending = (order == "desc")
+        ordering = zlib.crc32("|".join(
+            [str(key) for key, nullable in sortkeys] + [order]).encode())
+        # Continue from cursor, going backwards for previous pages
+        backwards = False
+        if cursor is not None:
+            direction, values, size = self.decodecursor(cursor, ordering,
+                                                        len(sortkeys))
+            backwards = (direction == 'prev')
+            # Limit last page to the results left over after full pages
+            if size is not None:
+                limit = min(size, limit)
+            if values is not None:
+                query = query.filter(self.keysetafter(
+                    sortkeys, values, descending != backwards))
+        # Order by sort keys, reversed when going backwards
+        query = query.order_by(*[
+            desc(key) if descending != backwards else asc(key)
+            for key, nullable in sortkeys])
+        # Otherwise skip offset rows
+        if cursor is None:
+            query = query.offset(offset)
+        # Get sort key values alongside results to create cursors from
+        width = len(query.column_descriptions)
+        query = query.add_columns(*[
+            key.label(f"sortkey{i}") for i, (key, nullable)
+            in enumerate(sortkeys)])
+        # Get one extra row to find whether there are further rows
+        rows = query.limit(limit + 1).all()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        # Split results from sort key values
+        results = [row[0] if width == 1 else tuple(row[:width])
+                   for row in rows]
+        # Create cursors of neighbouring pages
+        cursors = {'next': None, 'prev': None, 'last': None}
+        if rows:
+            if(more if not backwards else values is not None):
+                cursors['next'] = self.encodecursor(
+                    'next', list(rows[-1][width:]), ordering)
+                cursors['last'] = self.encodecursor(
+                    'prev', None, ordering, self.lastpagesize(count, limit))
+            if(more if backwards else (cursor is not None or offset > 0)):
+                cursors['prev'] = self.encodecursor(
+                    'prev', list(rows[0][width:]), ordering)
+        # Return page of results and cursors
+        return results, cursors
+
+    def pagelist(self, items, sortkeys, order="asc", offset=0, limit=1000,
+                 cursor=None, count=None):
+        """
+        Orders and limits a list of model objects or rows to a single page,
+        in the same way as pagequery does for a query, so that cursors are
+        interchangeable between the two.
+
+        Args:
+            items (list): Objects with attributes named after the sort key
+                columns to get page of.
+            sortkeys (list): (column, nullable) tuples of the columns to sort
+                by, ending with primary key columns.
+            order (str): How to order, 'asc' for acsending,
+                'desc' for descending. Defaults to "asc"
+            offset (int): How many objects to skip. Ignored if a cursor is
+                given. Defaults to 0.
+            limit (int): How many objects to return.
+                Defaults to 1000.
+            cursor (str): Cursor of page to get. Defaults to None.
+            count (int): Number of objects if counted, see pagequery.
+                Defaults to None.
+        Returns:
+            List of objects in the page.
+            Dictionary of cursors of neighbouring pages, see pagequery.
+        Raises:
+            ValueError: If the cursor is invalid or for another ordering.
+
+        """
+        def values(item):
+            return [getattr(item, key.key) for key, nullable in sortkeys]
+
+        def position(values):
+            # Position NULL values first when ascending, as in MySQL
+            return tuple((value is not None, value) for value in values)
+
+        # Identify ordering that cursors are valid for
+        descending = (order == "desc")
+        ordering = zlib.crc32("|".join(
+            [str(key) for key, nullable in sortkeys] + [order]).encode())
+        # Order objects by sort keys
+        items = sorted(items, key=lambda item: position(values(item)),
+                       reverse=descending)
+        positions = [position(values(item)) for item in items]
+        # Get page continuing from cursor, going backwards for previous pages
+        backwards = False
+        if cursor is not None:
+            direction, cursorvalues, size = self.decodecursor(
+                cursor, ordering, len(sortkeys))
+            backwards = (direction == 'prev')
+            if cursorvalues is not None:
+                cursorposition = position(cursorvalues)
+            if not backwards:
+                # Skip objects up to and including cursor row
+                start = sum(1 for itemposition in positions
+                            if (itemposition >= cursorposition
+                                if descending else
+                                itemposition <= cursorposition))
+                end = start + limit
+                more = end < len(items)
+            else:
+                # Get objects before cursor row, or up to the end
+                end = len(items) if cursorvalues is None else sum(
+                    1 for itemposition in positions
+                    if (itemposition > cursorposition
+                        if descending else
+                        itemposition < cursorposition))
+                start = max(end - min(size or limit, limit), 0)
+                more = start > 0
+        # Otherwise skip offset objects
+        else:
+            start = offset
+            end = offset + limit
+            more = end < len(items)
+        page = items[start:end]
+        # Create cursors of neighbouring pages
+        cursors = {'next': None, 'prev': None, 'last': None}
+        if page:
+            if(more if not backwards else cursorvalues is not None):
+                cursors['next'] = self.encodecursor(
+                    'next', values(page[-1]), ordering)
+                cursors['last'] = self.encodecursor(
+                    'prev', None, ordering, self.lastpagesize(count, limit))
+            if(more if backwards else (cursor is not None or offset > 0)):
+                cursors['prev'] = self.encodecursor(
+                    'prev', values(page[0]), ordering)
+        # Return page of objects and cursors
+        return page, cursors
+
+    def keysetafter(self, sortkeys, values, descending):
+        """
+        Creates a condition selecting the rows positioned after a row in
+        the order of the given sort keys. NULL values are positioned
+        first when ascending and last when descending, as in MySQL.
+
+        Args:
+            sortkeys (list): (expression, nullable) tuples of sort keys.
+            values (list): Values of each sort key of the row.
+            descending (bool): Whether the sort keys are descending.
+        Returns:
+            The condition expression.
+
+        """
+        conditions = list()
+        for i, ((key, nullable), value) in enumerate(zip(sortkeys, values)):
+            # Rows equal to the row on every earlier key
+            equal = [k.is_(None) if v is None else k == v
+                     for (k, n), v in zip(sortkeys[:i], values[:i])]
+            # and after the row on this key
+            if(value is None and descending):
+                continue
+            elif(value is None):
+                after = key.isnot(None)
+            elif(descending and nullable):
+                after = or_(key < value, key.is_(None))
+            elif(descending):
+                after = key < value
+            else:
+                after = key > value
+            conditions.append(and_(*equal, after))
+        return or_(*conditions)
+
+    def lastpagesize(self, count, limit):
+        """
+        Gets the number of results on the last page when numbering pages.
+
+        Args:
+            count (int): Number of results, or None if not counted.
+            limit (int): Number of results on each page.
+        Returns:
+            The number of results on the last page, or None if not counted.
+
+        """
+        if not count:
+            return None
+        return count % limit or limit
+
+    def encodecursor(self, direction, values, ordering, size=None):
+        """
+        Encodes a page cursor as an opaque URL safe string.
+
+        Args:
+            direction (str): 'next' or 'prev'.
+            values (list): Sort key values of the row the page continues
+                from, or None to start from the end.
+            ordering (int): Identifier of the ordering of the cursor.
+            size (int): Number of results of the page when starting from the
+                end, or None for a full page. Defaults to None.
+        Returns:
+            The cursor string.
+
+        """
+        # Convert dates into JSON serialisable values
+        if values is not None:
+            values = [{'datetime': value.isoformat()}
+                      if isinstance(value, datetime) else
+                      {'date': value.isoformat()}
+                      if isinstance(value, date) else value
+                      for value in values]
+        data = json.dumps([direction, ordering, values, size],
+                          separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    def decodecursor(self, cursor, ordering, keycount):
+        """
+        Decodes a page cursor created by encodecursor.
+
+        Args:
+            cursor (str): The cursor string.
+            ordering (int): Identifier of the ordering expected.
+            keycount (int): Number of sort keys expected.
+        Returns:
+            The direction, sort key values and page size of the cursor.
+        Raises:
+            ValueError: If the cursor is invalid or for another ordering.
+
+        """
+        try:
+            data = base64.urlsafe_b64decode(
+                cursor + '=' * (-len(cursor) % 4))
+            direction, cursorordering, values, size = json.loads(data)
+            if(direction not in ('next', 'prev') or
+               cursorordering != ordering or
+               (values is None and direction != 'prev') or
+               (values is not None and len(values) != keycount) or
+               (size is not None and (values is not None or
+                                      type(size) is not int or size < 1))):
+                raise ValueError
+            # Convert dates back from JSON values
+            if values is not None:
+                values = [datetime.fromisoformat(value['datetime'])
+                          if isinstance(value, dict) and 'datetime' in value
+                          else date.fromisoformat(value['date'])
+                          if isinstance(value, dict) else value
+                          for value in values]
+        except (ValueError, TypeError, KeyError):
+            raise ValueError("Invalid page cursor")
+        return direction, values, size
+
+    def getusers(self, orderby=None, order="asc", offset=0, limit=1000,
+                 cursor=None, countstrategy="exact"):
         """
         Gets and returns a detached user objects for all users in
         specified order and limit.
@@ -101,33 +884,33 @@ class DatabaseAPI:
                 Defaults to 0.
             limit (int): How many rows to return of query.
                 Defaults to 1000.
+            cursor (str): Cursor of page to get instead of using offset.
+                Defaults to None.
+            countstrategy (str): How to count results, see countquery.
+                Defaults to "exact".
         Returns:
             The user model objects in specified order and ammounts.
-            Total number of results that match criteria.
+            Total number of results that match criteria, or None if not
+                counted.
+            Dictionary of cursors of neighbouring pages, see pagequery.
 
         """
         # Initialse session
         with self.sessionmanager() as session:
             # Query all users
             query = session.query(User)
-            # Order query depending on order parameters
-            if(orderby and hasattr(User, orderby) and order == "asc"):
-                query = query.order_by(asc(getattr(User, orderby)))
-            elif(orderby and hasattr(User, orderby) and order == "desc"):
-                query = query.order_by(desc(getattr(User, orderby)))
-            else:
-                pass
             # Get count
-            count = query.count()
-            # Filter query by range
-            query = query.limit(limit).offset(offset)
-            # Get query results
-            users = query.all()
+            count = self.countquery(session, query, countstrategy)
+            # Get page of users ordered by field and user ID
+            sortkeys = (self.getsortkeys(User, orderby) +
+                        [(User.userID, False)])
+            users, cursors = self.pagequery(query, sortkeys, order,
+                                            offset, limit, cursor, count)
             # Detach all share objects from session
             for user in users:
                 session.expunge(user)
         # Return share data
-        return users, count
+        return users, count, cursors
 
     def getuserbyid(self, userID):
         """
@@ -353,9 +1136,9 @@ class DatabaseAPI:
             if share is not None:
                 return False
             # Get share data from ASX
-            address = ("https://www.asx.com.au/asx/1/company/"
+            address = (f"{self.asxurl}/asx/1/company/"
                        f"{issuerID}?fields=primary_share")
-            asxdata = requests.get(address).json()
+            asxdata = self.http.get(address, timeout=self.fetchtimeout).json()
             # Check if share data was not retrieved successfully
             if asxdata.get('error_code'):
                 return False
@@ -390,16 +1173,21 @@ class DatabaseAPI:
         # Return true for success
         return True
 
-    def generatesharepricehistory(self, issuerID):
+    def generatesharepricehistory(self, issuerID, rebuild=False):
         """
-        Generates share price history for given share, deleting previous
-        history there is any.
+        Generates share price history for given share from ASX. By default
+        only share prices at times not already recorded for the share are
+        added, so history is still added for shares that already have live
+        prices recorded by updateshares. A full rebuild deletes any previous
+        history for the share and adds all share prices again.
 
         Args:
             issuerID (str): Issuer ID of share to generate price history for.
+            rebuild (bool): Whether to delete and regenerate the entire
+                share price history. Defaults to False.
         Returns:
-            True if share price history was generated successfully.
-            False if there were any errors that occured.
+            The number of share prices that were added.
+            None if there were any errors that occured.
 
         """
         # Initialse session
@@ -408,58 +1196,67 @@ class DatabaseAPI:
             share = session.query(Share).filter(
                 Share.issuerID == issuerID).first()
             if share is None:
-                return False
-            # Deletes existsing share price history for share
-            session.query(SharePrice).filter(
-                SharePrice.issuerID == issuerID).delete()
-            session.commit()
+                return None
             # Gets the share issuer code from ASX
-            address = ("https://www.asx.com.au/asx/1/company/"
+            address = (f"{self.asxurl}/asx/1/company/"
                        f"{issuerID}?fields=primary_share")
-            asxdata = requests.get(address).json()
+            asxdata = self.http.get(address, timeout=self.fetchtimeout).json()
+            # Check if share data was not retrieved successfully
+            if asxdata.get('error_code'):
+                return None
             code = asxdata['primary_share']['code']
             # Get share price history
-            address = ("https://www.asx.com.au/asx/1/chart/highcharts?"
+            address = (f"{self.asxurl}/asx/1/chart/highcharts?"
                        f"asx_code={code}&complete=true")
-            asxdata = requests.get(address).json()
+            asxdata = self.http.get(address, timeout=self.fetchtimeout).json()
             # Check if share price history was aquired successfully
             if not isinstance(asxdata, list):
-                return False
-            # Record share price history in database
-            for sharepricerecord in asxdata:
-                time = datetime.utcfromtimestamp(
-                    sharepricerecord[0]/1000)
-                recordprice = sharepricerecord[4]
-                shareprice = SharePrice(
-                    issuerID=issuerID,
-                    time=time,
-                    price=recordprice
-                )
-                session.add(shareprice)
-            # Return success
-            return True
+                return None
+            # Process share price history into share price records
+            sharepricerecords = [{
+                "issuerID": issuerID,
+                "time": datetime.utcfromtimestamp(sharepricerecord[0]/1000),
+                "price": sharepricerecord[4]
+            } for sharepricerecord in asxdata]
+            if rebuild:
+                # Deletes existsing share price history for share
+                session.query(SharePrice).filter(
+                    SharePrice.issuerID == issuerID).delete()
+                session.query(SharePriceRollup).filter(
+                    SharePriceRollup.issuerID == issuerID).delete()
+            elif sharepricerecords:
+                # Get times of share prices recorded for share over the
+                # period of the history, then skip those already recorded
+                recordedtimes = {row.time for row in session.query(
+                    SharePrice.time).filter(
+                    SharePrice.issuerID == issuerID,
+                    SharePrice.time >= min(record["time"] for record
+                                           in sharepricerecords))}
+                sharepricerecords = [
+                    record for record in sharepricerecords
+                    if record["time"] not in recordedtimes]
+            # Record share price history in database with a single insert
+            session.bulk_insert_mappings(SharePrice, sharepricerecords)
+            self.discardcounts(SharePrice)
+            # Add share price history to share price rollups
+            self.rollupshareprices(session, sharepricerecords)
+            # Return number of share prices added
+            return len(sharepricerecords)
 
     def getshare(self, issuerID):
         """
-        Returns a single share based on the share ID.
+        Returns a single share based on the share ID, from the share cache.
 
         Args:
             issuerID (str): Issuer ID of the share to get.
         Returns:
-            Share object with specified issuer code.
+            ShareRow of the share with specified issuer code, a read only
+            named tuple of the share's columns.
             None if there is no share that matches the issuer code.
 
         """
-        # Initialse session
-        with self.sessionmanager() as session:
-            # Get all shares
-            share = session.query(Share).get(issuerID)
-            # Return None if share doesn't exist
-            if share is None:
-                return None
-            # Detach share from session
-            session.expunge(share)
-        return share
+        # Get share from share cache
+        return self.getsharecache().get(issuerID)
 
     def getsharepricehistory(self, issuerID, starttime=None, endtime=None):
         """
@@ -472,7 +1269,7 @@ class DatabaseAPI:
             endtime (datetime): Include history before this time.
         Returns:
             All SharePrice objects for that particular share withn
-            specified time.
+            specified time, ordered by time.
             None if the share doesn't exist or if the share has no price data.
 
         """
@@ -487,17 +1284,218 @@ class DatabaseAPI:
             # Filter times after end time
             if(isinstance(endtime, datetime)):
                 query = query.filter(SharePrice.time < endtime)
-            # Get shareprices
-            shareprices = query.all()
+            # Get shareprices ordered by time
+            shareprices = query.order_by(SharePrice.time).all()
             # Detach all share objects from session
             for shareprice in shareprices:
                 session.expunge(shareprice)
         return shareprices
 
-    def getshares(self, orderby=None, order="asc", offset=0, limit=1000):
+    def getsharepriceseries(self, issuerID, starttime=None, endtime=None):
+        """
+        Returns the price history of a single share as parallel arrays of
+        times and prices. Only the time and price columns are selected and
+        no SharePrice objects are created, so this is much lighter than
+        getsharepricehistory for large ranges of time.
+
+        Args:
+            issuerID (str): Issuer ID of the share to get price data for.
+            starttime (datetime): Include history after this time.
+            endtime (datetime): Include history before this time.
+        Returns:
+            Numpy array of share price times as UTC epoch seconds.
+            Numpy array of share prices.
+            Both arrays are ordered by time.
+
+        """
+        # Select only time and price of share prices for share
+        query = select([SharePrice.time, SharePrice.price]).where(
+            SharePrice.issuerID == issuerID)
+        # Filter times before start time
+        if(isinstance(starttime, datetime)):
+            query = query.where(SharePrice.time > starttime)
+        # Filter times after end time
+        if(isinstance(endtime, datetime)):
+            query = query.where(SharePrice.time < endtime)
+        # Initialse session
+        timechunks = [np.empty(0)]
+        pricechunks = [np.empty(0)]
+        with self.sessionmanager() as session:
+            # Get share prices as plain rows ordered by time, streaming
+            # rows from the database rather than buffering them all
+            result = session.execute(query.order_by(
+                SharePrice.time).execution_options(stream_results=True))
+            # Convert rows into arrays a chunk at a time, so only one chunk
+            # of rows is held in memory, converting times to epoch seconds
+            rows = result.fetchmany(10000)
+            while rows:
+                times = np.array([row[0] for row in rows],
+                                 dtype='datetime64[us]')
+                timechunks.append(times.astype(np.int64) / 1e6)
+                pricechunks.append(np.array([row[1] for row in rows],
+                                            dtype=np.float64))
+                rows = result.fetchmany(10000)
+        # Return combined arrays
+        return np.concatenate(timechunks), np.concatenate(pricechunks)
+
+    def getsharepricerollups(self, issuerID, starttime, endtime, maxpoints):
+        """
+        Returns the open, high, low and close share prices of a single share
+        over a range of times, using the finest resolution that covers the
+        range in no more than the given number of periods. Weekly rollups
+        are used if no resolution fits.
+
+        Args:
+            issuerID (str): Issuer ID of the share to get rollups for.
+            starttime (datetime): Include periods containing or after this
+                time.
+            endtime (datetime): Include periods starting before this time.
+            maxpoints (int): Maximum number of periods wanted.
+        Returns:
+            Name of the resolution used.
+            All SharePriceRollup objects of that resolution for the share
+            within specified time, ordered by time.
+
+        """
+        # Choose finest resolution that fits within the number of points
+        for resolution, period in SharePriceRollup.RESOLUTIONS.items():
+            if (endtime - starttime) / period <= maxpoints:
+                break
+        # Initialse session
+        with self.sessionmanager() as session:
+            # Get rollups of chosen resolution within range
+            rollups = session.query(SharePriceRollup).filter(
+                SharePriceRollup.issuerID == issuerID,
+                SharePriceRollup.resolution == resolution,
+                SharePriceRollup.time >= SharePriceRollup.getperiodstart(
+                    starttime, resolution),
+                SharePriceRollup.time < endtime).order_by(
+                SharePriceRollup.time).all()
+            # Detach all rollups from session
+            for rollup in rollups:
+                session.expunge(rollup)
+        return resolution, rollups
+
+    def rollupshareprices(self, session, sharepricerecords):
+        """
+        Adds share prices to the open, high, low and close share price
+        rollups of every resolution, creating rollups for new periods.
+        Must be given the session the share prices are being recorded in,
+        so rollups are kept consistent with share prices.
+
+        Args:
+            session (Session): Session share prices are being recorded in.
+            sharepricerecords (list): Share prices as dictionaries of
+                'issuerID', 'time' and 'price'.
+        Returns:
+            Number of rollups that were added or updated.
+
+        """
+        def merge(rollup, other):
+            # Combine other rollup of the same period into rollup
+            if other['opentime'] < rollup['opentime']:
+                rollup['opentime'] = other['opentime']
+                rollup['open'] = other['open']
+            if other['closetime'] >= rollup['closetime']:
+                rollup['closetime'] = other['closetime']
+                rollup['close'] = other['close']
+            rollup['high'] = max(rollup['high'], other['high'])
+            rollup['low'] = min(rollup['low'], other['low'])
+            rollup['count'] += other['count']
+
+        # Roll up share prices into periods of every resolution
+        rollups = dict()
+        for record in sharepricerecords:
+            for resolution in SharePriceRollup.RESOLUTIONS:
+                periodstart = SharePriceRollup.getperiodstart(
+                    record['time'], resolution)
+                rollup = {
+                    'issuerID': record['issuerID'],
+                    'resolution': resolution,
+                    'time': periodstart,
+                    'opentime': record['time'],
+                    'closetime': record['time'],
+                    'open': record['price'],
+                    'high': record['price'],
+                    'low': record['price'],
+                    'close': record['price'],
+                    'count': 1
+                }
+                key = (record['issuerID'], resolution, periodstart)
+                if key in rollups:
+                    merge(rollups[key], rollup)
+                else:
+                    rollups[key] = rollup
+        # Merge in existing rollups of the same periods, in chunks so the
+        # number of keys per query stays bounded
+        keys = list(rollups)
+        updatedrollups = list()
+        for i in range(0, len(keys), 1000):
+            existingrollups = session.query(
+                SharePriceRollup.issuerID, SharePriceRollup.resolution,
+                SharePriceRollup.time, SharePriceRollup.opentime,
+                SharePriceRollup.closetime, SharePriceRollup.open,
+                SharePriceRollup.high, SharePriceRollup.low,
+                SharePriceRollup.close, SharePriceRollup.count).filter(
+                tuple_(SharePriceRollup.issuerID, SharePriceRollup.resolution,
+                       SharePriceRollup.time).in_(keys[i:i+1000])).all()
+            for existingrollup in existingrollups:
+                existingrollup = existingrollup._asdict()
+                key = (existingrollup['issuerID'],
+                       existingrollup['resolution'], existingrollup['time'])
+                merge(existingrollup, rollups.pop(key))
+                updatedrollups.append(existingrollup)
+        # Update existing rollups and insert new rollups
+        session.bulk_update_mappings(SharePriceRollup, updatedrollups)
+        session.bulk_insert_mappings(SharePriceRollup, list(rollups.values()))
+        self.discardcounts(SharePriceRollup)
+        # Return number of rollups changed
+        return len(updatedrollups) + len(rollups)
+
+    def rebuildsharepricerollups(self, issuerID=None):
+        """
+        Deletes and rebuilds share price rollups from recorded share prices.
+        Used to create rollups for share price history recorded before
+        rollups were maintained.
+
+        Args:
+            issuerID (str): Issuer ID of share to rebuild rollups of.
+                Defaults to None, rebuilding rollups of every share.
+        Returns:
+            Number of rollups that were created.
+
+        """
+        # Get issuer IDs of shares to rebuild
+        if issuerID:
+            issuerIDs = [issuerID]
+        else:
+            with self.sessionmanager() as session:
+                issuerIDs = [code[0] for code in
+                             session.query(Share.issuerID).all()]
+        # Rebuild each share in its own transaction
+        rollupcount = 0
+        for issuerID in issuerIDs:
+            with self.sessionmanager() as session:
+                # Delete existing rollups of share
+                session.query(SharePriceRollup).filter(
+                    SharePriceRollup.issuerID == issuerID).delete()
+                # Roll up every recorded share price of share
+                shareprices = session.query(
+                    SharePrice.issuerID, SharePrice.time,
+                    SharePrice.price).filter(
+                    SharePrice.issuerID == issuerID).all()
+                rollupcount += self.rollupshareprices(
+                    session, [shareprice._asdict()
+                              for shareprice in shareprices])
+        # Return number of rollups created
+        return rollupcount
+
+    def getshares(self, orderby=None, order="asc", offset=0, limit=1000,
+                  cursor=None, countstrategy="exact"):
         """
-        Returns a list of all share objects contained in the database.
-        Detaches shares from session, so changes cannot be made directly.
+        Returns a list of all shares contained in the database, paged from
+        the share cache without querying the database. Shares are returned
+        as ShareRow read only named tuples of their columns.
 
         Args:
             orderby (str): Name of field to sort by.
@@ -508,136 +1506,252 @@ class DatabaseAPI:
                 Defaults to 0.
             limit (int): How many rows to return of query.
                 Defaults to 1000.
+            cursor (str): Cursor of page to get instead of using offset.
+                Defaults to None.
+            countstrategy (str): How to count results, see countquery.
+                Defaults to "exact".
         Returns:
             A list of every share in the database in given order.
-            Total number of results that match criteria.
-
+            Total number of results that match criteria, or None if not
+                counted.
+            Dictionary of cursors of neighbouring pages, see pagequery.
+        Raises:
+            ValueError: If the cursor or count strategy is invalid.
 
         """
-        # Initialse session
-        with self.sessionmanager() as session:
-            # Get all shares
-            query = session.query(Share)
-            # Order query depending on order parameters
-            if(orderby and hasattr(Share, orderby) and order == "asc"):
-                query = query.order_by(asc(getattr(Share, orderby)))
-            elif(orderby and hasattr(Share, orderby) and order == "desc"):
-                query = query.order_by(desc(getattr(Share, orderby)))
-            else:
-                pass
-            # Get count
-            count = query.count()
-            # Filter query by range
-            query = query.limit(limit).offset(offset)
-            # Get query results
-            shares = query.all()
-            # Detach all share objects from session
-            for share in shares:
-                session.expunge(share)
+        # Get all shares from share cache
+        shares = list(self.getsharecache().values())
+        # Get count, which only the exact and estimate count strategies
+        # usually query the database for
+        count = None
+        if(countstrategy != 'none'):
+            with self.sessionmanager() as session:
+                count = self.countquery(session, session.query(Share),
+                                        countstrategy)
+        # Get page of shares ordered by field and issuer ID
+        sortkeys = (self.getsortkeys(Share, orderby) +
+                    [(Share.issuerID, False)])
+        shares, cursors = self.pagelist(shares, sortkeys, order,
+                                        offset, limit, cursor, count)
         # Return share data
-        return shares, count
+        return shares, count, cursors
 
-    def updateshares(self):
+    def fetchsharedata(self, issuerIDs):
+        """
+        Fetches current share data from ASX for each given share.
+        Requests are run concurrently by a bounded pool of workers that
+        share a single HTTP session, so connections are reused.
+
+        Args:
+            issuerIDs (list): Issuer IDs of shares to fetch data for.
+        Returns:
+            A dictionary of share data keyed by issuer ID. Shares that ASX
+            returns an error for, or that could not be fetched, are
+            skipped.
+            A dictionary of fetch statistics, containing the overall
+            'walltime' and the per share 'latencies', both in seconds.
+
+        """
+        def fetch(issuerID):
+            # Call ASX API, timing how long the call takes
+            starttime = time.perf_counter()
+            address = (f"{self.asxurl}/asx/1/share/"
+                       f"{issuerID}?fields=primary_share")
+            try:
+                asxdata = self.http.get(
+                    address, timeout=self.fetchtimeout).json()
+            # Timeouts, connection errors and invalid JSON are not raised, so
+            # that one failing share does not stop the others being updated
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warning("Failed to fetch %s from ASX: %r", issuerID, e)
+                asxdata = None
+            return asxdata, time.perf_counter() - starttime
+
+        # Initialise share data and latencies
+        share_data = dict()
+        latencies = dict()
+        starttime = time.perf_counter()
+        # Fetch every share using the worker pool
+        with ThreadPoolExecutor(max_workers=self.fetchworkers) as executor:
+            # Iterate over results in the same order as issuer IDs
+            results = executor.map(fetch, issuerIDs)
+            for issuerID, (asxdata, latency) in zip(issuerIDs, results):
+                # Record latency of the call
+                latencies[issuerID] = latency
+                # Check that the data was successfully retreived
+                if asxdata is None or asxdata.get('error_code'):
+                    # If unsuccessful, skip this share and try the next one
+                    # TODO: Rather than skip, maybe throw an exception or make
+                    #       it return false after doing everything else, as
+                    #       some shares may be removed from ASX later and may
+                    #       not work correctly.
+                    continue
+                # Add data to dictionary
+                share_data[issuerID] = {
+                    "currentprice": asxdata['last_price'],
+                    "marketcapitalisation": asxdata['market_cap'],
+                    "sharecount": asxdata['number_of_shares'],
+                    "daychangepercent": asxdata['change_in_percent'],
+                    "daychangeprice": asxdata['change_price'],
+                    "daypricehigh": asxdata['day_high_price'],
+                    "daypricelow": asxdata['day_low_price'],
+                    "dayvolume": asxdata['volume']
+                }
+        # Calculate total time taken
+        walltime = time.perf_counter() - starttime
+        # Return share data and statistics
+        return share_data, {'walltime': walltime, 'latencies': latencies}
+
+    def updateshares(self, bulk=True):
         """
         Updates share and share price tables with new values from ASX.
-        Calls ASX API in this method directly.
+        Share data is fetched from ASX concurrently using fetchsharedata,
+        with fetch timings reported to the log, then written using
+        recordsharedata, and the share cache reloaded. Limit and stop orders
+        triggered by the new prices are then executed using
+        executependingorders, and leaderboard rankings refreshed using
+        refreshrankings.
 
+        Args:
+            bulk (bool): Whether to write share data in bulk.
+                Defaults to True.
         Returns:
             bool: True if update was successful, false if any
                   major error occurs.
 
-        Note: May be updated to be passed share data rather
-              than do API calls here.
-            Proposed data structure to be passed:
-            <issuer code>:{
-                curr_price: <Current price of share>
-                curr_mc: <Current market cap of share>
-                curr_sc: <Current total number of shares>
-                dc_percent: <Current daily price change percent>
-                dc_price: <Current daily price change>
-            }
         """
         # Initialse session
         with self.sessionmanager() as session:
             # Get issuer codes for all currently stored shares
             share_codes = session.query(Share.issuerID).all()
 
-        # Initialise share data
-        share_data = dict()
-        # Iterate over each share issuer code
-        for code in share_codes:
-            # Get issuer code
-            issuerID = code[0]
-            # Call ASX API
-            address = ("https://www.asx.com.au/asx/1/share/"
-                       "%s?fields=primary_share") % issuerID
-            asxdata = requests.get(address).json()
-            # Check that the data was successfully retreived
-            if asxdata.get('error_code'):
-                # If unsuccessful, skip this share and try the next one
-                # TODO: Rather than skip, maybe throw an exception or make it
-                #       return false after doing everything else, as some
-                #       shares may be removed from ASX later and may not
-                #       work correctly.
-                continue
-            # Add data to dictionary
-            share_data[issuerID] = {
-                "currentprice": asxdata['last_price'],
-                "marketcapitalisation": asxdata['market_cap'],
-                "sharecount": asxdata['number_of_shares'],
-                "daychangepercent": asxdata['change_in_percent'],
-                "daychangeprice": asxdata['change_price'],
-                "daypricehigh": asxdata['day_high_price'],
-                "daypricelow": asxdata['day_low_price'],
-                "dayvolume": asxdata['volume']
-            }
+        # Fetch current share data from ASX
+        share_data, fetchstats = self.fetchsharedata(
+            [code[0] for code in share_codes])
+        # Report how long fetching took
+        logger.info("Fetched %d of %d shares from ASX in %.3f seconds",
+                    len(share_data), len(share_codes),
+                    fetchstats['walltime'])
+        for issuerID, latency in fetchstats['latencies'].items():
+            logger.debug("Fetched %s in %.3f seconds", issuerID, latency)
+
+        # Record fetched share data
+        recorded = self.recordsharedata(share_data, bulk=bulk)
+        # Reload share cache with the new prices, replacing it at once
+        self.getsharecache()
+        # Execute limit and stop orders triggered by the new prices
+        self.executependingorders({
+            issuerID: float(share_data[issuerID]["currentprice"])
+            for issuerID in share_data})
+        # Refresh leaderboard rankings with the new prices
+        with self.sessionmanager() as session:
+            self.refreshrankings(session)
+        # Return whether share data was recorded
+        return recorded
 
+    def recordsharedata(self, share_data, bulk=True):
+        """
+        Updates shares with given share data and records a new share price
+        for each of them. Every share price recorded is given the same time.
+
+        Args:
+            share_data (dict): Share data keyed by issuer ID, in the format
+                returned by fetchsharedata.
+            bulk (bool): Whether to write all shares and share prices with
+                a constant number of statements in one transaction, rather
+                than updating and committing each share in turn.
+                Defaults to True.
+        Returns:
+            bool: True if shares were recorded successfully.
+
+        """
+        # Define record time shared by all share prices
+        recordtime = datetime.utcnow()
+        # Process share data into share updates and share price records
+        shareupdates = list()
+        sharepricerecords = list()
+        for issuerID in share_data:
+            shareupdates.append({
+                "issuerID": issuerID,
+                "currentprice": float(
+                    share_data[issuerID]["currentprice"]),
+                "marketcapitalisation": int(
+                    share_data[issuerID]["marketcapitalisation"]),
+                "sharecount": int(
+                    share_data[issuerID]["sharecount"]),
+                "daychangepercent": float(
+                    share_data[issuerID]["daychangepercent"].strip('%'))/100,
+                "daychangeprice": float(
+                    share_data[issuerID]["daychangeprice"]),
+                "daypricehigh": float(
+                    share_data[issuerID]['daypricehigh']),
+                "daypricelow": float(
+                    share_data[issuerID]['daypricelow']),
+                "dayvolume": int(
+                    share_data[issuerID]['dayvolume'])
+            })
+            sharepricerecords.append({
+                "issuerID": issuerID,
+                "time": recordtime,
+                "price": float(share_data[issuerID]["currentprice"])
+            })
         # Initialse session
         with self.sessionmanager() as session:
-            # Iterate over each share and update its values
-            for issuerID in share_data:
-                # Get share data
-                currentprice = float(
-                    share_data[issuerID]["currentprice"])
-                marketcapitalisation = int(
-                    share_data[issuerID]["marketcapitalisation"])
-                sharecount = int(
-                    share_data[issuerID]["sharecount"])
-                daychangepercent = float(
-                    share_data[issuerID]["daychangepercent"].strip('%'))/100
-                daychangeprice = float(
-                    share_data[issuerID]["daychangeprice"])
-                daypricehigh = float(
-                    share_data[issuerID]['daypricehigh'])
-                daypricelow = float(
-                    share_data[issuerID]['daypricelow'])
-                dayvolume = int(
-                    share_data[issuerID]['dayvolume'])
-                # Update share field
-                share = session.query(Share).get(issuerID)
-                share.currentprice = currentprice
-                share.marketcapitalisation = marketcapitalisation
-                share.sharecount = sharecount
-                share.daychangepercent = daychangepercent
-                share.daychangeprice = daychangeprice
-                share.daypricehigh = daypricehigh
-                share.daypricelow = daypricelow
-                share.dayvolume = dayvolume
-                # Create and add new share price record
-                shareprice = SharePrice(
-                    issuerID=issuerID,
-                    time=datetime.utcnow(),
-                    price=currentprice
-                )
-                session.add(shareprice)
-                session.commit()
+            if bulk:
+                # Update all shares with a single executemany update, which
+                # bypasses flush listeners so the shares are stamped here
+                session.bulk_update_mappings(Share, shareupdates)
+                self.stampshares(session)
+                # Insert all share prices with a single executemany insert
+                session.bulk_insert_mappings(SharePrice, sharepricerecords)
+                self.discardcounts(SharePrice)
+                # Add share prices to share price rollups
+                self.rollupshareprices(session, sharepricerecords)
+            else:
+                # Iterate over each share and update its values
+                for shareupdate, sharepricerecord in zip(
+                        shareupdates, sharepricerecords):
+                    # Update share fields
+                    share = session.query(Share).get(shareupdate['issuerID'])
+                    for field, value in shareupdate.items():
+                        setattr(share, field, value)
+                    # Create and add new share price record
+                    session.add(SharePrice(**sharepricerecord))
+                    # Add share price to share price rollups
+                    self.rollupshareprices(session, [sharepricerecord])
+                    session.commit()
         # Return true as update was successful
         return True
 
+    def validordernumber(self, number, integer=True):
+        """
+        Checks that a quantity or trigger price of an order is a positive,
+        finite number. Booleans are not accepted, despite being integers.
+
+        Args:
+            number: Value to check.
+            integer (bool): Whether the number must be an integer.
+                Defaults to True.
+        Returns:
+            bool: True if the number is valid.
+
+        """
+        # Check that number is of an accepted type
+        types = int if integer else (int, float)
+        if(not isinstance(number, types) or isinstance(number, bool)):
+            return False
+        # Check that number is finite and positive, integers always being
+        # finite but possibly too large to convert to a float
+        return ((isinstance(number, int) or math.isfinite(number)) and
+                number > 0)
+
     def buyshare(self, userID, issuerID, quantity):
         """
         Adds a new transaction of a user purchasing shares.
         Also updates user shares table.
+        The user and usershare rows are locked, in that order, until the
+        trade is committed, so concurrent trades by the same user are
+        serialised without locking whole tables.
         TODO: Return reason for false return
 
         Args:
@@ -646,14 +1760,21 @@ class DatabaseAPI:
             quantity (int): Ammount of shares being purchased.
 
         """
+        # Check that quantity is valid
+        if(not self.validordernumber(quantity)):
+            return False
+        # Get share and its price from share cache before any rows are
+        # locked
+        share = self.getsharecache().get(issuerID)
         # Initialse session
         with self.sessionmanager() as session:
-            # Check that user exists
-            user = session.query(User).get(userID)
+            # Check that user exists, locking their row until the purchase
+            # is committed so concurrent trades by the user are serialised
+            user = session.query(User).filter(
+                User.userID == userID).with_for_update().first()
             if(user is None):
                 return False
             # Check that share exists
-            share = session.query(Share).get(issuerID)
             if(share is None):
                 return False
             # Calculate costs for purchase including fee
@@ -676,10 +1797,10 @@ class DatabaseAPI:
                 status="Valid"
             )
             session.add(transaction)
-            # Update user shares table
+            # Update user shares table, locking the usershare row
             usershare = session.query(Usershare).filter(
                 Usershare.userID == userID,
-                Usershare.issuerID == issuerID).first()
+                Usershare.issuerID == issuerID).with_for_update().first()
             # If the share doesn't already exist, create new record
             if(usershare is None):
                 usershare = Usershare(
@@ -687,46 +1808,59 @@ class DatabaseAPI:
                     issuerID=issuerID,
                     profit=0,
                     loss=totalprice,
-                    quantity=quantity
+                    quantity=quantity,
+                    totalcost=totalprice,
+                    quantityacquired=quantity
                 )
                 session.add(usershare)
             # Otherwise, update existing usershare record
             else:
                 usershare.loss = (float(usershare.loss) + sharesprice)
                 usershare.quantity = (usershare.quantity + quantity)
+                usershare.totalcost = (float(usershare.totalcost) +
+                                       totalprice)
+                usershare.quantityacquired = (usershare.quantityacquired +
+                                              quantity)
             # Subtract from user balance
             user.balance = float(user.balance) - totalprice
+            # Refresh user's leaderboard ranking
+            session.flush()
+            self.refreshrankings(session, [userID])
             # Return true for success
             return True
 
     def averagePurchasedStockPrice(self, userID, issuerID):
         """
         Calculates the average purchase price for a given stock(issuer ID)
+        from the running purchase totals of the user's share.
 
         Args:
             userID (str): ID of user that is making the sale.
             issuerID (str): ID of share that is being sold.
+        Returns:
+            Average price paid per share including fees.
+            0 if the user has not purchased the share.
 
         """
-        averagePrice = 0
-        totalValue = 0
-        totalQuantity = 0
-        purchaseTransactions, count = self.gettransactions(
-            userID=userID, issuerID=issuerID, orderby=None,
-            order="asc", offset=0, limit=1000, transtype="B")
-        if (count > 0):
-            for purchase in purchaseTransactions:
-                totalValue += purchase.totaltransval
-                totalQuantity += purchase.quantity
-
-            averagePrice = totalValue/totalQuantity
-
-        return float(averagePrice)
+        # Initialse session
+        with self.sessionmanager() as session:
+            # Get purchase totals of user share
+            usershare = session.query(
+                Usershare.totalcost, Usershare.quantityacquired).filter(
+                Usershare.userID == userID,
+                Usershare.issuerID == issuerID).first()
+        # Calculate average price from purchase totals
+        if usershare is None or not usershare.quantityacquired:
+            return 0.0
+        return float(usershare.totalcost)/usershare.quantityacquired
 
     def sellshare(self, userID, issuerID, quantity):
         """
         Adds a new transaction of a user selling shares.
         Also updates user shares table.
+        The user and usershare rows are locked, in that order, until the
+        trade is committed, so concurrent trades by the same user are
+        serialised without locking whole tables.
         TODO: Return reason for false return
 
         Args:
@@ -735,20 +1869,27 @@ class DatabaseAPI:
             quantity (int): Ammount of shares being sold.
 
         """
+        # Check that quantity is valid
+        if(not self.validordernumber(quantity)):
+            return False
+        # Get share and its price from share cache before any rows are
+        # locked
+        share = self.getsharecache().get(issuerID)
         # Initialse session
         with self.sessionmanager() as session:
-            # Check that user exists
-            user = session.query(User).get(userID)
+            # Check that user exists, locking their row until the sale is
+            # committed so concurrent trades by the user are serialised
+            user = session.query(User).filter(
+                User.userID == userID).with_for_update().first()
             if(user is None):
                 return False
             # Check that share exists
-            share = session.query(Share).get(issuerID)
             if(share is None):
                 return False
-            # Check that user has shares
+            # Check that user has shares, locking the usershare row
             usershare = session.query(Usershare).filter(
                 Usershare.userID == userID,
-                Usershare.issuerID == issuerID).first()
+                Usershare.issuerID == issuerID).with_for_update().first()
             if(usershare is None):
                 return False
             # Check that user can sell the quantity of shares
@@ -779,8 +1920,11 @@ class DatabaseAPI:
 
             # Remember the amount a sale cost TODO: Handle error better
             soldSharePrice = totalprice/quantity
-            theAveragePurchasePrice = self.averagePurchasedStockPrice(
-                userID, issuerID)
+            if (usershare.quantityacquired > 0):
+                theAveragePurchasePrice = (float(usershare.totalcost) /
+                                           usershare.quantityacquired)
+            else:
+                theAveragePurchasePrice = 0
             if (theAveragePurchasePrice == 0):
                 pass
             else:
@@ -789,86 +1933,538 @@ class DatabaseAPI:
                     user.overallPerc*user.totalNumSales) + percent)/(
                         user.totalNumSales+1)
                 user.totalNumSales += 1
+            # Refresh user's leaderboard ranking
+            session.flush()
+            self.refreshrankings(session, [userID])
             # Return true for success
             return True
 
-    def getusersharesinfo(self, userID=None,
-                          orderby=None, order="asc", offset=0, limit=1000):
+    def submitorders(self, userID, orders):
+        """
+        Executes a batch of share purchases and sales for a user in a single
+        transaction. Shares and usershares of every order are loaded with
+        one query each, and all orders are applied or none are.
+        Orders are applied in the given order, and the batch succeeds only
+        if the user's balance and every holding are non-negative once all
+        orders are applied, so sales can fund purchases in the same batch.
+        The user row is locked before the usershare rows, matching buyshare
+        and sellshare.
+
+        Args:
+            userID (str): ID of user that is making the orders.
+            orders (list): List of dictionaries with the keys 'issuerID',
+                'quantity' and 'transtype', where transtype is 'B' for a
+                purchase or 'S' for a sale.
+        Returns:
+            True if every order was executed.
+            False if any order was invalid, in which case none are executed.
+
+        """
+        # Check that every order is valid
+        if not orders:
+            return False
+        for order in orders:
+            if(order.get('transtype') not in ('B', 'S') or
+                    not self.validordernumber(order.get('quantity'))):
+                return False
+        issuerIDs = {order.get('issuerID') for order in orders}
+        # Get shares and their prices from share cache before any rows are
+        # locked
+        shares = self.getsharecache()
+        # Initialse session
+        with self.sessionmanager() as session:
+            # Check that user exists, locking their row until the orders
+            # are committed so concurrent trades by the user are serialised
+            user = session.query(User).filter(
+                User.userID == userID).with_for_update().first()
+            if(user is None):
+                return False
+            # Get prices of all shares ordered and check that they exist
+            prices = {issuerID: shares[issuerID].currentprice
+                      for issuerID in issuerIDs if issuerID in shares}
+            if(len(prices) != len(issuerIDs)):
+                return False
+            # Get and lock all usershares of shares ordered
+            usershares = {usershare.issuerID: usershare for usershare in
+                          session.query(Usershare).filter(
+                              Usershare.userID == userID,
+                              Usershare.issuerID.in_(issuerIDs)
+                          ).with_for_update().all()}
+            # Apply all orders, calculating costs including fees
+            transactiontime = datetime.utcnow()
+            user.balance = float(user.balance)
+            for order in orders:
+                if not self.applytrade(
+                        session, user, usershares, order['issuerID'],
+                        order['transtype'], order['quantity'],
+                        prices[order['issuerID']], transactiontime):
+                    # Discard every change if user has no shares to sell
+                    session.rollback()
+                    return False
+            # Check that user can afford orders and holds the shares sold,
+            # otherwise discard every change
+            if(user.balance < 0 or any(usershare.quantity < 0
+                                       for usershare in usershares.values())):
+                session.rollback()
+                return False
+            # Refresh user's leaderboard ranking
+            session.flush()
+            self.refreshrankings(session, [userID])
+            # Return true for success
+            return True
+
+    def tradecosts(self, transtype, price, quantity):
+        """
+        Calculates the value of shares traded and the fee charged for a
+        purchase or sale.
+
+        Args:
+            transtype (str): 'B' for a purchase or 'S' for a sale.
+            price (float): Price per share.
+            quantity (int): Number of shares traded.
+        Returns:
+            Value of shares traded.
+            Fee charged.
+            Total value, the amount paid for a purchase or received for a
+            sale.
+
+        """
+        sharesprice = price * quantity
+        if transtype == 'B':
+            feesprice = 50 + (sharesprice * 0.01)
+            return sharesprice, feesprice, sharesprice + feesprice
+        feesprice = 50 + (sharesprice * 0.0025)
+        return sharesprice, feesprice, sharesprice - feesprice
+
+    def applytrade(self, session, user, usershares, issuerID, transtype,
+                   quantity, price, transactiontime):
+        """
+        Applies a purchase or sale to a user's balance and usershare and
+        adds its transaction, without checking that the user can afford it
+        or holds enough shares, so the caller must check the user's balance
+        and usershare afterwards. The caller should pass the active session
+        and should have locked the user and usershare rows.
+
+        Args:
+            session: Session of the trade.
+            user (User): User making the trade, with balance as a float.
+            usershares (dict): Usershares of the user keyed by issuer ID.
+                A usershare created by a purchase is added to it.
+            issuerID (str): ID of share traded.
+            transtype (str): 'B' for a purchase or 'S' for a sale.
+            quantity (int): Number of shares traded.
+            price (float): Price per share.
+            transactiontime (datetime): Time of the transaction.
+        Returns:
+            bool: False if the trade is a sale of a share the user has no
+                usershare for, in which case nothing is changed.
+
+        """
+        # Calculate costs of trade including fee
+        sharesprice, feesprice, totalprice = self.tradecosts(
+            transtype, price, quantity)
+        usershare = usershares.get(issuerID)
+        if transtype == 'B':
+            user.balance -= totalprice
+            # If the share isn't already owned, create new record
+            if(usershare is None):
+                usershare = Usershare(
+                    userID=user.userID, issuerID=issuerID, profit=0,
+                    loss=totalprice, quantity=quantity,
+                    totalcost=totalprice, quantityacquired=quantity)
+                usershares[issuerID] = usershare
+                session.add(usershare)
+            # Otherwise, update existing usershare record
+            else:
+                usershare.loss = float(usershare.loss) + sharesprice
+                usershare.quantity = usershare.quantity + quantity
+                usershare.totalcost = (float(usershare.totalcost) +
+                                       totalprice)
+                usershare.quantityacquired = (usershare.quantityacquired +
+                                              quantity)
+        else:
+            # Check that user has shares to sell
+            if(usershare is None):
+                return False
+            user.balance += totalprice
+            usershare.profit = float(usershare.profit) + totalprice
+            usershare.quantity = usershare.quantity - quantity
+            # Update user rating with gain of sale over average purchase
+            # price
+            if(usershare.quantityacquired > 0):
+                averageprice = (float(usershare.totalcost) /
+                                usershare.quantityacquired)
+                percent = (totalprice/quantity/averageprice - 1)*100
+                user.overallPerc = ((
+                    user.overallPerc*user.totalNumSales) + percent)/(
+                        user.totalNumSales+1)
+                user.totalNumSales += 1
+        # Create and add transaction
+        session.add(Transaction(
+            issuerID=issuerID,
+            userID=user.userID,
+            datetime=transactiontime,
+            transtype=transtype,
+            feeval=feesprice,
+            stocktransval=sharesprice,
+            totaltransval=totalprice,
+            quantity=quantity,
+            status="Valid"
+        ))
+        return True
+
+    def placeorder(self, userID, issuerID, transtype, ordertype,
+                   triggerprice, quantity):
+        """
+        Places a limit or stop order, which rests until a share price update
+        triggers it. Limit orders buy at or below, or sell at or above,
+        their trigger price. Stop orders buy at or above, or sell at or
+        below, their trigger price. Triggered orders are executed at the
+        share's new price.
+
+        Args:
+            userID (str): ID of user placing the order.
+            issuerID (str): ID of share ordered.
+            transtype (str): 'B' for a purchase or 'S' for a sale.
+            ordertype (str): 'limit' or 'stop'.
+            triggerprice (float): Price that triggers the order.
+            quantity (int): Number of shares ordered.
+        Returns:
+            ID of the placed order.
+            None if the order is invalid.
+
+        """
+        # Check that order is valid
+        if(transtype not in ('B', 'S') or ordertype not in ('limit', 'stop')
+                or not self.validordernumber(quantity) or
+                not self.validordernumber(triggerprice, integer=False)):
+            return None
+        # Get shares from share cache
+        shares = self.getsharecache()
+        # Initialse session
+        with self.sessionmanager() as session:
+            # Check that user and share exist
+            if(session.query(User).get(userID) is None or
+                    issuerID not in shares):
+                return None
+            # Create and add order
+            order = PendingOrder(
+                userID=userID,
+                issuerID=issuerID,
+                transtype=transtype,
+                ordertype=ordertype,
+                triggerprice=float(triggerprice),
+                quantity=quantity,
+                createdtime=datetime.utcnow(),
+                status="Open"
+            )
+            session.add(order)
+            session.commit()
+            # Return ID of order, which is indexed on the next price update
+            return order.orderID
+
+    def cancelorder(self, userID, orderID):
+        """
+        Cancels an open limit or stop order of a user.
+
+        Args:
+            userID (str): ID of user that placed the order.
+            orderID (int): ID of order to cancel.
+        Returns:
+            bool: True if the order was cancelled, False if the user has no
+                open order with given ID.
+
+        """
+        # Initialse session
+        with self.sessionmanager() as session:
+            # Close order if still open
+            cancelled = session.query(PendingOrder).filter(
+                PendingOrder.orderID == orderID,
+                PendingOrder.userID == userID,
+                PendingOrder.status == "Open").update({
+                    "status": "Cancelled",
+                    "closedtime": datetime.utcnow()},
+                synchronize_session=False)
+        # Remove order from index
+        self.orderbook.remove(orderID)
+        # Return whether order was cancelled
+        return cancelled == 1
+
+    def getpendingorders(self, userID):
+        """
+        Gets the open limit and stop orders of a user.
+
+        Args:
+            userID (str): ID of user to get orders of.
+        Returns:
+            List of detached pending order objects, oldest first.
+
+        """
+        # Initialse session
+        with self.sessionmanager() as session:
+            # Get open orders of user
+            orders = session.query(PendingOrder).filter(
+                PendingOrder.userID == userID,
+                PendingOrder.status == "Open").order_by(
+                PendingOrder.orderID).all()
+            # Detach all order objects from session
+            for order in orders:
+                session.expunge(order)
+        # Return orders
+        return orders
+
+    def loadpendingorders(self, full=False):
+        """
+        Loads open limit and stop orders into the order index. Only orders
+        placed since ORDER_LOAD_OVERLAP_SECONDS before the last load are
+        loaded, unless a full load is requested, the index has not been
+        loaded yet, or the last full load was over an hour ago. The overlap
+        picks up orders committed after orders placed later, and orders
+        already indexed are skipped. Full loads pick up orders cancelled by
+        other processes that incremental loads can miss.
+
+        Args:
+            full (bool): Whether to reload every open order.
+                Defaults to False.
+        Returns:
+            Number of orders added to the index.
+
+        """
+        # Reload every order if requested or due
+        now = datetime.utcnow()
+        loadedtime = self.orderbook.loadedtime
+        checkedtime = self.orderbook.checkedtime
+        if(full or loadedtime is None or
+                now - loadedtime > timedelta(hours=1)):
+            self.orderbook.clear()
+            self.orderbook.loadedtime = now
+            checkedtime = None
+        self.orderbook.checkedtime = now
+        # Initialse session
+        with self.sessionmanager() as session:
+            # Get open orders, only those placed since shortly before the
+            # last load unless reloading every order
+            query = session.query(
+                PendingOrder.orderID, PendingOrder.issuerID,
+                PendingOrder.transtype, PendingOrder.ordertype,
+                PendingOrder.triggerprice).filter(
+                PendingOrder.status == "Open")
+            if checkedtime is not None:
+                query = query.filter(
+                    PendingOrder.createdtime >= checkedtime - timedelta(
+                        seconds=self.orderloadoverlap))
+            orders = query.all()
+        # Add orders to index, skipping those already indexed
+        indexed = len(self.orderbook)
+        for order in orders:
+            self.orderbook.add(*order)
+        # Return number of orders added
+        return len(self.orderbook) - indexed
+
+    def removeexecutedorders(self, session):
+        """
+        Session after commit listener that removes the orders executed in a
+        committed request session from the order index.
+
+        """
+        # Ignore savepoints, which are only committed with the request
+        if session.transaction.nested:
+            return
+        for orderID in session.info.pop('executedorders', set()):
+            self.orderbook.remove(orderID)
+
+    def keepexecutedorders(self, session):
+        """
+        Session after rollback listener that keeps the orders executed in a
+        request session in the order index, as they may be open again.
+        Orders that were executed after all are removed when next triggered,
+        as they are then found to be no longer open.
+
+        """
+        session.info.pop('executedorders', None)
+
+    def executependingorders(self, prices):
+        """
+        Executes the limit and stop orders triggered by new share prices at
+        those prices. Triggered orders are found with range lookups on the
+        order index rather than by scanning every order, then executed in
+        transactions of at most ORDER_BATCH_SIZE orders. Orders the user can
+        no longer afford or hold enough shares for are marked as failed.
+        Orders are removed from the index once their batch is committed,
+        which within a request session is when the request is committed.
+        Counts of orders triggered and filled, and the time taken, are
+        reported to the log.
+
+        Args:
+            prices (dict): New price of each updated share, keyed by issuer
+                ID.
+        Returns:
+            Dictionary of statistics of the execution, with the keys
+            'resting', 'triggered', 'filled', 'failed' and 'walltime'.
+            Triggered orders that were neither filled nor failed were no
+            longer open.
+
+        """
+        starttime = time.perf_counter()
+        # Bring order index up to date
+        self.loadpendingorders()
+        resting = len(self.orderbook)
+        # Find orders triggered by each new price
+        triggered = list()
+        for issuerID, price in prices.items():
+            triggered.extend(self.orderbook.triggered(issuerID, price))
+        triggered.sort()
+        # Execute triggered orders in batches
+        filled = failed = 0
+        for index in range(0, len(triggered), self.orderbatchsize):
+            batch = triggered[index:index + self.orderbatchsize]
+            # Initialse session
+            with self.sessionmanager() as session:
+                # Get and lock orders still open, as some may have been
+                # cancelled since they were indexed
+                orders = session.query(PendingOrder).filter(
+                    PendingOrder.orderID.in_(batch),
+                    PendingOrder.status == "Open").order_by(
+                    PendingOrder.orderID).with_for_update().all()
+                # Get and lock users of orders, then their usershares,
+                # matching the locking order of other trades
+                users = {user.userID: user for user in session.query(
+                    User).filter(User.userID.in_(
+                        {order.userID for order in orders})).order_by(
+                    User.userID).with_for_update().all()}
+                usershares = dict()
+                if orders:
+                    for usershare in session.query(Usershare).filter(
+                            tuple_(Usershare.userID, Usershare.issuerID).in_(
+                                {(order.userID, order.issuerID)
+                                 for order in orders})).with_for_update():
+                        usershares.setdefault(usershare.userID, dict())[
+                            usershare.issuerID] = usershare
+                for user in users.values():
+                    user.balance = float(user.balance)
+                # Execute each order at the new price if still possible
+                transactiontime = datetime.utcnow()
+                for order in orders:
+                    user = users[order.userID]
+                    holdings = usershares.setdefault(order.userID, dict())
+                    price = prices[order.issuerID]
+                    if order.transtype == 'B':
+                        possible = user.balance >= self.tradecosts(
+                            'B', price, order.quantity)[2]
+                    else:
+                        usershare = holdings.get(order.issuerID)
+                        possible = (usershare is not None and
+                                    usershare.quantity >= order.quantity)
+                    if possible:
+                        self.applytrade(
+                            session, user, holdings, order.issuerID,
+                            order.transtype, order.quantity, price,
+                            transactiontime)
+                        order.status = "Filled"
+                        filled += 1
+                    else:
+                        order.status = "Failed"
+                        failed += 1
+                    order.closedtime = transactiontime
+                # Refresh leaderboard rankings of users with filled orders
+                session.flush()
+                self.refreshrankings(session, [
+                    order.userID for order in orders
+                    if order.status == "Filled"])
+            # Remove batch from index, including orders no longer open,
+            # waiting until a request session is committed if in one
+            if session is getattr(self.requestscope, 'session', None):
+                session.info.setdefault('executedorders', set()).update(
+                    batch)
+            else:
+                for orderID in batch:
+                    self.orderbook.remove(orderID)
+        # Report counts and timing of execution
+        stats = {
+            "resting": resting,
+            "triggered": len(triggered),
+            "filled": filled,
+            "failed": failed,
+            "walltime": time.perf_counter() - starttime
+        }
+        logger.info("Triggered %d of %d resting orders, filled %d and "
+                    "failed %d in %.3f seconds", stats['triggered'],
+                    stats['resting'], stats['filled'], stats['failed'],
+                    stats['walltime'])
+        return stats
+
+    def getusersharesinfo(self, userID=None, orderby=None, order="asc",
+                          offset=0, limit=1000, cursor=None,
+                          countstrategy="exact"):
         """
         Returns all the shares that a user owns along
         with relevant share information as well.
+        Only the columns shown in a portfolio are selected, as plain rows
+        rather than model objects.
 
         Args:
             userID (str): ID of user to get owned shares of.
                 Defaults to None.
             orderby (str): Name of field to sort by.
                 Defaults to None. Specify 'net' to sort by (profit - loss)
+                and 'value' to sort by (currentprice * quantity).
             order (str): How to order, 'asc' for acsending,
                 'desc' for descending. Defaults to "asc"
             offset (int): How many rows to skip of query.
                 Defaults to 0.
             limit (int): How many rows to return of query.
                 Defaults to 1000.
+            cursor (str): Cursor of page to get instead of using offset.
+                Defaults to None.
+            countstrategy (str): How to count results, see countquery.
+                Defaults to "exact".
         Returns:
-            List of shares that user owns with data from
-            usershare and share tables combined.
-            Total number of results that match criteria.
+            List of dicts of the shares that user owns, containing the
+            'userID', 'issuerID', 'quantity', 'currentprice',
+            'daychangepercent', 'daychangeprice', 'net' (profit - loss)
+            and 'value' (currentprice * quantity).
+            Total number of results that match criteria, or None if not
+                counted.
+            Dictionary of cursors of neighbouring pages, see pagequery.
 
         """
+        # Define computed columns
+        net = Usershare.profit - Usershare.loss
+        value = Share.currentprice * Usershare.quantity
         # Initialse session
         with self.sessionmanager() as session:
-            # Get all shares that the user owns combined with share info
-            query = session.query(Usershare, Share).join(Share)
+            # Get columns of shares that the user owns and their share info
+            query = session.query(
+                Usershare.userID, Usershare.issuerID, Usershare.quantity,
+                Share.currentprice, Share.daychangepercent,
+                Share.daychangeprice, net.label('net'), value.label('value')
+            ).join(Share)
             # If specified, filter by user ID
             if(userID):
                 query = query.filter(Usershare.userID == userID)
-            # Order query depending on order parameters
-            # TODO: Make more effiecent by nesting the if statements
-            if(orderby and hasattr(Share, orderby) and order == "asc"):
-                query = query.order_by(asc(getattr(Share, orderby)))
-            elif(orderby and hasattr(Usershare, orderby) and order == "asc"):
-                query = query.order_by(asc(getattr(Usershare, orderby)))
-            elif(orderby and hasattr(Share, orderby) and order == "desc"):
-                query = query.order_by(desc(getattr(Share, orderby)))
-            elif(orderby and hasattr(Usershare, orderby) and order == "desc"):
-                query = query.order_by(desc(getattr(Usershare, orderby)))
-            elif(orderby == "net" and order == "asc"):
-                query = query.order_by(asc(Usershare.profit - Usershare.loss))
-            elif(orderby == "net" and order == "desc"):
-                query = query.order_by(desc(Usershare.profit - Usershare.loss))
-            elif(orderby == "value" and order == "asc"):
-                query = query.order_by(
-                    asc(Share.currentprice * Usershare.quantity))
-            elif(orderby == "value" and order == "desc"):
-                query = query.order_by(
-                    desc(Share.currentprice * Usershare.quantity))
-            else:
-                pass
+            # Get expression to sort by depending on order parameters
+            sortkeys = (self.getsortkeys(Share, orderby) or
+                        self.getsortkeys(Usershare, orderby))
+            if(orderby == "net"):
+                sortkeys = [(net, False)]
+            elif(orderby == "value"):
+                sortkeys = [(value, False)]
             # Get count
-            count = query.count()
-            # Filter query by range
-            query = query.limit(limit).offset(offset)
-            # Get results
-            results = query.all()
-            # Detach all objects from session
-            for result in results:
-                for obj in result:
-                    session.expunge(obj)
-        # Process results into list of combined objects
-        usershares = list()
-        for result in results:
-            # Remove unecessary variables from result dictionaries
-            # and combine result dictionaries into one.
-            result[0].__dict__.pop('_sa_instance_state', None)
-            result[1].__dict__.pop('_sa_instance_state', None)
-            combinedres = {**result[0].__dict__, **result[1].__dict__}
-            usershares.append(combinedres)
-        # Return processed usershares
-        return usershares, count
+            count = self.countquery(session, query, countstrategy)
+            # Get page of results ordered by expression and primary key
+            sortkeys += [(Usershare.userID, False),
+                         (Usershare.issuerID, False)]
+            names = [column['name'] for column in query.column_descriptions]
+            results, cursors = self.pagequery(query, sortkeys, order,
+                                              offset, limit, cursor, count)
+        # Return usershares as dicts of column values
+        usershares = [dict(zip(names, result)) for result in results]
+        return usershares, count, cursors
 
     def gettransactions(self, userID=None, issuerID=None,
                         orderby=None, order="asc", offset=0, limit=1000,
-                        transtype=None):
+                        transtype=None, cursor=None,
+                        countstrategy="exact"):
         """
         Get all transactions for a given user and/or share.
 
@@ -887,10 +2483,16 @@ class DatabaseAPI:
                 Defaults to 1000.
             transtype (str): Restricts sell("S") or buy("B").
                 Defaults to None.
+            cursor (str): Cursor of page to get instead of using offset.
+                Defaults to None.
+            countstrategy (str): How to count results, see countquery.
+                Defaults to "exact".
 
         Returns:
             List of transaction objects that match filter criteria.
-            Total number of results that match criteria.
+            Total number of results that match criteria, or None if not
+                counted.
+            Dictionary of cursors of neighbouring pages, see pagequery.
 
         """
         # Initialse session
@@ -906,26 +2508,18 @@ class DatabaseAPI:
             # If transtype is specified, filter by transtype
             if(transtype):
                 query = query.filter(Transaction.transtype == transtype)
-            # Order query depending on order parameters
-            if(orderby and hasattr(Transaction, orderby) and
-               order == "asc"):
-                query = query.order_by(asc(getattr(Transaction, orderby)))
-            elif(orderby and hasattr(Transaction, orderby) and
-                 order == "desc"):
-                query = query.order_by(desc(getattr(Transaction, orderby)))
-            else:
-                pass
             # Get count
-            count = query.count()
-            # Filter query by range
-            query = query.limit(limit).offset(offset)
-            # Get query results
-            results = query.all()
+            count = self.countquery(session, query, countstrategy)
+            # Get page of transactions ordered by field and transaction ID
+            sortkeys = (self.getsortkeys(Transaction, orderby) +
+                        [(Transaction.transID, False)])
+            results, cursors = self.pagequery(query, sortkeys, order,
+                                              offset, limit, cursor, count)
             # Detach all objects from session
             for result in results:
                 session.expunge(result)
         # Return resulting list
-        return results, count
+        return results, count, cursors
 
     def banuser(self, userID):
         """
@@ -973,79 +2567,193 @@ class DatabaseAPI:
         # Return success
         return True
 
-    def getuserstatistics(self):
+    def getuserstatistics(self, activitydays=30):
         """
         Queries, calculates and returns different user statistics.
-        TODO: Potentially move different statistics into seperate methods.
+        User statistics are counted in a single pass over the user table,
+        and trading statistics in a single pass over recent transactions.
+        Results are cached for STATISTICS_CACHE_SECONDS.
 
+        Args:
+            activitydays (int): Number of days of transactions to calculate
+                trading statistics from. Defaults to 30.
         Returns:
             A dictionary of statistics as follows:
             - Gender distribution as 'gendercounts' dict that contains the
                 integer count for each gender, male, female and other.
             - Age group distribution as 'agegroupcounts' dict that contains the
-                integer count for each age group of '0to12', '13to17',
-                '18to25' and '26toinf'.
+                integer count for each age group of 'post-mil', 'mil',
+                'gen-x', 'baby-boom', 'silent-gen' and 'greatest-gen'.
+            - Trading activity as 'tradingactivity' dict that contains
+                'days', the number of days covered, 'activetraders', the
+                number of users that traded, 'trades', 'purchases',
+                'sales', 'volume', the number of shares traded, 'value',
+                the value of shares traded, and 'tradesperday', a list of
+                dicts of 'day', 'trades' and 'volume' for each day with
+                trades, oldest first.
 
         """
+        # Return cached statistics if present
+        statistics = self.statisticscache.get(('userstatistics',
+                                               activitydays))
+        if statistics is not None:
+            return statistics
+
+        # Define condition counted by each statistic
+        genders = {
+            'male': User.gender == 'M',
+            'female': User.gender == 'F',
+            'other': User.gender == 'O'
+        }
+        bounds = [('post-mil', datetime(1997, 1, 1)),
+                  ('mil', datetime(1981, 1, 1)),
+                  ('gen-x', datetime(1965, 1, 1)),
+                  ('baby-boom', datetime(1946, 1, 1)),
+                  ('silent-gen', datetime(1928, 1, 1)),
+                  ('greatest-gen', None)]
+        agegroups = dict()
+        for (name, start), (_, end) in zip(bounds, [(None, None)] + bounds):
+            # Each age group is born on or after its start and before the
+            # start of the next youngest group
+            conditions = list()
+            if start is not None:
+                conditions.append(User.dob >= start)
+            if end is not None:
+                conditions.append(User.dob < end)
+            agegroups[name] = and_(*conditions)
+
+        # Counts the rows matching a condition
+        def countof(condition):
+            return func.coalesce(func.sum(case([(condition, 1)], else_=0)), 0)
+        # Define transactions counted by trading statistics
+        starttime = datetime.utcnow() - timedelta(days=activitydays)
+        recent = Transaction.datetime >= starttime
+        day = func.date(Transaction.datetime)
         # Initialse session
         with self.sessionmanager() as session:
-            # Query all users
-            userquery = session.query(User)
-            # Get user count
-            usercount = userquery.count()
-
-            # Initialise statistics
-            statistics = dict()
-            # Get gender distribution
-            statistics['gendercounts'] = {
-                'male': userquery.filter(
-                    User.gender == 'M').count(),
-                'female': userquery.filter(
-                    User.gender == 'F').count(),
-                'other': userquery.filter(
-                    User.gender == 'O').count()
-            }
-            # Get age group distribution
-            statistics['agegroupcounts'] = {
-                'post-mil': userquery.filter(
-                        User.dob >= datetime(1997, 1, 1)
-                    ).count(),
-                'mil': userquery.filter(
-                        User.dob < datetime(1997, 1, 1)
-                    ).filter(
-                        User.dob >= datetime(1981, 1, 1)
-                    ).count(),
-                'gen-x': userquery.filter(
-                        User.dob < datetime(1981, 1, 1)
-                    ).filter(
-                        User.dob >= datetime(1965, 1, 1)
-                    ).count(),
-                'baby-boom': userquery.filter(
-                        User.dob < datetime(1965, 1, 1)
-                    ).filter(
-                        User.dob >= datetime(1946, 1, 1)
-                    ).count(),
-                'silent-gen': userquery.filter(
-                        User.dob < datetime(1946, 1, 1)
-                    ).filter(
-                        User.dob >= datetime(1928, 1, 1)
-                    ).count(),
-                'greatest-gen': userquery.filter(
-                        User.dob < datetime(1928, 1, 1)
-                    ).count()
-            }
-
-            # Return statistics
-            return statistics
+            # Count users of each gender and age group in one pass
+            counts = session.query(
+                *[countof(condition).label(name) for name, condition in
+                  list(genders.items()) + list(agegroups.items())]).one()
+            # Count trading activity in one pass
+            activity = session.query(
+                func.count(func.distinct(Transaction.userID)).label(
+                    'activetraders'),
+                func.count(Transaction.transID).label('trades'),
+                countof(Transaction.transtype == 'B').label('purchases'),
+                countof(Transaction.transtype == 'S').label('sales'),
+                func.coalesce(func.sum(Transaction.quantity), 0).label(
+                    'volume'),
+                func.coalesce(func.sum(Transaction.stocktransval), 0).label(
+                    'value')
+            ).filter(recent).one()
+            # Count trades on each day
+            tradesperday = session.query(
+                day.label('day'),
+                func.count(Transaction.transID).label('trades'),
+                func.sum(Transaction.quantity).label('volume')
+            ).filter(recent).group_by(day).order_by(day).all()
+
+        # Initialise statistics
+        statistics = dict()
+        # Get gender distribution
+        statistics['gendercounts'] = {
+            name: int(getattr(counts, name)) for name in genders}
+        # Get age group distribution
+        statistics['agegroupcounts'] = {
+            name: int(getattr(counts, name)) for name in agegroups}
+        # Get trading activity
+        statistics['tradingactivity'] = {
+            'days': activitydays,
+            'activetraders': int(activity.activetraders),
+            'trades': int(activity.trades),
+            'purchases': int(activity.purchases),
+            'sales': int(activity.sales),
+            'volume': int(activity.volume),
+            'value': float(activity.value),
+            'tradesperday': [{
+                'day': str(row.day),
+                'trades': int(row.trades),
+                'volume': int(row.volume)
+            } for row in tradesperday]
+        }
+        # Cache and return statistics
+        self.statisticscache.set(('userstatistics', activitydays),
+                                 statistics)
+        return statistics
+
+    def refreshrankings(self, session, userIDs=None):
+        """
+        Recalculates the share value, balance and total value of users in
+        the ranking table with a single INSERT ... SELECT, so no user rows
+        are loaded into python. The caller should pass the active session,
+        and should have locked the rows of given users. A full refresh
+        takes a shared lock on every user first, so it waits for trades in
+        progress rather than deadlocking with them.
+
+        Args:
+            session: Session to refresh rankings in.
+            userIDs (list): IDs of users to refresh.
+                Defaults to None, refreshing every user.
+        Returns:
+            Number of rankings written.
 
-    def getleaderboard(self, current_userID):
         """
-        Get users and fields needed for a leaderboard preordered.
+        # Calculate values of each user from their usershares
+        sharesvalue = func.coalesce(
+            func.sum(Usershare.quantity * Share.currentprice), 0)
+        query = select([
+            User.userID,
+            sharesvalue,
+            User.balance,
+            User.balance + sharesvalue,
+            literal(datetime.utcnow(), DateTime)
+        ]).select_from(
+            User.__table__.outerjoin(Usershare.__table__).outerjoin(
+                Share.__table__)
+        ).group_by(User.userID)
+        delete = Ranking.__table__.delete()
+        if userIDs is None:
+            # Lock every user before their rankings
+            session.query(func.count(User.userID)).with_for_update(
+                read=True).scalar()
+        else:
+            # Limit refresh to given users
+            if not userIDs:
+                return 0
+            query = query.where(User.userID.in_(userIDs))
+            delete = delete.where(Ranking.userID.in_(userIDs))
+        # Replace rankings with recalculated values
+        session.execute(delete)
+        result = session.execute(Ranking.__table__.insert().from_select(
+            ['userID', 'sharesvalue', 'balance', 'totalvalue',
+             'updatedtime'], query))
+        self.discardcounts(Ranking)
+        return result.rowcount
+
+    def getleaderboard(self, current_userID, limit=10, offset=0,
+                       neighbours=2):
+        """
+        Get a page of the leaderboard, along with the current user and the
+        users ranked either side of them, read from the ranking table kept
+        up to date by refreshrankings. Rankings are calculated by the
+        database with RANK(), so users with equal total values share a
+        ranking. The page is ranked over only the users up to the end of
+        the page, read in order from the index on total value, which gives
+        the same rankings as ranking every user since every user ranked
+        above a user is within them.
 
         Args:
             current_userID (str): The ID of the logged in user.
+            limit (int): Number of users in page.
+                Defaults to 10. None returns every user.
+            offset (int): Number of users to skip before page.
+                Defaults to 0.
+            neighbours (int): Number of users either side of the current
+                user to return. Defaults to 2.
         Returns:
-            A list of dictionary results for the leaderboard ordered by total.
+            A list of dictionary results for the page of the leaderboard
+            ordered by total.
             The returned format is:
                 result.userID: ID of the user.
                 result.username: Username of the user.
@@ -1053,79 +2761,175 @@ class DatabaseAPI:
                 result.balance: Current balance for user.
                 result.totalvalue: Total shares values and user balance.
                 result.ranking: Ranking of the user by totalvalue,
-            A dictionary of results for the current user
+            A dictionary of results for the current user, None if the user
+            doesn't exist. Also contains neighbours, a list of results for
+            the users ranked either side of them in order, including them.
+            Total number of users on the leaderboard.
 
         """
+        # Define fields of leaderboard rows
+        fields = (Ranking.userID, User.username, Ranking.sharesvalue,
+                  Ranking.balance, Ranking.totalvalue)
         # Initialse session
         with self.sessionmanager() as session:
-            # Query all the shares and user shares
-            query = session.query(
-                User.userID,
-                User.username,
-                func.ifnull(func.sum(Usershare.quantity * Share.currentprice),
-                            0).label("sharesvalue"),
-                User.balance,
-                func.ifnull(func.sum(Usershare.quantity * Share.currentprice) +
-                            User.balance, User.balance).label("totalvalue")
-            )
-            # Outer join query with usershare and share tables
-            query = query.outerjoin(Usershare).outerjoin(Share)
-            # Group the query by user ID
-            query = query.group_by(User.userID)
-            # Order the query by total
-            query = query.order_by(desc("totalvalue"))
-            # Get the results
-            result = query.all()
-
-            leaderboard = []
-            rankiterator = 1
-            for row in result:
-                dictionary = {
-                    'userID': row.userID,
-                    'username': row.username,
-                    'sharesvalue': row.sharesvalue,
-                    'balance': row.balance,
-                    'totalvalue': row.totalvalue,
-                    'ranking': rankiterator}
-
-                if row.userID == current_userID:
-                    current_user_info = dictionary
-
-                leaderboard.append(dictionary)
-
-                rankiterator = rankiterator + 1
+            # Fill rankings if they have never been refreshed
+            if session.query(Ranking.userID).first() is None:
+                self.refreshrankings(session)
+            # Get current user's row, refreshing it if user has no ranking
+            # yet, such as after registering
+            current = session.query(Ranking.totalvalue).filter(
+                Ranking.userID == current_userID).first()
+            if current is None:
+                self.refreshrankings(session, [current_userID])
+                current = session.query(Ranking.totalvalue).filter(
+                    Ranking.userID == current_userID).first()
+            # Get users up to end of page in order
+            query = session.query(*fields).join(
+                User, User.userID == Ranking.userID).order_by(
+                desc(Ranking.totalvalue), Ranking.userID)
+            if limit is not None:
+                query = query.limit(offset + limit)
+            top = query.subquery()
+            # Rank users and get those in page
+            ranked = session.query(
+                top,
+                func.rank().over(
+                    order_by=desc(top.c.totalvalue)).label('ranking'),
+                func.row_number().over(
+                    order_by=(desc(top.c.totalvalue),
+                              top.c.userID)).label('position')
+            ).subquery()
+            leaderboard = [{
+                'userID': row.userID,
+                'username': row.username,
+                'sharesvalue': row.sharesvalue,
+                'balance': row.balance,
+                'totalvalue': row.totalvalue,
+                'ranking': row.ranking
+            } for row in session.query(ranked).filter(
+                ranked.c.position > offset).order_by(ranked.c.position)]
+            current_user_info = None
+            if current is not None:
+                # Rank users by counting users with a greater total value
+                other = aliased(Ranking)
+                ranking = session.query(func.count(other.userID)).filter(
+                    other.totalvalue > Ranking.totalvalue).correlate(
+                    Ranking).as_scalar() + 1
+                query = session.query(*fields, ranking.label('ranking')).join(
+                    User, User.userID == Ranking.userID)
+                # Get users ordered before current user, nearest first
+                before = or_(Ranking.totalvalue > current.totalvalue,
+                             and_(Ranking.totalvalue == current.totalvalue,
+                                  Ranking.userID < current_userID))
+                above = query.filter(before).order_by(
+                    asc(Ranking.totalvalue), desc(Ranking.userID)).limit(
+                    neighbours).all()
+                # Get current user and users ordered after them
+                below = query.filter(~before).order_by(
+                    desc(Ranking.totalvalue), Ranking.userID).limit(
+                    neighbours + 1).all()
+                rows = [row._asdict() for row in reversed(above)]
+                rows.extend(row._asdict() for row in below)
+                current_user_info = rows[len(above)]
+                current_user_info['neighbours'] = rows
+            # Get number of users on leaderboard
+            count = session.query(func.count(Ranking.userID)).scalar()
 
         # Return leaderboard
-        return leaderboard, current_user_info
+        return leaderboard, current_user_info, count
 
     def updateleaderboard(self):
         """
-        Update leaderboard table with current totalvalues and rankings
-        """
-        # TODO Remove magic number
-        leaderboard, user = DatabaseAPI.getleaderboard(self, 1)
-        with self.sessionmanager() as session:
+        Update leaderboard table with current totalvalues and rankings.
+        Every user's snapshot is written by a single INSERT ... SELECT from
+        the ranking table, with rankings calculated by RANK() in the
+        database, so no rows are loaded into python.
 
-            recordtime = datetime.utcnow()
+        Returns:
+            Number of snapshots written.
 
-            for row in leaderboard:
-                user = Leaderboard(
-                    userID=row['userID'],
-                    recordtime=recordtime,
-                    ranking=row['ranking'],
-                    totalvalue=row['totalvalue']
-                )
-                session.add(user)
-            # Create leaderboard entry
+        """
+        # Initialse session
+        with self.sessionmanager() as session:
+            # Fill rankings if they have never been refreshed
+            if session.query(Ranking.userID).first() is None:
+                self.refreshrankings(session)
+            # Snapshot every user's total value and ranking at the same time
+            query = select([
+                Ranking.userID,
+                literal(datetime.utcnow(), DateTime),
+                func.rank().over(order_by=desc(Ranking.totalvalue)),
+                Ranking.totalvalue
+            ])
+            result = session.execute(
+                Leaderboard.__table__.insert().from_select(
+                    ['userID', 'recordtime', 'ranking', 'totalvalue'], query))
+            self.discardcounts(Leaderboard)
+        # Return number of snapshots written
+        return result.rowcount
+
+    def compactleaderboard(self):
+        """
+        Thins out leaderboard history, keeping every snapshot from the last
+        LEADERBOARD_HOURLY_DAYS days and only the last snapshot of each day
+        before that. Snapshots are deleted in transactions of at most
+        LEADERBOARD_COMPACT_BATCH_SIZE rows, so the table isn't locked for
+        long. Each batch is committed in its own session, even when called
+        within a request session.
 
-        # Return success
-        return True
+        Returns:
+            Number of snapshot times removed.
+            Number of snapshot rows deleted.
 
-    def gettopgainers(self):
+        """
+        cutoff = datetime.utcnow() - timedelta(days=self.leaderboardhourlydays)
+        # Initialse session
+        with self.sessionmanager(join=False) as session:
+            # Get times of snapshots before cutoff, using index on time
+            recordtimes = [row.recordtime for row in session.query(
+                Leaderboard.recordtime).filter(
+                Leaderboard.recordtime < cutoff).distinct()]
+        # Keep last snapshot of each day, removing the others
+        lastofday = dict()
+        for recordtime in recordtimes:
+            day = recordtime.date()
+            lastofday[day] = max(lastofday.get(day, recordtime), recordtime)
+        removed = sorted(set(recordtimes) - set(lastofday.values()))
+        # Delete snapshots of each removed time in batches
+        deleted = 0
+        for recordtime in removed:
+            while True:
+                # Commit each batch on its own
+                with self.sessionmanager(join=False) as session:
+                    userIDs = [row.userID for row in session.query(
+                        Leaderboard.userID).filter(
+                        Leaderboard.recordtime == recordtime).limit(
+                        self.leaderboardbatchsize)]
+                    if userIDs:
+                        session.query(Leaderboard).filter(
+                            Leaderboard.recordtime == recordtime,
+                            Leaderboard.userID.in_(userIDs)).delete(
+                            synchronize_session=False)
+                deleted += len(userIDs)
+                if len(userIDs) < self.leaderboardbatchsize:
+                    break
+        # Report and return amount of history removed
+        logger.info("Compacted leaderboard, deleting %d snapshots at %d "
+                    "times", deleted, len(removed))
+        return len(removed), deleted
+
+    def gettopgainers(self, limit=10):
         """
         Get users and fields needed for topgainers leaderboard preordered
-        by totalvalue.
+        by totalvalue. Gains are calculated from each user's current value
+        in the ranking table and the latest leaderboard snapshot at least a
+        week ago, or at least a month ago, searching back up to two days.
+        Both periods are calculated by a single query that returns only the
+        top users of each.
 
+        Args:
+            limit (int): Number of top users to return for each period.
+                Defaults to 10.
         Returns:
             A list of dictionary results for the topgainers over a week
             ordered by changeinvalue.
@@ -1141,75 +2945,59 @@ class DatabaseAPI:
                     time period
 
         """
-        # TODO Remove magic number
-        currentleaderboard, user = DatabaseAPI.getleaderboard(self, 1)
-
+        currentdate = datetime.utcnow()
+        # Define query of top gainers since given number of days ago
+        periodqueries = list()
+        for days in (7, 30):
+            # Get time of latest snapshot in the two days before, found with
+            # the index on record time. Every user is recorded at the same
+            # time by updateleaderboard, so this is each user's closest
+            # snapshot. Two days are searched so that a snapshot is found
+            # where only one snapshot per day is kept by compactleaderboard.
+            snapshottime = select([func.max(Leaderboard.recordtime)]).where(
+                Leaderboard.recordtime.between(
+                    currentdate - timedelta(days=days + 2),
+                    currentdate - timedelta(days=days))).as_scalar()
+            # Compare current values against snapshot values
+            changeinvalue = Ranking.totalvalue - Leaderboard.totalvalue
+            periodqueries.append(select([
+                literal(days).label('days'),
+                User.username,
+                changeinvalue.label('changeinvalue'),
+                Ranking.totalvalue.label('currentvalue'),
+                Leaderboard.totalvalue.label('previousvalue')
+            ]).select_from(
+                Leaderboard.__table__.join(
+                    Ranking, Ranking.userID == Leaderboard.userID
+                ).join(
+                    User, User.userID == Leaderboard.userID)
+            ).where(
+                Leaderboard.recordtime == snapshottime
+            ).order_by(desc(changeinvalue)).limit(limit).alias())
+        # Combine top gainers of both periods into one query
+        query = select([periodqueries[0]]).union_all(
+            select([periodqueries[1]]))
+        # Initialse session
         with self.sessionmanager() as session:
-
-            currentdate = datetime.utcnow()
-            lowertdelta = timedelta(days=7)
-            uppertdelta = timedelta(days=8)
-
-            # Creates a date a week prior to current time
-            lowerdatelimit = currentdate - lowertdelta
-            # Creates a date a week + 1 day prior to currrent time
-            upperdatelimit = currentdate - uppertdelta
-            # Get week top gainers
-            weektopgainers = []
-            query = session.query(Leaderboard).filter(
-                Leaderboard.recordtime.between(upperdatelimit, lowerdatelimit))
-            for row in currentleaderboard:
-                result = query.filter(
-                    Leaderboard.userID == row['userID']).first()
-                if result is not None:
-                    dictionary = {
-                        'username': row['username'],
-                        'changeinvalue': round((
-                            row['totalvalue'] - result.totalvalue), 4),
-                        'changepercentage': round(((
-                            row['totalvalue'] - result.totalvalue
-                            )/result.totalvalue) * 100, 4),
-                        'currentvalue': row['totalvalue'],
-                        'previousvalue': result.totalvalue}
-                    weektopgainers.append(dictionary)
-
-            weektopgainers.sort(
-                key=operator.itemgetter('changeinvalue'), reverse=True)
-
-            currentdate = datetime.utcnow()
-            lowertdelta = timedelta(days=30)
-            uppertdelta = timedelta(days=31)
-
-            # Creates a date a month prior to current time
-            lowerdatelimit = currentdate - lowertdelta
-            # Creates a date a month + 1 day prior to currrent time
-            upperdatelimit = currentdate - uppertdelta
-
-            query = session.query(Leaderboard).filter(
-                Leaderboard.recordtime.between(upperdatelimit, lowerdatelimit))
-            monthtopgainers = []
-
-            for row in currentleaderboard:
-                result = query.filter(
-                    Leaderboard.userID == row['userID']).first()
-
-                if result is not None:
-                    dictionary = {
-                        'username': row['username'],
-                        'changeinvalue': round(
-                            (row['totalvalue'] - result.totalvalue), 4),
-                        'changepercentage': round(((
-                            row['totalvalue'] - result.totalvalue
-                            )/result.totalvalue) * 100, 4),
-                        'currentvalue': row['totalvalue'],
-                        'previousvalue': result.totalvalue}
-                    monthtopgainers.append(dictionary)
-
-            monthtopgainers.sort(
-                key=operator.itemgetter('changeinvalue'), reverse=True)
-            session.expunge_all()
-
-            return weektopgainers, monthtopgainers
+            rows = session.execute(query).fetchall()
+        # Parse results into dictionaries for each period
+        topgainers = {7: list(), 30: list()}
+        for row in rows:
+            currentvalue = float(row.currentvalue)
+            previousvalue = float(row.previousvalue)
+            topgainers[row.days].append({
+                'username': row.username,
+                'changeinvalue': round(currentvalue - previousvalue, 4),
+                'changepercentage': round((
+                    currentvalue - previousvalue) / previousvalue * 100, 4)
+                if previousvalue else 0.0,
+                'currentvalue': currentvalue,
+                'previousvalue': previousvalue})
+        # Order results, since the union of both periods isn't ordered
+        for gainers in topgainers.values():
+            gainers.sort(key=operator.itemgetter('changeinvalue'),
+                         reverse=True)
+        return topgainers[7], topgainers[30]
 
     def gettipofday(self):
         """
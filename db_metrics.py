@@ -0,0 +1,334 @@
+"""
+Database metrics used to size the connection pool, spot pool exhaustion and
+find routes that run too many or too slow queries.
+
+Checkouts, new connections and invalidations are counted by pool event
+listeners. The time spent waiting for a connection is not covered by any
+pool event, so engines are created with MeasuredQueuePool, which times each
+connection request and reports it to the metrics of the pool.
+
+Queries are counted and timed by cursor execute event listeners, for each
+unit of work, such as a web request, recorded between begin and end calls
+on the same thread.
+
+"""
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+import threading
+import time
+
+
+class MeasuredQueuePool(QueuePool):
+    """
+    Queue pool that reports the time taken to get each connection, including
+    waiting for a free connection and connecting, to its pool metrics.
+
+    """
+    # Metrics reported to, set by PoolMetrics.attach
+    metrics = None
+
+    def connect(self):
+        # Time getting connection, including failures such as timeouts
+        start = time.perf_counter()
+        timedout = False
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            timedout = True
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.recordwait(time.perf_counter() - start,
+                                        timedout)
+
+    def recreate(self):
+        # Keep reporting to the same metrics after the pool is recreated
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class PoolMetrics:
+    """
+    Thread safe counters of the connection pool activity of an engine.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engine = None
+        self.reset()
+
+    def reset(self):
+        """
+        Resets every counter to zero.
+
+        """
+        with self.lock:
+            self.startedtime = time.time()
+            self.checkouts = 0
+            self.overflowcheckouts = 0
+            self.peakcheckedout = 0
+            self.peakoverflow = 0
+            self.connects = 0
+            self.invalidations = 0
+            self.waits = 0
+            self.waittime = 0.0
+            self.maxwaittime = 0.0
+            self.timeouts = 0
+
+    def attach(self, engine):
+        """
+        Starts counting the pool activity of an engine.
+
+        Args:
+            engine: SQLAlchemy engine, ideally created with MeasuredQueuePool
+                so that connection wait times are also counted.
+
+        """
+        self.engine = engine
+        if isinstance(engine.pool, MeasuredQueuePool):
+            engine.pool.metrics = self
+        # Pool events on the engine also apply to recreated pools
+        event.listen(engine, 'connect', self.onconnect)
+        event.listen(engine, 'checkout', self.oncheckout)
+        event.listen(engine, 'invalidate', self.oninvalidate)
+        event.listen(engine, 'soft_invalidate', self.oninvalidate)
+
+    def onconnect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def oncheckout(self, dbapi_connection, connection_record,
+                   connection_proxy):
+        # Get pool usage, which only queue pools report
+        pool = self.engine.pool
+        checkedout = getattr(pool, 'checkedout', lambda: 0)()
+        overflow = max(getattr(pool, 'overflow', lambda: 0)(), 0)
+        with self.lock:
+            self.checkouts += 1
+            if overflow > 0:
+                self.overflowcheckouts += 1
+            self.peakcheckedout = max(self.peakcheckedout, checkedout)
+            self.peakoverflow = max(self.peakoverflow, overflow)
+
+    def oninvalidate(self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.invalidations += 1
+
+    def recordwait(self, seconds, timedout=False):
+        """
+        Records the time taken to get a connection from the pool.
+
+        Args:
+            seconds (float): Time taken.
+            timedout (bool): Whether no connection was available in time.
+
+        """
+        with self.lock:
+            self.waits += 1
+            self.waittime += seconds
+            self.maxwaittime = max(self.maxwaittime, seconds)
+            if timedout:
+                self.timeouts += 1
+
+    def snapshot(self):
+        """
+        Gets the current pool state and counters.
+
+        Returns:
+            A dictionary of the pool 'size', connections 'checkedout' and
+            'checkedin', 'overflow' connections in use, and since the
+            counters were last reset, the number of 'checkouts',
+            'overflowcheckouts' made while using overflow connections,
+            'peakcheckedout', 'peakoverflow', new 'connects',
+            'invalidations', 'timeouts', and the 'meanwaitms' and
+            'maxwaitms' taken to get a connection, along with 'seconds'
+            since the counters were reset.
+
+        """
+        pool = self.engine.pool if self.engine is not None else None
+        status = dict()
+        for name in ('size', 'checkedout', 'checkedin', 'overflow'):
+            status[name] = getattr(pool, name, lambda: 0)()
+        status['overflow'] = max(status['overflow'], 0)
+        with self.lock:
+            status.update({
+                'seconds': round(time.time() - self.startedtime),
+                'checkouts': self.checkouts,
+                'overflowcheckouts': self.overflowcheckouts,
+                'peakcheckedout': self.peakcheckedout,
+                'peakoverflow': self.peakoverflow,
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+                'timeouts': self.timeouts,
+                'meanwaitms': round(1000 * self.waittime /
+                                    max(self.waits, 1), 3),
+                'maxwaitms': round(1000 * self.maxwaittime, 3)
+            })
+        return status
+
+
+class QueryMetrics:
+    """
+    Thread safe counts and times of the queries run by each unit of work,
+    such as a web request, aggregated by endpoint.
+
+    """
+    def __init__(self, slowest=3):
+        """
+        Initialise metrics.
+
+        Args:
+            slowest (int): Number of slowest statements kept for each unit of
+                work and each endpoint. Defaults to 3.
+
+        """
+        self.slowest = slowest
+        self.lock = threading.Lock()
+        # Queries of the unit of work being recorded on each thread
+        self.current = threading.local()
+        # Aggregated metrics of each endpoint
+        self.endpoints = dict()
+
+    def attach(self, engine):
+        """
+        Starts counting the queries run by an engine.
+
+        Args:
+            engine: SQLAlchemy engine.
+
+        """
+        event.listen(engine, 'before_cursor_execute', self.beforeexecute)
+        event.listen(engine, 'after_cursor_execute', self.afterexecute)
+        event.listen(engine, 'handle_error', self.onerror)
+
+    def beforeexecute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        # Record start of statement, stacked in case of nested statements
+        conn.info.setdefault('querystarttimes', list()).append(
+            time.perf_counter())
+
+    def afterexecute(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        # Get time taken by statement
+        elapsed = time.perf_counter() - conn.info['querystarttimes'].pop()
+        # Add statement to the unit of work recorded on this thread, if any
+        record = getattr(self.current, 'record', None)
+        if record is None:
+            return
+        record['queries'] += 1
+        record['dbtime'] += elapsed
+        keepslowest(record['slowest'], (elapsed, statement), self.slowest)
+
+    def onerror(self, context):
+        # Discard start of failed statement
+        if context.connection is not None:
+            starttimes = context.connection.info.get('querystarttimes')
+            if starttimes:
+                starttimes.pop()
+
+    def begin(self):
+        """
+        Starts recording the queries run on this thread, discarding any
+        recording not ended.
+
+        """
+        self.current.record = {'queries': 0, 'dbtime': 0.0,
+                               'slowest': list()}
+
+    def end(self, endpoint=None):
+        """
+        Stops recording the queries run on this thread, adding them to the
+        metrics of an endpoint.
+
+        Args:
+            endpoint (str): Name of endpoint the queries are counted for, or
+                None to not aggregate them.
+        Returns:
+            A dictionary of the number of 'queries', the total 'dbms' time
+            taken in milliseconds, and the 'slowest' statements as a list of
+            (milliseconds, statement) tuples, slowest first.
+            None if no queries were being recorded.
+
+        """
+        # Get and clear recording of this thread
+        record = getattr(self.current, 'record', None)
+        if record is None:
+            return None
+        self.current.record = None
+        # Add to aggregated metrics of endpoint
+        if endpoint is not None:
+            with self.lock:
+                metrics = self.endpoints.setdefault(endpoint, {
+                    'requests': 0, 'queries': 0, 'maxqueries': 0,
+                    'dbtime': 0.0, 'maxdbtime': 0.0, 'slowest': list()})
+                metrics['requests'] += 1
+                metrics['queries'] += record['queries']
+                metrics['maxqueries'] = max(metrics['maxqueries'],
+                                            record['queries'])
+                metrics['dbtime'] += record['dbtime']
+                metrics['maxdbtime'] = max(metrics['maxdbtime'],
+                                           record['dbtime'])
+                for query in record['slowest']:
+                    keepslowest(metrics['slowest'], query, self.slowest)
+        # Return metrics of recording
+        return {
+            'queries': record['queries'],
+            'dbms': round(1000 * record['dbtime'], 3),
+            'slowest': [(round(1000 * elapsed, 3), statement)
+                        for elapsed, statement in record['slowest']]
+        }
+
+    def reset(self):
+        """
+        Removes the aggregated metrics of every endpoint.
+
+        """
+        with self.lock:
+            self.endpoints.clear()
+
+    def snapshot(self):
+        """
+        Gets the aggregated metrics of every endpoint.
+
+        Returns:
+            A list of dictionaries for each endpoint containing the
+            'endpoint' name, number of 'requests', 'meanqueries' and
+            'maxqueries' per request, 'meandbms' and 'maxdbms' time taken per
+            request, 'totaldbms' and the 'slowest' statements as a list of
+            (milliseconds, statement) tuples, ordered by total time taken.
+
+        """
+        with self.lock:
+            endpoints = [{
+                'endpoint': endpoint,
+                'requests': metrics['requests'],
+                'meanqueries': round(
+                    metrics['queries'] / metrics['requests'], 1),
+                'maxqueries': metrics['maxqueries'],
+                'meandbms': round(
+                    1000 * metrics['dbtime'] / metrics['requests'], 3),
+                'maxdbms': round(1000 * metrics['maxdbtime'], 3),
+                'totaldbms': round(1000 * metrics['dbtime'], 3),
+                'slowest': [(round(1000 * elapsed, 3), statement)
+                            for elapsed, statement in metrics['slowest']]
+            } for endpoint, metrics in self.endpoints.items()]
+        # Order by total time taken, highest first
+        endpoints.sort(key=lambda metrics: metrics['totaldbms'],
+                       reverse=True)
+        return endpoints
+
+
+def keepslowest(slowest, query, count):
+    """
+    Adds a query to a list of the slowest queries if it is one of the slowest.
+
+    Args:
+        slowest (list): (seconds, statement) tuples, slowest first.
+        query (tuple): (seconds, statement) tuple of the query.
+        count (int): Number of queries kept.
+
+    """
+    slowest.append(query)
+    slowest.sort(key=lambda query: query[0], reverse=True)
+    del slowest[count:]
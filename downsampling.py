@@ -0,0 +1,123 @@
+"""
+Shape preserving downsampling of time series, used to reduce the number of
+points sent for price graphs to roughly what can actually be drawn.
+
+Both methods take parallel sequences of times and values ordered by time,
+where times are numbers such as epoch seconds, and return the indices of
+the points to keep in ascending order.
+
+"""
+import numpy as np
+
+# Fewest points a series can be downsampled to, being the first and last
+# points and at least one point between them
+MINTHRESHOLD = 3
+
+
+def lttb(times, values, threshold):
+    """
+    Downsamples a time series using Largest-Triangle-Three-Buckets.
+    The first and last points are always kept, and every other bucket keeps
+    the point forming the largest triangle with the point kept from the
+    previous bucket and the average of the next bucket. Only the choice of
+    point per bucket is sequential, so the work done in python grows with
+    the threshold rather than with the number of points.
+
+    Args:
+        times (sequence): Times of points, ordered ascending.
+        values (sequence): Values of points.
+        threshold (int): Number of points to keep, at least MINTHRESHOLD.
+    Returns:
+        Numpy array of indices of the points to keep.
+    Raises:
+        ValueError: If threshold is less than MINTHRESHOLD.
+
+    """
+    if(threshold < MINTHRESHOLD):
+        raise ValueError(f"threshold must be at least {MINTHRESHOLD}")
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    count = len(times)
+    # Keep every point if there are not enough to downsample
+    if threshold >= count:
+        return np.arange(count)
+    # Split all points except first and last into buckets
+    edges = np.linspace(1, count - 1, threshold - 1).astype(np.int64)
+    # Calculate average point of each bucket, with the last point standing
+    # in as the bucket after the last one
+    sums = np.add.reduceat(times[1:count - 1], edges[:-1] - 1)
+    lengths = np.diff(edges)
+    averagetimes = np.append(sums / lengths, times[-1])
+    sums = np.add.reduceat(values[1:count - 1], edges[:-1] - 1)
+    averagevalues = np.append(sums / lengths, values[-1])
+    # Choose the point in each bucket forming the largest triangle
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = count - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        buckettimes = times[start:end]
+        bucketvalues = values[start:end]
+        areas = np.abs(
+            (times[previous] - averagetimes[bucket + 1]) *
+            (bucketvalues - values[previous]) -
+            (times[previous] - buckettimes) *
+            (averagevalues[bucket + 1] - values[previous]))
+        previous = start + int(np.argmax(areas))
+        indices[bucket + 1] = previous
+    # Return chosen indices
+    return indices
+
+
+def minmax(times, values, threshold):
+    """
+    Downsamples a time series by keeping the minimum and maximum point of
+    equally sized buckets, along with the first and last points. Fully
+    vectorised, so no python work is done per bucket.
+
+    Args:
+        times (sequence): Times of points, ordered ascending.
+        values (sequence): Values of points.
+        threshold (int): Number of points to keep, at most. At least
+            MINTHRESHOLD, though with fewer than 4 only the first and last
+            points are kept, as each bucket keeps two points.
+    Returns:
+        Numpy array of indices of the points to keep.
+    Raises:
+        ValueError: If threshold is less than MINTHRESHOLD.
+
+    """
+    if(threshold < MINTHRESHOLD):
+        raise ValueError(f"threshold must be at least {MINTHRESHOLD}")
+    values = np.asarray(values, dtype=np.float64)
+    count = len(values)
+    # Keep every point if there are not enough to downsample
+    if threshold >= count:
+        return np.arange(count)
+    # Keep only the first and last points if there is no room for a bucket
+    if threshold < 4:
+        return np.array([0, count - 1])
+    # Split points into equally sized buckets, keeping two points per bucket
+    bucketcount = (threshold - 2) // 2
+    starts = (np.arange(bucketcount) * count) // bucketcount
+    lengths = np.diff(np.append(starts, count))
+    # Find minimum and maximum value of each bucket
+    minimums = np.repeat(np.minimum.reduceat(values, starts), lengths)
+    maximums = np.repeat(np.maximum.reduceat(values, starts), lengths)
+    # Find first index of each bucket holding its minimum and maximum
+    positions = np.arange(count)
+    minindices = np.minimum.reduceat(
+        np.where(values == minimums, positions, count), starts)
+    maxindices = np.minimum.reduceat(
+        np.where(values == maximums, positions, count), starts)
+    # Combine first, last, minimum and maximum points in time order
+    indices = np.concatenate(([0, count - 1], minindices, maxindices))
+    return np.unique(indices)
+
+
+# Downsampling methods by name
+METHODS = {
+    "lttb": lttb,
+    "minmax": minmax
+}
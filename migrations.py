@@ -0,0 +1,131 @@
+"""
+Versioned schema migrations, which bring databases created by older
+versions up to date with the models.
+
+Databases created from the models already have the latest schema, so they
+are recorded as having every migration applied without running them. Other
+databases have each migration they are missing applied in order by
+DatabaseAPI.migrate, which records them in the SCHEMAVERSION table.
+
+Migrations must check the schema before changing it, as databases created
+before migrations were recorded may already have some of their changes.
+Indexes are defined here by name and columns rather than taken from the
+models, so that migrations keep working as the models change. On MySQL,
+indexes are added and removed with online DDL, which fails rather than
+blocking writes to the table while the index is built.
+
+To add a migration, define a function taking the DatabaseAPI decorated with
+the next version number and a description.
+
+"""
+from sqlalchemy import inspect
+
+# (version, description, function) of every migration, in version order
+MIGRATIONS = list()
+
+
+def migration(version, description):
+    """
+    Decorator registering a migration function.
+
+    Args:
+        version (int): Version of the migration, one more than the last.
+        description (str): Description of the schema change.
+
+    """
+    def register(function):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] == version - 1
+        MIGRATIONS.append((version, description, function))
+        return function
+    return register
+
+
+def indexnames(gdb, tablename):
+    """
+    Gets the names of the indexes of a table.
+
+    Args:
+        gdb: DatabaseAPI of database.
+        tablename (str): Name of table.
+    Returns:
+        Set of index names.
+
+    """
+    return {index['name'] for index in
+            inspect(gdb.engine).get_indexes(tablename)}
+
+
+def executeddl(gdb, statement):
+    """
+    Runs a DDL statement adding or removing an index, online on MySQL.
+
+    Args:
+        gdb: DatabaseAPI of database.
+        statement (str): The statement.
+
+    """
+    if gdb.engine.dialect.name == 'mysql':
+        statement += " ALGORITHM=INPLACE LOCK=NONE"
+    with gdb.engine.begin() as connection:
+        connection.execute(statement)
+
+
+def createindex(gdb, tablename, name, columns):
+    """
+    Creates an index if a table does not already have it.
+
+    Args:
+        gdb: DatabaseAPI of database.
+        tablename (str): Name of table.
+        name (str): Name of index.
+        columns (list): Names of indexed columns.
+    Returns:
+        bool: True if the index was created.
+
+    """
+    if name in indexnames(gdb, tablename):
+        return False
+    quote = gdb.engine.dialect.identifier_preparer.quote
+    executeddl(gdb, f"CREATE INDEX {quote(name)} ON {quote(tablename)} "
+                    f"({', '.join(quote(column) for column in columns)})")
+    return True
+
+
+def dropindex(gdb, tablename, name):
+    """
+    Drops an index if a table has it.
+
+    Args:
+        gdb: DatabaseAPI of database.
+        tablename (str): Name of table.
+        name (str): Name of index.
+    Returns:
+        bool: True if the index was dropped.
+
+    """
+    if name not in indexnames(gdb, tablename):
+        return False
+    quote = gdb.engine.dialect.identifier_preparer.quote
+    # Only MySQL requires the table of the index
+    if gdb.engine.dialect.name == 'mysql':
+        executeddl(gdb, f"DROP INDEX {quote(name)} ON {quote(tablename)}")
+    else:
+        executeddl(gdb, f"DROP INDEX {quote(name)}")
+    return True
+
+
+@migration(1, "Add purchase totals to USERSHARE")
+def addcostbasis(gdb):
+    gdb.migratecostbasis()
+
+
+@migration(2, "Add composite indexes for transaction, usershare and "
+              "leaderboard queries")
+def addcompositeindexes(gdb):
+    createindex(gdb, 'TRANSACTION', 'ix_TRANSACTION_userID_issuerID_datetime',
+                ['userID', 'issuerID', 'datetime'])
+    createindex(gdb, 'TRANSACTION', 'ix_TRANSACTION_datetime', ['datetime'])
+    createindex(gdb, 'USERSHARE', 'ix_USERSHARE_issuerID', ['issuerID'])
+    createindex(gdb, 'LEADERBOARD',
+                'ix_LEADERBOARD_recordtime_userID_totalvalue',
+                ['recordtime', 'userID', 'totalvalue'])
@@ -1,9 +1,11 @@
 from config import Config
 from sqlalchemy import (Column, Integer, String, Boolean, BigInteger, DECIMAL,
-                        Float, Date, DateTime, ForeignKey, create_engine)
+                        Float, Date, DateTime, ForeignKey, Index,
+                        create_engine)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from flask_login import UserMixin
+from datetime import timedelta
 
 Base = declarative_base()
 
@@ -101,6 +103,16 @@ class Usershare(Base):
     loss = Column(DECIMAL(20, 2, asdecimal=False), nullable=False,
                   unique=False)
     quantity = Column(BigInteger, nullable=False, unique=False)
+    # Running totals of all purchases, used for average purchase price
+    totalcost = Column(DECIMAL(20, 2, asdecimal=False), nullable=False,
+                       unique=False, default=0, server_default='0')
+    quantityacquired = Column(BigInteger, nullable=False, unique=False,
+                              default=0, server_default='0')
+    # Indexes, which are added to existing databases by migrations.py
+    __table_args__ = (
+        # Joining usershares to shares
+        Index('ix_USERSHARE_issuerID', 'issuerID'),
+    )
 
 
 class Transaction(Base):
@@ -122,6 +134,33 @@ class Transaction(Base):
                            unique=False)
     quantity = Column(BigInteger, nullable=False, unique=False)
     status = Column(String(20), nullable=False)
+    # Indexes, which are added to existing databases by migrations.py
+    __table_args__ = (
+        # Transactions of a user, and of a user and share by time
+        Index('ix_TRANSACTION_userID_issuerID_datetime',
+              'userID', 'issuerID', 'datetime'),
+        # Recent transactions of every user
+        Index('ix_TRANSACTION_datetime', 'datetime'),
+    )
+
+
+class PendingOrder(Base):
+    """Model for resting limit and stop orders"""
+    # Table name
+    __tablename__ = "PENDINGORDER"
+    # Table Columns
+    orderID = Column(Integer, primary_key=True)
+    userID = Column(Integer, ForeignKey('USER.userID'), nullable=False)
+    issuerID = Column(String(3), ForeignKey('SHARE.issuerID'),
+                      nullable=False)
+    transtype = Column(String(1), nullable=False, unique=False)
+    ordertype = Column(String(5), nullable=False, unique=False)
+    triggerprice = Column(Float, nullable=False, unique=False)
+    quantity = Column(BigInteger, nullable=False, unique=False)
+    createdtime = Column(DateTime, nullable=False, unique=False)
+    closedtime = Column(DateTime, nullable=True, unique=False)
+    # One of 'Open', 'Filled', 'Failed' or 'Cancelled'
+    status = Column(String(20), nullable=False, index=True)
 
 
 class Share(Base):
@@ -165,6 +204,53 @@ class SharePrice(Base):
     price = Column(Float, nullable=False, unique=False)
 
 
+class SharePriceRollup(Base):
+    """Model for open, high, low and close share prices over a period."""
+
+    # Period length of each resolution, from finest to coarsest
+    RESOLUTIONS = {
+        'hour': timedelta(hours=1),
+        'day': timedelta(days=1),
+        'week': timedelta(weeks=1)
+    }
+
+    # Table name
+    __tablename__ = 'SHAREPRICEROLLUP'
+    # Table Columns
+    issuerID = Column(String(3), ForeignKey('SHARE.issuerID'),
+                      primary_key=True)
+    resolution = Column(String(4), primary_key=True)
+    time = Column(DateTime, primary_key=True)
+    opentime = Column(DateTime, nullable=False, unique=False)
+    closetime = Column(DateTime, nullable=False, unique=False)
+    open = Column(Float, nullable=False, unique=False)
+    high = Column(Float, nullable=False, unique=False)
+    low = Column(Float, nullable=False, unique=False)
+    close = Column(Float, nullable=False, unique=False)
+    count = Column(Integer, nullable=False, unique=False)
+
+    @staticmethod
+    def getperiodstart(time, resolution):
+        """
+        Returns the start of the period of given resolution containing the
+        given time. Days start at midnight and weeks start on Monday.
+
+        Args:
+            time (datetime): Time to get period start of.
+            resolution (str): Resolution of period, one of RESOLUTIONS.
+
+        Returns:
+            The start of the period.
+        """
+        hour = time.replace(minute=0, second=0, microsecond=0)
+        if resolution == 'hour':
+            return hour
+        day = hour.replace(hour=0)
+        if resolution == 'day':
+            return day
+        return day - timedelta(days=day.weekday())
+
+
 class Admin(Base, UserMixin):
     """ Model for admin user """
     # Table name
@@ -185,6 +271,48 @@ class Leaderboard(Base):
     recordtime = Column(DateTime, primary_key=True)
     ranking = Column(Integer, nullable=False, unique=False)
     totalvalue = Column(DECIMAL(20, 2), unique=False, nullable=False)
+    # Indexes, which are added to existing databases by migrations.py
+    __table_args__ = (
+        # Snapshots at a time, covering the values of each user
+        Index('ix_LEADERBOARD_recordtime_userID_totalvalue',
+              'recordtime', 'userID', 'totalvalue'),
+    )
+
+
+class Ranking(Base):
+    """Model for the current value of each user, used for the leaderboard"""
+    # Table name
+    __tablename__ = 'RANKING'
+    # Table Columns
+    userID = Column(Integer, ForeignKey('USER.userID'),
+                    primary_key=True)
+    sharesvalue = Column(DECIMAL(20, 2, asdecimal=False), unique=False,
+                         nullable=False)
+    balance = Column(DECIMAL(20, 2, asdecimal=False), unique=False,
+                     nullable=False)
+    totalvalue = Column(DECIMAL(20, 2, asdecimal=False), unique=False,
+                        nullable=False, index=True)
+    updatedtime = Column(DateTime, nullable=False, unique=False)
+
+
+class SchemaVersion(Base):
+    """Model for schema migrations applied to the database"""
+    # Table name
+    __tablename__ = 'SCHEMAVERSION'
+    # Table Columns
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(255), nullable=False, unique=False)
+    appliedtime = Column(DateTime, nullable=False, unique=False)
+
+
+class CacheVersion(Base):
+    """Model for the version stamps of tables cached by each process"""
+    # Table name
+    __tablename__ = 'CACHEVERSION'
+    # Table Columns
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, unique=False)
+    updatedtime = Column(DateTime, nullable=False, unique=False)
 
 
 # Allow creation of tables by running API directly
@@ -0,0 +1,122 @@
+"""
+In-memory index of resting limit and stop orders, used to find the orders
+triggered by a new share price without scanning every order.
+
+Orders of each share are split by the direction of price movement that
+triggers them, and each side is kept sorted by trigger price, so the orders
+triggered by a price are a contiguous range found by bisection.
+    - Limit buys and stop sells trigger when the price falls to or below
+      their trigger price.
+    - Limit sells and stop buys trigger when the price rises to or above
+      their trigger price.
+
+"""
+from bisect import bisect_left, bisect_right, insort
+import threading
+
+
+def triggersbelow(transtype, ordertype):
+    """
+    Returns whether an order triggers when the price falls to or below its
+    trigger price, rather than when it rises to or above it.
+
+    Args:
+        transtype (str): 'B' for a purchase or 'S' for a sale.
+        ordertype (str): 'limit' or 'stop'.
+    Returns:
+        bool: True if the order triggers on a falling price.
+
+    """
+    return (transtype == 'B') == (ordertype == 'limit')
+
+
+class OrderBook:
+    """
+    Per share index of resting orders sorted by trigger price. Safe to use
+    from multiple threads.
+
+    """
+    def __init__(self):
+        # Sorted (trigger price, order ID) entries of each side of each
+        # share, keyed by issuer ID and whether the side triggers below
+        self.sides = dict()
+        # Issuer ID, side and trigger price of every indexed order
+        self.orders = dict()
+        # Time the index was last fully loaded, None if never loaded
+        self.loadedtime = None
+        # Time orders were last loaded, fully or not, used to load only
+        # orders placed since
+        self.checkedtime = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.orders)
+
+    def add(self, orderID, issuerID, transtype, ordertype, triggerprice):
+        """
+        Adds an order to the index. Does nothing if already indexed.
+
+        Args:
+            orderID (int): ID of order.
+            issuerID (str): ID of share ordered.
+            transtype (str): 'B' for a purchase or 'S' for a sale.
+            ordertype (str): 'limit' or 'stop'.
+            triggerprice (float): Price that triggers the order.
+
+        """
+        below = triggersbelow(transtype, ordertype)
+        with self.lock:
+            if orderID in self.orders:
+                return
+            self.orders[orderID] = (issuerID, below, triggerprice)
+            insort(self.sides.setdefault((issuerID, below), list()),
+                   (triggerprice, orderID))
+
+    def remove(self, orderID):
+        """
+        Removes an order from the index. Does nothing if not indexed.
+
+        Args:
+            orderID (int): ID of order.
+
+        """
+        with self.lock:
+            if orderID not in self.orders:
+                return
+            issuerID, below, triggerprice = self.orders.pop(orderID)
+            side = self.sides[(issuerID, below)]
+            del side[bisect_left(side, (triggerprice, orderID))]
+
+    def clear(self):
+        """
+        Removes every order from the index.
+
+        """
+        with self.lock:
+            self.sides.clear()
+            self.orders.clear()
+            self.loadedtime = None
+            self.checkedtime = None
+
+    def triggered(self, issuerID, price):
+        """
+        Finds the orders of a share triggered by a price.
+
+        Args:
+            issuerID (str): ID of share.
+            price (float): New price of share.
+        Returns:
+            List of IDs of triggered orders.
+
+        """
+        with self.lock:
+            # Orders triggering on a falling price, with trigger prices at
+            # or above the price
+            below = self.sides.get((issuerID, True), list())
+            start = bisect_left(below, (price, 0))
+            # Orders triggering on a rising price, with trigger prices at or
+            # below the price
+            above = self.sides.get((issuerID, False), list())
+            end = bisect_right(above, (price, float('inf')))
+            return ([orderID for triggerprice, orderID in below[start:]] +
+                    [orderID for triggerprice, orderID in above[:end]])
@@ -1,10 +1,21 @@
 from db_api import DatabaseAPI
 from config import Config
-from models import Base, User, Share, Admin, Transaction, Usershare, Tips
+from models import (Base, User, Share, SharePrice, SharePriceRollup, Admin,
+                    Transaction, Usershare, PendingOrder, Ranking,
+                    Leaderboard, Tips, SchemaVersion,
+                    CacheVersion)
+import migrations
+from orderbook import OrderBook
 from argon2 import PasswordHasher
-from datetime import datetime, date
+from sqlalchemy import event
+from sqlalchemy.exc import DisconnectionError
+from datetime import datetime, date, timedelta
+import asx_replay
+import downsampling
 import pytest
+import threading
 import unittest
+import math
 import os
 import random
 import string
@@ -41,6 +52,11 @@ class TestDatabaseAPI(unittest.TestCase):
         # Create all tables
         Base.metadata.create_all(self.gdb.engine)
         Base.metadata.reflect(bind=self.gdb.engine)
+        # Start offline ASX stand-in serving synthetic shares
+        self.asxserver = asx_replay.createserver(port=0, synthetic=True)
+        threading.Thread(target=self.asxserver.serve_forever,
+                         daemon=True).start()
+        self.asxreplayurl = f"http://127.0.0.1:{self.asxserver.server_port}"
 
     def setUp(self):
         # Do nothing
@@ -51,11 +67,19 @@ class TestDatabaseAPI(unittest.TestCase):
         with self.gdb.sessionmanager() as session:
             for table in reversed(Base.metadata.sorted_tables):
                 session.execute(table.delete())
+        # Clear index of deleted orders
+        self.gdb.orderbook.clear()
+        # Clear statistics and counts of deleted data
+        self.gdb.statisticscache.clear()
+        self.gdb.countcache.clear()
+        self.gdb.sharecache.clear()
 
     @classmethod
     def tearDownClass(self):
         # Delete all tables
         Base.metadata.drop_all(self.gdb.engine)
+        # Stop offline ASX stand-in
+        self.asxserver.shutdown()
 
     def test_adduser(self):
         # Add valid users and assert they were added successfully
@@ -100,7 +124,7 @@ class TestDatabaseAPI(unittest.TestCase):
         with self.gdb.sessionmanager() as session:
             session.add(testuser)
         # Get all users
-        users, num = self.gdb.getusers()
+        users, num, cursors = self.gdb.getusers()
         # Assert that user is present in returned users list
         assert users[0].userID == testuserID
 
@@ -202,7 +226,7 @@ class TestDatabaseAPI(unittest.TestCase):
             for share in shares:
                 session.add(share)
         # Get shares
-        shares, count = self.gdb.getshares()
+        shares, count, cursors = self.gdb.getshares()
         # Assert all shares were returned
         assert all(share.issuerID in issuerIDs for share in shares)
 
@@ -210,9 +234,207 @@ class TestDatabaseAPI(unittest.TestCase):
         # TODO
         pass
 
+    def test_getsharepriceseries(self):
+        # Generate share and add it directly to database
+        share = self.generatetestshare()
+        issuerID = share.issuerID
+        with self.gdb.sessionmanager() as session:
+            session.add(share)
+        # Add share prices directly to database out of order
+        starttime = datetime(2019, 8, 5, 10, 0, 0)
+        with self.gdb.sessionmanager() as session:
+            session.commit()
+            for i in [2, 0, 3, 1]:
+                session.add(SharePrice(
+                    issuerID=issuerID,
+                    time=starttime + timedelta(minutes=i),
+                    price=float(i)))
+        # Get share price series
+        times, prices = self.gdb.getsharepriceseries(issuerID)
+        # Assert that prices are ordered by time with times as epoch seconds
+        epoch = (starttime - datetime(1970, 1, 1)).total_seconds()
+        assert list(times) == [epoch + 60*i for i in range(4)]
+        assert list(prices) == [0.0, 1.0, 2.0, 3.0]
+        # Assert that times can be limited
+        times, prices = self.gdb.getsharepriceseries(
+            issuerID, starttime=starttime,
+            endtime=starttime + timedelta(minutes=3))
+        assert list(prices) == [1.0, 2.0]
+
     def test_updateshares(self):
-        # TODO: Potentially ignore due to reliance on ASX API
-        pass
+        # Use offline ASX stand-in
+        self.gdb.asxurl = self.asxreplayurl
+        try:
+            # Add shares through ASX stand-in
+            issuerIDs = ["AAA", "BBB", "CCC"]
+            for issuerID in issuerIDs:
+                assert self.gdb.addshare(issuerID) is True
+            # Update shares and assert one share price was recorded for each
+            assert self.gdb.updateshares() is True
+            with self.gdb.sessionmanager() as session:
+                assert session.query(SharePrice).count() == len(issuerIDs)
+            # Assert fetched share data matches the served share data
+            share_data, fetchstats = self.gdb.fetchsharedata(
+                issuerIDs + ["000"])
+            assert list(share_data) == issuerIDs
+            assert set(fetchstats['latencies']) == set(issuerIDs + ["000"])
+            for issuerID in issuerIDs:
+                asxdata = asx_replay.synthesisefixture("share", issuerID)
+                assert (share_data[issuerID]['currentprice'] ==
+                        asxdata['last_price'])
+            # Assert shares that cannot be fetched are skipped, keeping their
+            # latencies
+            self.gdb.asxurl = "http://127.0.0.1:1"
+            share_data, fetchstats = self.gdb.fetchsharedata(issuerIDs)
+            assert share_data == {}
+            assert set(fetchstats['latencies']) == set(issuerIDs)
+        finally:
+            self.gdb.asxurl = TestConfig.ASX_BASE_URL
+
+    def test_generatesharepricehistory(self):
+        # Use offline ASX stand-in
+        self.gdb.asxurl = self.asxreplayurl
+        try:
+            # Add share through ASX stand-in
+            issuerID = "AAA"
+            assert self.gdb.addshare(issuerID) is True
+            chart = asx_replay.synthesisefixture("chart", issuerID)
+            # Record a live share price, as updateshares does each hour
+            assert self.gdb.updateshares() is True
+            # Assert that full history is added the first time, despite the
+            # live share price being newer
+            assert self.gdb.generatesharepricehistory(issuerID) == len(chart)
+            # Assert that no history is added when already up to date
+            assert self.gdb.generatesharepricehistory(issuerID) == 0
+            # Assert that a rebuild adds the full history again
+            assert self.gdb.generatesharepricehistory(
+                issuerID, rebuild=True) == len(chart)
+            with self.gdb.sessionmanager() as session:
+                assert session.query(SharePrice).count() == len(chart)
+            assert self.gdb.generatesharepricehistory(issuerID) == 0
+            # Assert that share not in database fails
+            assert self.gdb.generatesharepricehistory("BBB") is None
+        finally:
+            self.gdb.asxurl = TestConfig.ASX_BASE_URL
+
+    def test_recordsharedata(self):
+        # Generate shares and add them directly to database
+        shares = [self.generatetestshare() for i in range(3)]
+        issuerIDs = [share.issuerID for share in shares]
+        with self.gdb.sessionmanager() as session:
+            for share in shares:
+                session.add(share)
+        # Record share data both in bulk and one share at a time
+        for bulk, currentprice in [(True, 12.5), (False, 13.5)]:
+            share_data = {issuerID: {
+                "currentprice": currentprice,
+                "marketcapitalisation": 1000,
+                "sharecount": 100,
+                "daychangepercent": "1.5%",
+                "daychangeprice": 0.2,
+                "daypricehigh": 14,
+                "daypricelow": 11,
+                "dayvolume": 500
+            } for issuerID in issuerIDs}
+            assert self.gdb.recordsharedata(share_data, bulk=bulk) is True
+            # Assert that shares were updated
+            with self.gdb.sessionmanager() as session:
+                for issuerID in issuerIDs:
+                    share = session.query(Share).get(issuerID)
+                    assert share.currentprice == currentprice
+                    assert share.daychangepercent == 0.015
+                    assert share.dayvolume == 500
+                # Assert that one share price was recorded for each share,
+                # all with the same time
+                shareprices = session.query(SharePrice).filter(
+                    SharePrice.price == currentprice).all()
+                assert len(shareprices) == len(issuerIDs)
+                assert len(set(sp.time for sp in shareprices)) == 1
+
+    def test_sharecache(self):
+        # Generate share and add it directly to database
+        share = self.generatetestshare(currentprice=10)
+        issuerID = share.issuerID
+        with self.gdb.sessionmanager() as session:
+            session.add(share)
+        # Assert share is read once, then served without queries
+        metrics = self.gdb.querymetrics
+        assert self.gdb.getshare(issuerID).currentprice == 10
+        metrics.begin()
+        share = self.gdb.getshare(issuerID)
+        assert share.currentprice == 10
+        assert self.gdb.getshares(
+            countstrategy="none")[0][0].issuerID == issuerID
+        assert metrics.end()['queries'] == 0
+        # Assert cached shares cannot be changed by callers
+        with pytest.raises(AttributeError):
+            share.currentprice = 1
+        assert self.gdb.getshare(issuerID).currentprice == 10
+        # Assert shares changed by this process are reloaded at once
+        share_data = {issuerID: {
+            "currentprice": 11, "marketcapitalisation": 1000,
+            "sharecount": 100, "daychangepercent": "1.5%",
+            "daychangeprice": 0.2, "daypricehigh": 14, "daypricelow": 11,
+            "dayvolume": 500}}
+        self.gdb.recordsharedata(share_data)
+        assert self.gdb.getshare(issuerID).currentprice == 11
+        with self.gdb.sessionmanager() as session:
+            session.query(Share).get(issuerID).currentprice = 12
+        assert self.gdb.getshare(issuerID).currentprice == 12
+        # Change share as another process would, without stamping it
+        shares = Share.__table__
+        stamps = CacheVersion.__table__
+        with self.gdb.engine.begin() as connection:
+            connection.execute(shares.update().values(currentprice=13))
+        try:
+            self.gdb.sharecache.checkinterval = 0
+            # Assert cached share is kept while the stamp is unchanged
+            assert self.gdb.getshare(issuerID).currentprice == 12
+            # Assert share is reloaded once the stamp is changed
+            with self.gdb.engine.begin() as connection:
+                connection.execute(stamps.update().values(
+                    version=stamps.c.version + 1))
+            assert self.gdb.getshare(issuerID).currentprice == 13
+        finally:
+            self.gdb.sharecache.checkinterval = (
+                TestConfig.SHARE_CACHE_CHECK_SECONDS)
+
+    def test_sharepricerollups(self):
+        # Generate share and add it directly to database
+        share = self.generatetestshare()
+        issuerID = share.issuerID
+        with self.gdb.sessionmanager() as session:
+            session.add(share)
+        # Roll up share prices in two batches spanning two days
+        starttime = datetime(2019, 8, 5, 10, 0, 0)
+        prices = [3, 5, 1, 4, 2, 6]
+        records = [{
+            'issuerID': issuerID,
+            'time': starttime + timedelta(hours=10*i),
+            'price': price} for i, price in enumerate(prices)]
+        with self.gdb.sessionmanager() as session:
+            session.bulk_insert_mappings(SharePrice, records)
+            self.gdb.rollupshareprices(session, records[:3])
+            self.gdb.rollupshareprices(session, records[3:])
+        # Assert weekly rollup covers every share price
+        resolution, rollups = self.gdb.getsharepricerollups(
+            issuerID, starttime, starttime + timedelta(days=3), 1)
+        assert resolution == 'week'
+        assert len(rollups) == 1
+        assert (rollups[0].open, rollups[0].high, rollups[0].low,
+                rollups[0].close, rollups[0].count) == (3, 6, 1, 6, 6)
+        # Assert daily rollups are used when they fit
+        resolution, rollups = self.gdb.getsharepricerollups(
+            issuerID, starttime, starttime + timedelta(days=3), 5)
+        assert resolution == 'day'
+        assert [rollup.count for rollup in rollups] == [2, 2, 2]
+        assert [rollup.close for rollup in rollups] == [5, 4, 6]
+        # Assert rebuilding rollups gives the same rollups
+        assert self.gdb.rebuildsharepricerollups(issuerID) == 6 + 3 + 1
+        resolution, rebuiltrollups = self.gdb.getsharepricerollups(
+            issuerID, starttime, starttime + timedelta(days=3), 5)
+        assert ([(r.time, r.open, r.close) for r in rebuiltrollups] ==
+                [(r.time, r.open, r.close) for r in rollups])
 
     def test_buyshare(self):
         # Generate user with predefined balance
@@ -232,6 +454,9 @@ class TestDatabaseAPI(unittest.TestCase):
         assert self.gdb.buyshare(userID, issuerID, 10) is True
         # Attempt to purchase unaffordable number or shares and assert false
         assert self.gdb.buyshare(userID, issuerID, 1000) is False
+        # Attempt to purchase invalid numbers of shares and assert false
+        for invalid in (0, -1, True, 1.5, math.nan):
+            assert self.gdb.buyshare(userID, issuerID, invalid) is False
         # Start session
         with self.gdb.sessionmanager() as session:
             # Calculate transaction values
@@ -258,6 +483,11 @@ class TestDatabaseAPI(unittest.TestCase):
             # Assert usershare was created with correct values
             assert usershare.loss == totalval
             assert usershare.quantity == 10
+            assert usershare.totalcost == totalval
+            assert usershare.quantityacquired == 10
+        # Assert average purchase price includes fees
+        assert self.gdb.averagePurchasedStockPrice(
+            userID, issuerID) == totalval / 10
 
     def test_sellshare(self):
         # Generate user with predefined balance
@@ -285,6 +515,9 @@ class TestDatabaseAPI(unittest.TestCase):
         assert self.gdb.sellshare(userID, issuerID, 10) is True
         # Attempt to sell unheld number or shares and assert false
         assert self.gdb.sellshare(userID, issuerID, 1000) is False
+        # Attempt to sell invalid numbers of shares and assert false
+        for invalid in (0, -1, True, 1.5, math.inf):
+            assert self.gdb.sellshare(userID, issuerID, invalid) is False
         # Start session
         with self.gdb.sessionmanager() as session:
             # Calculate transaction values
@@ -312,6 +545,431 @@ class TestDatabaseAPI(unittest.TestCase):
             assert usershare.profit == profit + totalval
             assert usershare.quantity == quantity - 10
 
+    def test_sellshare_updatesrating(self):
+        # Generate user with no sales
+        userID = 1
+        user = self.generatetestuser(userID=userID, balance=5000)
+        user.overallPerc = 0
+        user.totalNumSales = 0
+        # Generate share with predefined price
+        issuerID = "TST"
+        share = self.generatetestshare(issuerID=issuerID, currentprice=100)
+        # Generate usershare bought at an average of 50 per share
+        usershare = Usershare(issuerID=issuerID, userID=userID, profit=0,
+                              loss=5000, quantity=100, totalcost=5000,
+                              quantityacquired=100)
+        with self.gdb.sessionmanager() as session:
+            session.add(user)
+            session.add(share)
+            session.commit()
+            session.add(usershare)
+        # Sell shares and assert percentage gained was recorded
+        assert self.gdb.sellshare(userID, issuerID, 10) is True
+        soldprice = (1000 - (50 + 1000 * 0.0025)) / 10
+        with self.gdb.sessionmanager() as session:
+            user = session.query(User).get(userID)
+            assert user.totalNumSales == 1
+            assert user.overallPerc == pytest.approx(
+                (soldprice / 50 - 1) * 100)
+
+    def test_concurrenttrades(self):
+        # Generate user with predefined balance
+        userID = 1
+        balance = 1000000
+        user = self.generatetestuser(userID=userID, balance=balance)
+        # Generate share with predefined price
+        issuerID = "TST"
+        share = self.generatetestshare(issuerID=issuerID, currentprice=10)
+        # Generate usershare with shares available to sell
+        quantity = 1000
+        usershare = Usershare(issuerID=issuerID, userID=userID, profit=0,
+                              loss=0, quantity=quantity)
+        with self.gdb.sessionmanager() as session:
+            session.add(user)
+            session.add(share)
+            session.commit()
+            session.add(usershare)
+        # Buy and sell shares for the same user from several threads
+        threadcount = 8
+        tradecount = 10
+        results = list()
+
+        def trade(buy):
+            for i in range(tradecount):
+                if buy:
+                    results.append(("B", self.gdb.buyshare(
+                        userID, issuerID, 2)))
+                else:
+                    results.append(("S", self.gdb.sellshare(
+                        userID, issuerID, 3)))
+        threads = [threading.Thread(target=trade, args=(i % 2 == 0,))
+                   for i in range(threadcount)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Assert every trade succeeded
+        assert len(results) == threadcount * tradecount
+        assert all(succeeded for transtype, succeeded in results)
+        # Assert no updates were lost
+        with self.gdb.sessionmanager() as session:
+            user = session.query(User).get(userID)
+            usershare = session.query(Usershare).filter(
+                Usershare.userID == userID,
+                Usershare.issuerID == issuerID).first()
+            transactions = session.query(Transaction).filter(
+                Transaction.userID == userID).all()
+            bought = sum(t.totaltransval for t in transactions
+                         if t.transtype == 'B')
+            sold = sum(t.totaltransval for t in transactions
+                       if t.transtype == 'S')
+            assert len(transactions) == threadcount * tradecount
+            assert user.balance == pytest.approx(balance - bought + sold)
+            assert usershare.quantity == (
+                quantity + 2 * threadcount * tradecount // 2 -
+                3 * threadcount * tradecount // 2)
+
+    def test_submitorders(self):
+        # Generate user with predefined balance
+        userID = 1
+        balance = 5000
+        user = self.generatetestuser(userID=userID, balance=balance)
+        # Generate shares with predefined prices
+        sellID, buyID = "TSA", "TSB"
+        sellshare = self.generatetestshare(issuerID=sellID, currentprice=100)
+        buyshare = self.generatetestshare(issuerID=buyID, currentprice=200)
+        # Generate usershare of share to sell
+        usershare = Usershare(issuerID=sellID, userID=userID, profit=0,
+                              loss=0, quantity=50)
+        with self.gdb.sessionmanager() as session:
+            session.add(user)
+            session.add(sellshare)
+            session.add(buyshare)
+            session.commit()
+            session.add(usershare)
+        # Attempt orders that need the sale to fund the purchase
+        orders = [{"issuerID": buyID, "quantity": 40, "transtype": "B"},
+                  {"issuerID": sellID, "quantity": 50, "transtype": "S"}]
+        assert self.gdb.submitorders(userID, orders) is True
+        # Assert balance reflects both orders
+        saleval = 5000 - (50 + 5000 * 0.0025)
+        purchaseval = 8000 + (50 + 8000 * 0.01)
+        with self.gdb.sessionmanager() as session:
+            user = session.query(User).get(userID)
+            assert user.balance == pytest.approx(
+                balance + saleval - purchaseval)
+            assert session.query(Transaction).count() == 2
+            quantities = dict(session.query(
+                Usershare.issuerID, Usershare.quantity).all())
+            assert quantities == {sellID: 0, buyID: 40}
+        # Attempt orders where one is invalid and assert none are executed
+        for orders in (
+                [{"issuerID": buyID, "quantity": 1, "transtype": "B"},
+                 {"issuerID": sellID, "quantity": 1, "transtype": "S"}],
+                [{"issuerID": buyID, "quantity": 1, "transtype": "B"},
+                 {"issuerID": "NON", "quantity": 1, "transtype": "B"}],
+                [{"issuerID": buyID, "quantity": 1000, "transtype": "B"}],
+                [{"issuerID": buyID, "quantity": -1, "transtype": "S"}],
+                [{"issuerID": buyID, "quantity": True, "transtype": "B"}],
+                [{"issuerID": buyID, "quantity": math.inf, "transtype": "B"}],
+                []):
+            assert self.gdb.submitorders(userID, orders) is False
+        with self.gdb.sessionmanager() as session:
+            assert session.query(Transaction).count() == 2
+            assert session.query(Usershare).filter(
+                Usershare.issuerID == buyID).one().quantity == 40
+
+    def test_requestsession(self):
+        # Generate user with predefined balance and share
+        userID = 1
+        balance = 5000
+        user = self.generatetestuser(userID=userID, balance=balance)
+        share = self.generatetestshare(issuerID="TST", currentprice=100)
+        with self.gdb.sessionmanager() as session:
+            session.add(user)
+            session.add(share)
+        # Count connections checked out from the pool
+        checkouts = list()
+
+        def countcheckout(*args):
+            checkouts.append(args)
+        event.listen(self.gdb.engine, "checkout", countcheckout)
+        try:
+            # Run several calls and a failing order in one request session
+            with self.gdb.requestsession():
+                assert self.gdb.getuserbyid(userID).balance == balance
+                assert self.gdb.getshare("TST") is not None
+                assert self.gdb.buyshare(userID, "TST", 10)
+                assert self.gdb.submitorders(userID, [
+                    {"issuerID": "TST", "quantity": 1000,
+                     "transtype": "B"}]) is False
+                assert self.gdb.getuserbyid(userID).balance < balance
+        finally:
+            event.remove(self.gdb.engine, "checkout", countcheckout)
+        # Assert one connection was used and only the failed order discarded
+        assert len(checkouts) == 1
+        with self.gdb.sessionmanager() as session:
+            assert session.query(Transaction).count() == 1
+        # Assert every change is discarded if the request fails
+        with pytest.raises(ValueError):
+            with self.gdb.requestsession():
+                assert self.gdb.buyshare(userID, "TST", 10)
+                raise ValueError
+        with self.gdb.sessionmanager() as session:
+            assert session.query(Transaction).count() == 1
+        # Assert methods use their own sessions outside a request session
+        assert self.gdb.buyshare(userID, "TST", 10)
+        with self.gdb.sessionmanager() as session:
+            assert session.query(Transaction).count() == 2
+        # Assert sessions that do not join the request session are
+        # committed on their own, even if the request fails
+        with pytest.raises(ValueError):
+            with self.gdb.requestsession():
+                with self.gdb.sessionmanager(join=False) as session:
+                    session.query(User).get(userID).balance = 1
+                raise ValueError
+        assert self.gdb.getuserbyid(userID).balance == 1
+
+    def test_poolmetrics(self):
+        # Reset pool metrics
+        metrics = self.gdb.poolmetrics
+        metrics.reset()
+        # Run queries from several threads at once
+        threads = [threading.Thread(target=self.gdb.getuserbyid, args=(1,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Assert each checkout and its wait were counted
+        snapshot = metrics.snapshot()
+        assert snapshot['checkouts'] == 4
+        assert snapshot['checkedout'] == 0
+        assert 1 <= snapshot['peakcheckedout'] <= 4
+        assert snapshot['maxwaitms'] >= snapshot['meanwaitms'] > 0
+        assert snapshot['invalidations'] == 0
+        # Invalidate a connection and assert it is counted
+        with self.gdb.engine.connect() as connection:
+            connection.invalidate()
+        assert metrics.snapshot()['invalidations'] == 1
+
+    def test_querymetrics(self):
+        # Generate user
+        userID = 1
+        user = self.generatetestuser(userID=userID)
+        with self.gdb.sessionmanager() as session:
+            session.add(user)
+        metrics = self.gdb.querymetrics
+        metrics.reset()
+        # Assert queries are not counted when not recording
+        self.gdb.getuserbyid(userID)
+        assert metrics.end("unrecorded") is None
+        # Record queries of two units of work for the same endpoint
+        metrics.begin()
+        self.gdb.getuserbyid(userID)
+        first = metrics.end("user")
+        metrics.begin()
+        self.gdb.getuserbyid(userID)
+        self.gdb.getuserbyid(userID)
+        second = metrics.end("user")
+        # Assert queries of each unit of work are counted and timed
+        assert first['queries'] >= 1
+        assert second['queries'] == 2 * first['queries']
+        assert second['dbms'] > 0
+        assert len(second['slowest']) == min(second['queries'], 3)
+        assert any("USER" in statement
+                   for ms, statement in second['slowest'])
+        # Assert queries are aggregated for the endpoint
+        endpoints = metrics.snapshot()
+        assert [e['endpoint'] for e in endpoints] == ["user"]
+        assert endpoints[0]['requests'] == 2
+        assert endpoints[0]['meanqueries'] == 1.5 * first['queries']
+        assert endpoints[0]['maxqueries'] == second['queries']
+        assert endpoints[0]['totaldbms'] == pytest.approx(
+            first['dbms'] + second['dbms'], abs=0.01)
+        assert len(endpoints[0]['slowest']) == 3
+
+    def test_pingidleconnection(self):
+        # Define connection record last used long ago
+        class Record:
+            info = {'lastused': 0}
+        # Assert an idle live connection passes its ping
+        connection = self.gdb.engine.raw_connection()
+        try:
+            self.gdb.pingidleconnection(connection.connection, Record(),
+                                        None)
+        finally:
+            connection.invalidate()
+            connection.close()
+        # Assert a closed connection fails its ping, to be replaced
+        connection = self.gdb.engine.raw_connection()
+        connection.connection.close()
+        try:
+            with pytest.raises(DisconnectionError):
+                self.gdb.pingidleconnection(connection.connection,
+                                            Record(), None)
+        finally:
+            connection.invalidate()
+            connection.close()
+
+    def test_executependingorders(self):
+        # Generate user with predefined balance
+        userID = 1
+        balance = 5000
+        user = self.generatetestuser(userID=userID, balance=balance)
+        # Generate share with predefined price
+        issuerID = "TST"
+        share = self.generatetestshare(issuerID=issuerID, currentprice=100)
+        # Generate usershare of share to sell
+        usershare = Usershare(issuerID=issuerID, userID=userID, profit=0,
+                              loss=0, quantity=10)
+        with self.gdb.sessionmanager() as session:
+            session.add(user)
+            session.add(share)
+            session.commit()
+            session.add(usershare)
+        # Place orders, with one that can't be afforded when triggered
+        limitbuy = self.gdb.placeorder(userID, issuerID, 'B', 'limit', 90, 5)
+        stopsell = self.gdb.placeorder(userID, issuerID, 'S', 'stop', 80, 10)
+        limitsell = self.gdb.placeorder(
+            userID, issuerID, 'S', 'limit', 120, 5)
+        bigbuy = self.gdb.placeorder(userID, issuerID, 'B', 'limit', 95, 1000)
+        cancelled = self.gdb.placeorder(
+            userID, issuerID, 'B', 'limit', 95, 1)
+        assert None not in (limitbuy, stopsell, limitsell, bigbuy, cancelled)
+        # Assert invalid orders are not placed
+        assert self.gdb.placeorder(
+            userID, issuerID, 'B', 'limit', 0, 1) is None
+        assert self.gdb.placeorder(
+            userID, "NON", 'B', 'limit', 1, 1) is None
+        assert self.gdb.placeorder(
+            userID, issuerID, 'B', 'limit', 90, True) is None
+        assert self.gdb.placeorder(
+            userID, issuerID, 'B', 'limit', True, 1) is None
+        for triggerprice in (math.nan, math.inf):
+            assert self.gdb.placeorder(
+                userID, issuerID, 'S', 'stop', triggerprice, 1) is None
+        # Cancel order and assert it can't be cancelled twice
+        assert self.gdb.cancelorder(userID, cancelled) is True
+        assert self.gdb.cancelorder(userID, cancelled) is False
+        # Assert no orders are triggered while price is unchanged
+        stats = self.gdb.executependingorders({issuerID: 100})
+        assert stats['resting'] == 4
+        assert stats['triggered'] == 0
+        # Drop price to trigger limit buys but not the stop sell
+        stats = self.gdb.executependingorders({issuerID: 90})
+        assert stats['triggered'] == 2
+        assert stats['filled'] == 1
+        assert stats['failed'] == 1
+        assert len(self.gdb.orderbook) == 2
+        # Assert purchase was made at the new price
+        with self.gdb.sessionmanager() as session:
+            user = session.query(User).get(userID)
+            assert user.balance == pytest.approx(
+                balance - self.gdb.tradecosts('B', 90, 5)[2])
+            statuses = dict(session.query(
+                PendingOrder.orderID, PendingOrder.status).all())
+            assert statuses == {limitbuy: 'Filled', stopsell: 'Open',
+                                limitsell: 'Open', bigbuy: 'Failed',
+                                cancelled: 'Cancelled'}
+        # Assert orders executed in a request session that fails are kept
+        # in the index
+        with pytest.raises(ValueError):
+            with self.gdb.requestsession():
+                stats = self.gdb.executependingorders({issuerID: 130})
+                assert stats['filled'] == 1
+                raise ValueError
+        assert len(self.gdb.orderbook) == 2
+        # Raise price to trigger the limit sell in a request session, and
+        # assert it is only removed from the index once committed
+        with self.gdb.requestsession():
+            stats = self.gdb.executependingorders({issuerID: 130})
+            assert len(self.gdb.orderbook) == 2
+        assert len(self.gdb.orderbook) == 1
+        assert stats['filled'] == 1
+        assert [order.orderID for order in self.gdb.getpendingorders(
+            userID)] == [stopsell]
+        with self.gdb.sessionmanager() as session:
+            usershare = session.query(Usershare).first()
+            assert usershare.quantity == 10
+
+    def test_loadpendingorders(self):
+        # Generate user and share
+        userID = 1
+        issuerID = "TST"
+        with self.gdb.sessionmanager() as session:
+            session.add(self.generatetestuser(userID=userID))
+            session.add(self.generatetestshare(issuerID=issuerID))
+        now = datetime.utcnow()
+
+        def addorder(orderID, createdtime):
+            with self.gdb.sessionmanager() as session:
+                session.add(PendingOrder(
+                    orderID=orderID, userID=userID, issuerID=issuerID,
+                    transtype='B', ordertype='limit', triggerprice=90,
+                    quantity=1, createdtime=createdtime, status="Open"))
+        # Index an order
+        addorder(20, now)
+        assert self.gdb.loadpendingorders() == 1
+        # Assert an order with a lower ID committed afterwards is loaded,
+        # and orders already indexed are not loaded again
+        addorder(10, now - timedelta(minutes=1))
+        assert self.gdb.loadpendingorders() == 1
+        assert self.gdb.loadpendingorders() == 0
+        # Assert orders placed long before the last load are only loaded by
+        # a full load
+        addorder(5, now - timedelta(hours=1))
+        assert self.gdb.loadpendingorders() == 0
+        assert self.gdb.loadpendingorders(full=True) == 3
+
+    def test_migrate(self):
+        # Drop an index, as if the database was created by an older version
+        # without any migrations recorded
+        versions = [version for version, _, _ in migrations.MIGRATIONS]
+        migrations.dropindex(self.gdb, 'TRANSACTION',
+                             'ix_TRANSACTION_userID_issuerID_datetime')
+        # Assert every migration is applied, leaving indexes of the models
+        assert self.gdb.migrate() == versions
+        for table in (Leaderboard.__table__, Transaction.__table__):
+            assert (migrations.indexnames(self.gdb, table.name) ==
+                    {index.name for index in table.indexes})
+        # Assert migrations are only applied once
+        assert self.gdb.migrate() == []
+        # Assert stamping records migrations without applying them
+        with self.gdb.sessionmanager() as session:
+            session.query(SchemaVersion).delete()
+        assert self.gdb.migrate(stamp=True) == versions
+
+    def test_backfillcostbasis(self):
+        # Generate user and share
+        userID = 1
+        user = self.generatetestuser(userID=userID)
+        share = self.generatetestshare()
+        issuerID = share.issuerID
+        # Generate usershare without purchase totals
+        usershare = Usershare(issuerID=issuerID, userID=userID, profit=0,
+                              loss=0, quantity=0)
+        # Generate purchases and a sale
+        transactions = [self.generatetesttransaction(
+            userID=userID, issuerID=issuerID, transtype=transtype)
+            for transtype in ["B", "B", "S"]]
+        totalcost = sum(t.totaltransval for t in transactions[:2])
+        quantityacquired = sum(t.quantity for t in transactions[:2])
+        with self.gdb.sessionmanager() as session:
+            session.add(user)
+            session.add(share)
+            session.commit()
+            session.add(usershare)
+            for transaction in transactions:
+                session.add(transaction)
+        # Backfill purchase totals
+        self.gdb.backfillcostbasis()
+        # Assert purchase totals match purchases only
+        with self.gdb.sessionmanager() as session:
+            usershare = session.query(Usershare).first()
+            assert usershare.totalcost == pytest.approx(totalcost)
+            assert usershare.quantityacquired == quantityacquired
+
     def test_getusershareinfo(self):
         # TODO: Test sorting and test more fields
         # Generate user
@@ -334,13 +992,18 @@ class TestDatabaseAPI(unittest.TestCase):
             session.commit()
             session.add(usershare)
         # Get usershare info
-        shareinfos, count = self.gdb.getusersharesinfo(userID=userID)
+        shareinfos, count, cursors = self.gdb.getusersharesinfo(
+            userID=userID)
         shareinfo = shareinfos[0]
         # Assert that usershare fields are mostly correct
         assert shareinfo['issuerID'] == issuerID
         assert shareinfo['userID'] == userID
         assert shareinfo['quantity'] == quantity
         assert shareinfo['currentprice'] == currentprice
+        # Assert computed columns are included and unused columns are not
+        assert shareinfo['net'] == profit - loss
+        assert shareinfo['value'] == pytest.approx(currentprice * quantity)
+        assert 'description' not in shareinfo
 
     def test_gettransactions(self):
         # TODO: Test sorting
@@ -363,7 +1026,8 @@ class TestDatabaseAPI(unittest.TestCase):
             for transaction in transactions:
                 session.add(transaction)
         # Get transactions for user
-        transactions, count = self.gdb.gettransactions(userID=userID)
+        transactions, count, cursors = self.gdb.gettransactions(
+            userID=userID)
         # Assert that each transaction is present in the returned transactions
         assert all(
             t.totaltransval in transactiontotalvals for t in transactions)
@@ -433,6 +1097,8 @@ class TestDatabaseAPI(unittest.TestCase):
         with self.gdb.sessionmanager() as session:
             for user in users:
                 session.add(user)
+            session.flush()
+            userIDs = [user.userID for user in users]
         # Get statistics
         stats = self.gdb.getuserstatistics()
         # Assert that statistics are accurate
@@ -440,6 +1106,178 @@ class TestDatabaseAPI(unittest.TestCase):
             assert stats['gendercounts'][key] == gender_dist[key]
         for key in stats['agegroupcounts']:
             assert stats['agegroupcounts'][key] == agegroup_dist[key]
+        assert sum(stats['gendercounts'].values()) == len(users)
+        assert sum(stats['agegroupcounts'].values()) == len(users)
+        # Assert no trading activity is counted without transactions
+        assert stats['tradingactivity']['trades'] == 0
+        assert stats['tradingactivity']['activetraders'] == 0
+        assert stats['tradingactivity']['tradesperday'] == []
+        # Add recent transactions for two users and one old transaction
+        share = self.generatetestshare(issuerID="TST")
+        now = datetime.utcnow()
+        transactions = [
+            self.generatetesttransaction(
+                issuerID="TST", userID=userIDs[0], transtype='B',
+                time=now - timedelta(days=1), stocktransval=100,
+                quantity=10),
+            self.generatetesttransaction(
+                issuerID="TST", userID=userIDs[0], transtype='S',
+                time=now, stocktransval=50, quantity=5),
+            self.generatetesttransaction(
+                issuerID="TST", userID=userIDs[1], transtype='B',
+                time=now, stocktransval=20, quantity=2),
+            self.generatetesttransaction(
+                issuerID="TST", userID=userIDs[2], transtype='B',
+                time=now - timedelta(days=60), stocktransval=1000,
+                quantity=100)
+        ]
+        with self.gdb.sessionmanager() as session:
+            session.add(share)
+            session.add_all(transactions)
+        # Assert cached statistics are returned until the cache is cleared
+        assert self.gdb.getuserstatistics() is stats
+        self.gdb.statisticscache.clear()
+        activity = self.gdb.getuserstatistics()['tradingactivity']
+        # Assert trading activity counts only recent transactions
+        assert activity['activetraders'] == 2
+        assert activity['trades'] == 3
+        assert activity['purchases'] == 2
+        assert activity['sales'] == 1
+        assert activity['volume'] == 17
+        assert activity['value'] == 170
+        assert [day['trades'] for day in activity['tradesperday']] == [1, 2]
+        assert [day['volume'] for day in activity['tradesperday']] == [10, 7]
+        assert activity['tradesperday'][-1]['day'] == str(now.date())
+
+    def test_keysetpagination(self):
+        # Generate shares, some sharing prices and without sectors
+        shares = list()
+        for i in range(23):
+            share = self.generatetestshare(issuerID=f"T{i:02}",
+                                           currentprice=i % 5)
+            share.industrysector = None if i % 3 == 0 else f"S{i % 4}"
+            shares.append(share)
+        with self.gdb.sessionmanager() as session:
+            session.add_all(shares)
+        # Page through shares in several orders using cursors
+        for orderby in (None, "currentprice", "industrysector"):
+            for order in ("asc", "desc"):
+                allshares, count, cursors = self.gdb.getshares(
+                    orderby=orderby, order=order)
+                assert count == len(shares)
+                # Follow next cursors and assert every share is listed once
+                # in the same order as a single page
+                pages = list()
+                cursor = None
+                while True:
+                    page, count, cursors = self.gdb.getshares(
+                        orderby=orderby, order=order, limit=5, cursor=cursor)
+                    pages.append([share.issuerID for share in page])
+                    cursor = cursors['next']
+                    if cursor is None:
+                        break
+                assert [issuerID for page in pages for issuerID in page] == \
+                    [share.issuerID for share in allshares]
+                assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+                # Follow previous cursors back and assert pages are the same
+                page, count, cursors = self.gdb.getshares(
+                    orderby=orderby, order=order, limit=5, offset=20)
+                for expected in reversed(pages[:-1]):
+                    page, count, cursors = self.gdb.getshares(
+                        orderby=orderby, order=order, limit=5,
+                        cursor=cursors['prev'])
+                    assert [share.issuerID for share in page] == expected
+                assert cursors['prev'] is None
+                # Assert last cursor gets the shares of the last numbered
+                # page, and previous pages from it are numbered pages
+                page, count, cursors = self.gdb.getshares(
+                    orderby=orderby, order=order, limit=5,
+                    cursor=cursors['last'])
+                assert [share.issuerID for share in page] == pages[-1]
+                assert cursors['next'] is None
+                page, count, cursors = self.gdb.getshares(
+                    orderby=orderby, order=order, limit=5,
+                    cursor=cursors['prev'])
+                assert [share.issuerID for share in page] == pages[-2]
+        # Assert last cursor of queried pages gets the last numbered page
+        with self.gdb.sessionmanager() as session:
+            for userID in range(1, 24):
+                session.add(self.generatetestuser(userID=userID,
+                                                  hashpassword=False))
+        for order in ("asc", "desc"):
+            users, count, cursors = self.gdb.getusers(order=order)
+            userIDs = [user.userID for user in users]
+            page, count, cursors = self.gdb.getusers(order=order, limit=5)
+            page, count, cursors = self.gdb.getusers(
+                order=order, limit=5, cursor=cursors['last'])
+            assert [user.userID for user in page] == userIDs[20:]
+            page, count, cursors = self.gdb.getusers(
+                order=order, limit=5, cursor=cursors['prev'])
+            assert [user.userID for user in page] == userIDs[15:20]
+        # Assert cursors are rejected for other orderings or if invalid
+        page, count, cursors = self.gdb.getshares(orderby="currentprice",
+                                                  limit=5)
+        for orderby, order, cursor in (("currentprice", "desc",
+                                        cursors['next']),
+                                       ("fullname", "asc", cursors['next']),
+                                       ("currentprice", "asc", "invalid")):
+            with pytest.raises(ValueError):
+                self.gdb.getshares(orderby=orderby, order=order, limit=5,
+                                   cursor=cursor)
+
+    def test_countstrategies(self):
+        # Generate shares
+        shares = [self.generatetestshare(issuerID=f"T{i:02}")
+                  for i in range(12)]
+        with self.gdb.sessionmanager() as session:
+            session.add_all(shares)
+        # Assert every strategy except none counts every share
+        for strategy in ("exact", "cached", "estimate"):
+            page, count, cursors = self.gdb.getshares(
+                limit=5, countstrategy=strategy)
+            assert count == 12
+        page, count, cursors = self.gdb.getshares(limit=5,
+                                                  countstrategy="none")
+        assert count is None
+        assert len(page) == 5 and cursors['next'] is not None
+        # Add share without the session, so the cached count is not
+        # discarded, and assert only the cached count is unchanged
+        share = self.generatetestshare(issuerID="T12")
+        with self.gdb.engine.begin() as connection:
+            connection.execute(Share.__table__.insert().values(
+                **{column.name: getattr(share, column.name)
+                   for column in Share.__table__.columns}))
+        assert self.gdb.getshares(countstrategy="exact")[1] == 13
+        assert self.gdb.getshares(countstrategy="cached")[1] == 12
+        # Add share through a session and assert the cached count is
+        # discarded
+        with self.gdb.sessionmanager() as session:
+            session.add(self.generatetestshare(issuerID="T13"))
+        assert self.gdb.getshares(countstrategy="cached")[1] == 14
+        # Assert the cached count is discarded when rows are deleted by a
+        # query
+        with self.gdb.sessionmanager() as session:
+            session.query(Share).filter(Share.issuerID == "T13").delete()
+        assert self.gdb.getshares(countstrategy="cached")[1] == 13
+        # Assert the cached count is discarded when rows are added in bulk
+        with self.gdb.sessionmanager() as session:
+            sharepricecount = self.gdb.countquery(
+                session, session.query(SharePrice), "cached")
+        self.gdb.recordsharedata({"T00": {
+            "currentprice": 1, "marketcapitalisation": 1000,
+            "sharecount": 100, "daychangepercent": "1.5%",
+            "daychangeprice": 0.2, "daypricehigh": 2, "daypricelow": 1,
+            "dayvolume": 500}})
+        with self.gdb.sessionmanager() as session:
+            assert self.gdb.countquery(
+                session, session.query(SharePrice),
+                "cached") == sharepricecount + 1
+        # Assert counts of filtered queries are cached separately
+        assert self.gdb.gettransactions(
+            userID=1, countstrategy="cached")[1] == 0
+        # Assert unknown strategies are rejected
+        with pytest.raises(ValueError):
+            self.gdb.getshares(countstrategy="guess")
 
     def test_getleaderboard(self):
         users = list()
@@ -482,7 +1320,8 @@ class TestDatabaseAPI(unittest.TestCase):
                 session.add(usershare)
         # Get leaderboard with top user as current
         userID = 1
-        leaderboard, curruser_lb_info = self.gdb.getleaderboard(userID)
+        leaderboard, curruser_lb_info, count = self.gdb.getleaderboard(
+            userID)
         # Assert the current user was returned correctly
         assert curruser_lb_info['userID'] == userID
         # Assert that leaderboard is ordered and ranked correctly
@@ -497,10 +1336,183 @@ class TestDatabaseAPI(unittest.TestCase):
         assert leaderboard[0]['totalvalue'] == 10000 + 100 * 20
         assert leaderboard[1]['totalvalue'] == 5000
         assert leaderboard[2]['totalvalue'] == 2000 + 100 * 20
+        # Get only top of leaderboard with bottom user as current
+        leaderboard, curruser_lb_info, count = self.gdb.getleaderboard(
+            2, limit=1)
+        assert [row['userID'] for row in leaderboard] == [1]
+        assert curruser_lb_info['ranking'] == 3
+        assert count == 3
+        # Assert current user is returned with users ranked either side
+        assert [row['userID'] for row in curruser_lb_info[
+            'neighbours']] == [1, 3, 2]
+        assert [row['ranking'] for row in curruser_lb_info[
+            'neighbours']] == [1, 2, 3]
+        # Get second page of leaderboard
+        leaderboard, curruser_lb_info, count = self.gdb.getleaderboard(
+            1, limit=1, offset=1, neighbours=1)
+        assert [(row['userID'], row['ranking'])
+                for row in leaderboard] == [(3, 2)]
+        assert [row['userID'] for row in curruser_lb_info[
+            'neighbours']] == [1, 3]
+        # Buy shares as bottom user and assert their ranking was refreshed,
+        # since the fee reduces their total value below the third user
+        assert self.gdb.buyshare(2, issuerID, 1) is True
+        leaderboard, curruser_lb_info, count = self.gdb.getleaderboard(2)
+        assert curruser_lb_info['sharesvalue'] == 100 * 21
+        assert curruser_lb_info['totalvalue'] == pytest.approx(
+            2000 + 100 * 20 - (50 + 100 * 0.01))
+        assert curruser_lb_info['ranking'] == 3
+        # Assert users without a ranking yet are ranked when requested
+        with self.gdb.sessionmanager() as session:
+            session.add(self.generatetestuser(userID=4, balance=100000))
+        leaderboard, curruser_lb_info, count = self.gdb.getleaderboard(
+            4, limit=2)
+        assert curruser_lb_info['ranking'] == 1
+        assert [row['userID'] for row in leaderboard] == [4, 1]
+        # Assert users with equal total values share a ranking
+        with self.gdb.sessionmanager() as session:
+            session.add(self.generatetestuser(userID=5, balance=100000))
+        leaderboard, curruser_lb_info, count = self.gdb.getleaderboard(
+            5, limit=3, neighbours=1)
+        assert [(row['userID'], row['ranking'])
+                for row in leaderboard] == [(4, 1), (5, 1), (1, 3)]
+        assert curruser_lb_info['ranking'] == 1
+        assert [row['ranking'] for row in curruser_lb_info[
+            'neighbours']] == [1, 1, 3]
+
+    def test_refreshrankings(self):
+        # Generate user holding a share
+        userID = 1
+        share = self.generatetestshare(issuerID="TST", currentprice=100)
+        user = self.generatetestuser(userID=userID, balance=1000)
+        usershare = Usershare(issuerID="TST", userID=userID, profit=0,
+                              loss=0, quantity=10)
+        with self.gdb.sessionmanager() as session:
+            session.add(share)
+            session.add(user)
+            session.commit()
+            session.add(usershare)
+            # Assert full refresh ranks user
+            assert self.gdb.refreshrankings(session) == 1
+            # Change share price and refresh again
+            session.query(Share).update({"currentprice": 200})
+            self.gdb.refreshrankings(session)
+        # Assert ranking holds values at the new price
+        with self.gdb.sessionmanager() as session:
+            ranking = session.query(Ranking).one()
+            assert ranking.sharesvalue == 2000
+            assert ranking.balance == 1000
+            assert ranking.totalvalue == 3000
+
+    def test_updateleaderboard(self):
+        # Generate users with predefined balances, two of them equal
+        balances = {1: 1000, 2: 3000, 3: 3000}
+        with self.gdb.sessionmanager() as session:
+            for userID, balance in balances.items():
+                session.add(self.generatetestuser(userID=userID,
+                                                  balance=balance))
+        # Record snapshot of leaderboard
+        assert self.gdb.updateleaderboard() == 3
+        # Assert every user was recorded at the same time and ranked
+        with self.gdb.sessionmanager() as session:
+            snapshots = session.query(Leaderboard).order_by(
+                Leaderboard.userID).all()
+            assert len({row.recordtime for row in snapshots}) == 1
+            assert [(row.ranking, float(row.totalvalue))
+                    for row in snapshots] == [(3, 1000), (1, 3000),
+                                              (1, 3000)]
+
+    def test_compactleaderboard(self):
+        # Generate users with snapshots every hour for ten days
+        now = datetime.utcnow()
+        with self.gdb.sessionmanager() as session:
+            for userID in (1, 2):
+                session.add(self.generatetestuser(userID=userID,
+                                                  balance=1000*userID))
+            session.commit()
+            self.gdb.refreshrankings(session)
+            for hour in range(24 * 10):
+                for userID in (1, 2):
+                    session.add(Leaderboard(
+                        userID=userID,
+                        recordtime=now - timedelta(hours=hour, minutes=30),
+                        ranking=userID, totalvalue=hour * userID))
+        topgainers = self.gdb.gettopgainers()
+        # Compact leaderboard in small batches, keeping two days of hours
+        hourlydays = self.gdb.leaderboardhourlydays
+        batchsize = self.gdb.leaderboardbatchsize
+        self.gdb.leaderboardhourlydays = 2
+        self.gdb.leaderboardbatchsize = 1
+        # Count commits, compacting within a request session that fails
+        commits = list()
+
+        def countcommit(*args):
+            commits.append(args)
+        event.listen(self.gdb.engine, "commit", countcommit)
+        try:
+            with pytest.raises(ValueError):
+                with self.gdb.requestsession():
+                    removed, deleted = self.gdb.compactleaderboard()
+                    raise ValueError
+        finally:
+            event.remove(self.gdb.engine, "commit", countcommit)
+            self.gdb.leaderboardhourlydays = hourlydays
+            self.gdb.leaderboardbatchsize = batchsize
+        assert deleted == removed * 2
+        # Assert each batch was committed on its own, so the failed request
+        # did not discard the deletions
+        assert len(commits) > deleted
+        # Assert recent snapshots were kept and older ones thinned to one
+        # per day
+        cutoff = now - timedelta(days=2)
+        with self.gdb.sessionmanager() as session:
+            recordtimes = [row.recordtime for row in session.query(
+                Leaderboard.recordtime).distinct()]
+        assert len([t for t in recordtimes if t >= cutoff]) == 48
+        older = [t.date() for t in recordtimes if t < cutoff]
+        assert len(older) == len(set(older))
+        assert len(recordtimes) + removed == 24 * 10
+        # Assert top gainers of week are unchanged and month still found
+        weektopgainers, monthtopgainers = self.gdb.gettopgainers()
+        assert [row['username'] for row in weektopgainers] == [
+            row['username'] for row in topgainers[0]]
+        assert len(weektopgainers) == 2
+        assert monthtopgainers == []
 
     def test_gettopgainers(self):
-        # TODO: Create unit test
-        pass
+        # Generate users with predefined balances
+        balances = {1: 1000, 2: 2000, 3: 3000}
+        with self.gdb.sessionmanager() as session:
+            for userID, balance in balances.items():
+                session.add(self.generatetestuser(userID=userID,
+                                                  balance=balance))
+            session.commit()
+            self.gdb.refreshrankings(session)
+            # Generate leaderboard snapshots, with an older snapshot in the
+            # week period and none for user 3 in either period
+            now = datetime.utcnow()
+            for userID, days, totalvalue in (
+                    (1, 7.9, 100), (1, 7.5, 500), (2, 7.5, 1000),
+                    (1, 30.5, 250), (2, 30.5, 2500), (3, 20, 1)):
+                session.add(Leaderboard(
+                    userID=userID, recordtime=now - timedelta(days=days),
+                    ranking=1, totalvalue=totalvalue))
+        # Get top gainers
+        weektopgainers, monthtopgainers = self.gdb.gettopgainers()
+        # Assert gains were calculated from latest snapshot in each period
+        assert [(row['username'], row['changeinvalue'])
+                for row in weektopgainers] == [
+            (self.gdb.getuserbyid(2).username, 1000),
+            (self.gdb.getuserbyid(1).username, 500)]
+        assert weektopgainers[1]['changepercentage'] == 100
+        assert weektopgainers[1]['previousvalue'] == 500
+        assert weektopgainers[1]['currentvalue'] == 1000
+        assert [row['changeinvalue'] for row in monthtopgainers] == [
+            750, -500]
+        # Assert only top gainers are returned when limited
+        weektopgainers, monthtopgainers = self.gdb.gettopgainers(limit=1)
+        assert [row['changeinvalue'] for row in weektopgainers] == [1000]
+        assert [row['changeinvalue'] for row in monthtopgainers] == [750]
 
     def test_gettipofday(self):
         # Create new tip
@@ -716,3 +1728,67 @@ class TestDatabaseAPI(unittest.TestCase):
         )
         # Return generated transaction
         return transaction
+
+
+class TestOrderBook(unittest.TestCase):
+    def test_triggered(self):
+        # Add orders of each type to order book
+        orderbook = OrderBook()
+        orderbook.add(1, "TST", 'B', 'limit', 90)
+        orderbook.add(2, "TST", 'S', 'stop', 80)
+        orderbook.add(3, "TST", 'S', 'limit', 120)
+        orderbook.add(4, "TST", 'B', 'stop', 110)
+        orderbook.add(5, "ABC", 'B', 'limit', 95)
+        assert len(orderbook) == 5
+        # Assert orders are triggered by prices reaching trigger prices
+        assert orderbook.triggered("TST", 100) == []
+        assert orderbook.triggered("TST", 90) == [1]
+        assert sorted(orderbook.triggered("TST", 75)) == [1, 2]
+        assert orderbook.triggered("TST", 110) == [4]
+        assert sorted(orderbook.triggered("TST", 150)) == [3, 4]
+        assert orderbook.triggered("ABC", 95) == [5]
+        assert orderbook.triggered("NON", 1) == []
+        # Assert removed orders are no longer triggered
+        orderbook.remove(1)
+        orderbook.remove(1)
+        assert orderbook.triggered("TST", 75) == [2]
+        assert len(orderbook) == 4
+
+
+class TestDownsampling(unittest.TestCase):
+    def test_lttb(self):
+        # Generate a sine wave with a single spike
+        times = list(range(10000))
+        values = [math.sin(t/500) for t in times]
+        values[5000] = 10
+        indices = downsampling.lttb(times, values, 100)
+        # Assert requested number of points are kept in time order
+        assert len(indices) == 100
+        assert all(a < b for a, b in zip(indices, indices[1:]))
+        # Assert first, last and spike points are kept
+        assert indices[0] == 0 and indices[-1] == 9999
+        assert 5000 in indices
+        # Assert short series are not downsampled
+        assert list(downsampling.lttb([1, 2], [1, 2], 100)) == [0, 1]
+        # Assert too few points to keep is rejected
+        with pytest.raises(ValueError):
+            downsampling.lttb(times, values, 2)
+
+    def test_minmax(self):
+        # Generate a sine wave with a single dip
+        times = list(range(10000))
+        values = [math.sin(t/500) for t in times]
+        values[1234] = -10
+        indices = downsampling.minmax(times, values, 100)
+        # Assert at most requested number of points are kept in time order
+        assert len(indices) <= 100
+        assert all(a < b for a, b in zip(indices, indices[1:]))
+        # Assert first, last and dip points are kept
+        assert indices[0] == 0 and indices[-1] == 9999
+        assert 1234 in indices
+        # Assert only first and last points are kept when there is no room
+        # for a bucket, and too few points to keep is rejected
+        assert list(downsampling.minmax(times, values, 3)) == [0, 9999]
+        with pytest.raises(ValueError):
+            downsampling.minmax(times, values, 2)
+